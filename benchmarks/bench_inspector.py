@@ -0,0 +1,70 @@
+#!/bin/env python
+"""
+Measure how long finding the completion context takes on big cells
+
+Compares a cold lookup (new cell), a warm lookup (typing at the end
+of the last cell) and, for reference, a full lexer pass over the cell,
+which is what the context lookup used to cost.
+
+usage: python benchmarks/bench_inspector.py [--repeat N]
+"""
+from __future__ import print_function
+import argparse
+import timeit
+
+from pygments.lexers.scripting import LuaLexer
+
+from ilua.inspector import Inspector
+
+LINE_TEMPLATES = [
+    'local value_{0} = string.format("%d: %s", {0}, "item") -- note\n',
+    'print(value_{0}, [[long\nstring]], \'quoted\')\n',
+    '--[[ block\ncomment {0} ]] t[{0}] = {{x = {0}}}\n',
+]
+
+def make_cell(size):
+    lines = []
+    length = 0
+    i = 0
+    while length < size:
+        line = LINE_TEMPLATES[i % len(LINE_TEMPLATES)].format(i)
+        lines.append(line)
+        length += len(line)
+        i += 1
+    return "".join(lines)
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description="Completion context benchmark")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    lexer = LuaLexer()
+    print("{:>8} {:>12} {:>12} {:>12}".format("size", "cold (ms)",
+                                              "warm (ms)", "lex (ms)"))
+    for size in (10, 25, 50, 100):
+        cell = make_cell(size * 1024) + "io.stdout:wr"
+
+        def cold():
+            Inspector().get_last_obj(cell, len(cell))
+
+        inspector = Inspector()
+        inspector.get_last_obj(cell, len(cell))
+        typed = [cell + "ite"[:i] for i in range(4)]
+        def warm():
+            for code in typed:
+                inspector.get_last_obj(code, len(code))
+
+        def lex():
+            list(lexer.get_tokens(cell))
+
+        print("{:>6}KB {:>12.3f} {:>12.3f} {:>12.3f}".format(
+            size,
+            best_of(cold, args.repeat) * 1000,
+            best_of(warm, args.repeat) * 1000 / len(typed),
+            best_of(lex, min(args.repeat, 5)) * 1000))
+
+if __name__ == "__main__":
+    main()
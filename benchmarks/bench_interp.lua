@@ -0,0 +1,250 @@
+-- ILua
+-- Copyright (C) 2018  guysv
+
+-- This file is part of ILua which is released under GPLv2.
+-- See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+-- for full license details.
+
+-- Microbenchmarks of the Lua side of the kernel: json encoding and
+-- decoding, netstring framing, inspect rendering, and completion and
+-- inspection of namespaces
+--
+-- Reports operations per second, and KB allocated per operation
+-- (measured with the garbage collector stopped)
+--
+-- usage: lua benchmarks/bench_interp.lua [--raw] [--min-time SECONDS]
+--                                        [NAME_PATTERN ...]
+
+local script_dir = (arg and arg[0] or ""):match("^(.*)[/\\]") or "."
+package.path = script_dir .. "/../ilua/?.lua;" .. package.path
+
+local json = require"ext.json"
+local netstring = require"ext.netstring"
+local inspect = require"ext.inspect"
+local introspect = require"introspect"
+
+local unpack = table.unpack or unpack
+
+local raw = false
+local min_time = 0.5
+local patterns = {}
+local i = 1
+while arg and arg[i] do
+    if arg[i] == "--raw" then
+        raw = true
+    elseif arg[i] == "--min-time" then
+        i = i + 1
+        min_time = assert(tonumber(arg[i]), "--min-time expects seconds")
+    else
+        patterns[#patterns + 1] = arg[i]
+    end
+    i = i + 1
+end
+
+-- Workload data
+
+local function deep_table(depth)
+    local root = {}
+    local node = root
+    for level = 1, depth do
+        node.level = level
+        node.name = "node " .. level
+        node.child = {}
+        node = node.child
+    end
+    return root
+end
+
+local function wide_table(width)
+    local t = {}
+    for n = 1, width do
+        t["key_" .. n] = {id = n, name = "item " .. n, ok = n % 2 == 0}
+    end
+    return t
+end
+
+local function number_array(length)
+    local t = {}
+    for n = 1, length do
+        t[n] = n * 1.5
+    end
+    return t
+end
+
+local function escaped_string(length)
+    local parts = {}
+    local size = 0
+    local chunk = 'line with "quotes", a \\ backslash\tand a tab\n'
+    while size < length do
+        parts[#parts + 1] = chunk
+        size = size + #chunk
+    end
+    return table.concat(parts)
+end
+
+local function namespace(size)
+    local ns = {}
+    for n = 1, size do
+        ns["name_" .. n] = n % 3 == 0 and print or n
+    end
+    return ns
+end
+
+local DEEP = deep_table(100)
+local WIDE = wide_table(1000)
+local ARRAY = number_array(10000)
+local LONG_STRING = escaped_string(100 * 1024)
+local BIG_NAMESPACE = namespace(100000)
+local DEEP_JSON = json.encode(DEEP)
+local WIDE_JSON = json.encode(WIDE)
+local ARRAY_JSON = json.encode(ARRAY)
+local LONG_STRING_JSON = json.encode(LONG_STRING)
+local COMPLETE_REPLY = json.encode({type = "complete", payload = {
+    matches = introspect.complete(BIG_NAMESPACE, {}, false), version = 1}})
+
+-- In-memory stream, with the file methods netstring uses
+local function memory_stream(data)
+    local stream = {data = data or "", pos = 1, parts = {}}
+    function stream:write(...)
+        for n = 1, select("#", ...) do
+            self.parts[#self.parts + 1] = (select(n, ...))
+        end
+        return true
+    end
+    function stream:read(count)
+        local chunk = self.data:sub(self.pos, self.pos + count - 1)
+        self.pos = self.pos + count
+        return chunk
+    end
+    return stream
+end
+
+local SMALL_FRAME = ('%d:%s,'):format(#'{"type":"echo"}', '{"type":"echo"}')
+local BIG_FRAME = ('%d:%s,'):format(#COMPLETE_REPLY, COMPLETE_REPLY)
+
+-- name, function
+local benchmarks = {
+    {"json.encode deep", function() json.encode(DEEP) end},
+    {"json.encode wide", function() json.encode(WIDE) end},
+    {"json.encode array", function() json.encode(ARRAY) end},
+    {"json.encode long string", function() json.encode(LONG_STRING) end},
+    {"json.encode complete reply", function()
+        json.encode({type = "complete", payload = {
+            matches = introspect.complete(BIG_NAMESPACE, {}, false),
+            version = 1}})
+    end},
+    {"json.decode deep", function() json.decode(DEEP_JSON) end},
+    {"json.decode wide", function() json.decode(WIDE_JSON) end},
+    {"json.decode array", function() json.decode(ARRAY_JSON) end},
+    {"json.decode long string", function() json.decode(LONG_STRING_JSON) end},
+    {"netstring.write small", function()
+        netstring.write(memory_stream(), '{"type":"echo"}')
+    end},
+    {"netstring.write big", function()
+        netstring.write(memory_stream(), COMPLETE_REPLY)
+    end},
+    {"netstring.read small", function()
+        netstring.read(memory_stream(SMALL_FRAME))
+    end},
+    {"netstring.read big", function()
+        netstring.read(memory_stream(BIG_FRAME))
+    end},
+    {"inspect deep", function()
+        inspect(DEEP, {newline="", indent=""})
+    end},
+    {"inspect wide", function()
+        inspect(WIDE, {newline="", indent=""})
+    end},
+    {"inspect array", function()
+        inspect(ARRAY, {newline="", indent=""})
+    end},
+    {"inspect long string", function()
+        inspect(LONG_STRING, {newline="", indent=""})
+    end},
+    {"complete 100k namespace", function()
+        introspect.complete(BIG_NAMESPACE, {}, false)
+    end},
+    {"complete 100k namespace methods", function()
+        introspect.complete(BIG_NAMESPACE, {}, true)
+    end},
+    {"complete string", function()
+        introspect.complete(_G, {"string"}, false)
+    end},
+    {"info string.format", function()
+        introspect.info(_G, {"string", "format"})
+    end},
+}
+
+-- Measurement
+
+local function selected(name)
+    if #patterns == 0 then
+        return true
+    end
+    for _, pattern in ipairs(patterns) do
+        if name:find(pattern) then
+            return true
+        end
+    end
+    return false
+end
+
+local function run_batch(func, iterations)
+    local start = os.clock()
+    for _ = 1, iterations do
+        func()
+    end
+    return os.clock() - start
+end
+
+-- Runs batches of doubling size until one takes min_time
+local function ops_per_sec(func)
+    local iterations = 1
+    while true do
+        local elapsed = run_batch(func, iterations)
+        if elapsed >= min_time then
+            return iterations / elapsed
+        end
+        -- Aim straight for min_time once timings are meaningful
+        if elapsed > 0.01 then
+            iterations = math.max(iterations * 2,
+                math.ceil(iterations * min_time / elapsed * 1.1))
+        else
+            iterations = iterations * 10
+        end
+    end
+end
+
+-- KB allocated per operation, over a few operations
+local function kb_per_op(func)
+    local iterations = 5
+    collectgarbage("collect")
+    collectgarbage("stop")
+    local before = collectgarbage("count")
+    for _ = 1, iterations do
+        func()
+    end
+    local allocated = collectgarbage("count") - before
+    collectgarbage("restart")
+    collectgarbage("collect")
+    return allocated / iterations
+end
+
+if not raw then
+    print(("%s (%s)"):format(_VERSION, jit and jit.version or "PUC"))
+    print(("%-34s %14s %12s"):format("benchmark", "ops/s", "KB/op"))
+end
+for _, benchmark in ipairs(benchmarks) do
+    local name, func = unpack(benchmark)
+    if selected(name) then
+        func() -- warm up (and JIT compile)
+        local ops = ops_per_sec(func)
+        local kb = kb_per_op(func)
+        if raw then
+            print(("%s\t%.3f\t%.3f"):format(name, ops, kb))
+        else
+            print(("%-34s %14.1f %12.2f"):format(name, ops, kb))
+        end
+        io.stdout:flush()
+    end
+end
@@ -0,0 +1,96 @@
+#!/bin/env python
+"""
+Run the Lua runtime microbenchmarks on every Lua interpreter found
+
+Runs bench_interp.lua with each interpreter, and prints operations
+per second and KB allocated per operation of each workload side by
+side. Interpreters are looked up on PATH unless given explicitly.
+
+usage: python benchmarks/bench_interp.py [--interpreter LUA ...]
+                                         [--min-time SECONDS]
+                                         [--output FILE] [NAME_PATTERN ...]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+BENCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "bench_interp.lua")
+INTERPRETERS = ["lua5.1", "lua5.2", "lua5.3", "lua5.4", "luajit", "lua"]
+
+def find_interpreters():
+    found = []
+    seen = set()
+    for name in INTERPRETERS:
+        path = which(name)
+        if path and os.path.realpath(path) not in seen:
+            seen.add(os.path.realpath(path))
+            found.append(name)
+    return found
+
+def run(interpreter, min_time, patterns):
+    """
+    :return: list of (workload, ops/s, KB/op) tuples
+    """
+    output = subprocess.check_output([interpreter, BENCH_SCRIPT, "--raw",
+                                      "--min-time", str(min_time)] + patterns)
+    results = []
+    for line in output.decode("utf8").splitlines():
+        name, ops, kb = line.split("\t")
+        results.append((name, float(ops), float(kb)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Lua runtime "
+                                                 "microbenchmarks")
+    parser.add_argument("--interpreter", action="append",
+                        help="Lua interpreter to run (default: all found)")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="Seconds to time each workload for")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("patterns", nargs="*",
+                        help="Only run workloads matching these Lua patterns")
+    args = parser.parse_args()
+
+    interpreters = args.interpreter or find_interpreters()
+    if not interpreters:
+        print("No Lua interpreter found", file=sys.stderr)
+        sys.exit(1)
+
+    results = {}
+    workloads = []
+    for interpreter in interpreters:
+        print("Running {}...".format(interpreter), file=sys.stderr)
+        results[interpreter] = {}
+        for name, ops, kb in run(interpreter, args.min_time, args.patterns):
+            results[interpreter][name] = {'ops_per_sec': ops, 'kb_per_op': kb}
+            if name not in workloads:
+                workloads.append(name)
+
+    print("{:<34}".format("ops/s") + "".join(
+        "{:>14}".format(interpreter) for interpreter in interpreters))
+    for name in workloads:
+        print("{:<34}".format(name) + "".join(
+            "{:>14.1f}".format(results[interpreter][name]['ops_per_sec'])
+            for interpreter in interpreters))
+    print("\n{:<34}".format("KB/op") + "".join(
+        "{:>14}".format(interpreter) for interpreter in interpreters))
+    for name in workloads:
+        print("{:<34}".format(name) + "".join(
+            "{:>14.2f}".format(results[interpreter][name]['kb_per_op'])
+            for interpreter in interpreters))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+#!/bin/env python
+"""
+Measure end-to-end kernel latency over ZeroMQ
+
+Launches ILuaApp with a generated connection file, drives it with a
+jupyter_client client, and measures reply latency percentiles and
+throughput of each scenario, plus the time to the first kernel_info
+reply at startup.
+
+Results are written as JSON, and compared against a stored baseline:
+scenarios whose p50 or p95 grew past the threshold are reported as
+regressions, and the exit status is 1. Baselines depend on the machine,
+so none is committed: save one with --save-baseline before comparing.
+To compare transports, save a baseline with --transport tcp and run
+again with --transport ipc.
+
+usage: python benchmarks/bench_kernel.py [--lua LUA] [--iterations N]
+                                         [--transport {tcp,ipc}]
+                                         [--output FILE] [--baseline FILE]
+                                         [--save-baseline] [--threshold X]
+                                         [--min-delta MS]
+                                         [--scenario NAME ...]
+                                         [-- KERNEL_ARGS ...]
+"""
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from jupyter_client import BlockingKernelClient
+from jupyter_client.connect import write_connection_file
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks",
+                                "bench_kernel_baseline.json")
+TIMEOUT = 60
+# Metrics compared against the baseline
+COMPARED_METRICS = ("first_reply_ms", "p50_ms", "p95_ms")
+
+# Code run once before the iterations of a scenario
+BIG_TABLE_SETUP = ("big = {} for i = 1, 20000 do "
+                   "big['key_' .. i] = i end")
+HEAVY_CODE = ("local t = {} for i = 1, 200000 do t[i] = i * i end "
+              "local s = 0 for i = 1, #t do s = s + t[i] end return s")
+STREAM_LINES = 20000
+
+def kernel_info(client):
+    return client.kernel_info()
+
+def execute(code):
+    return lambda client: client.execute(code)
+
+def complete(code):
+    return lambda client: client.complete(code, len(code))
+
+def inspect(code):
+    return lambda client: client.inspect(code, len(code))
+
+def is_complete(code):
+    return lambda client: client.is_complete(code)
+
+# name: (request, setup code)
+SCENARIOS = [
+    ("kernel_info", kernel_info, None),
+    ("execute_trivial", execute("return 1"), None),
+    ("execute_heavy", execute(HEAVY_CODE), None),
+    ("complete_large_table", complete("big.key_1"), BIG_TABLE_SETUP),
+    ("inspect", inspect("string.format"), None),
+    ("is_complete", is_complete("for i = 1, 10 do"), None),
+    ("stream_output", execute(
+        "for i = 1, {} do print('output line', i) end".format(STREAM_LINES)),
+     None),
+]
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    rank = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(0, rank)]
+
+def wait_reply(client, msg_id, deadline):
+    while True:
+        reply = client.get_shell_msg(timeout=max(0, deadline - time.time()))
+        if reply['parent_header'].get('msg_id') == msg_id:
+            return reply
+
+def wait_idle(client, msg_id, deadline):
+    """
+    Drain IOPub up to the idle status of a request
+
+    :return: bytes of stream output the request produced
+    """
+    stream_bytes = 0
+    while True:
+        msg = client.get_iopub_msg(timeout=max(0, deadline - time.time()))
+        if msg['parent_header'].get('msg_id') != msg_id:
+            continue
+        if msg['msg_type'] == 'stream':
+            stream_bytes += len(msg['content']['text'].encode("utf8"))
+        elif msg['msg_type'] == 'status' and \
+             msg['content']['execution_state'] == 'idle':
+            return stream_bytes
+
+def drain_iopub(client):
+    while True:
+        try:
+            client.get_iopub_msg(timeout=0.1)
+        except Empty:
+            return
+
+def run_request(client, request):
+    """
+    Send a request and wait for it to finish
+
+    :return: seconds until the reply, and bytes of stream output
+    """
+    deadline = time.time() + TIMEOUT
+    start = time.time()
+    msg_id = request(client)
+    reply = wait_reply(client, msg_id, deadline)
+    latency = time.time() - start
+    stream_bytes = wait_idle(client, msg_id, deadline)
+    if reply['content'].get('status') == 'error':
+        raise RuntimeError("Request failed: {}".format(
+            reply['content'].get('evalue')))
+    return latency, stream_bytes
+
+def run_scenario(client, request, setup, iterations, warmup):
+    if setup:
+        run_request(client, execute(setup))
+    for _ in range(warmup):
+        run_request(client, request)
+
+    latencies = []
+    stream_bytes = 0
+    start = time.time()
+    for _ in range(iterations):
+        latency, output = run_request(client, request)
+        latencies.append(latency)
+        stream_bytes += output
+    elapsed = time.time() - start
+
+    result = {
+        'iterations': iterations,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'ops_per_sec': iterations / elapsed,
+    }
+    if stream_bytes:
+        result['stream_mb_per_sec'] = stream_bytes / elapsed / 1024 / 1024
+    return result
+
+def start_kernel(lua, kernel_args, transport):
+    """
+    Launch the kernel and wait for its first kernel_info reply
+
+    :return: kernel process, client, and seconds to the first reply
+    """
+    fd, connection_file = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    extra = {}
+    if transport == "ipc":
+        # Sockets are named after the connection file
+        extra['ip'] = connection_file[:-len(".json")] + "-ipc"
+    write_connection_file(connection_file, transport=transport,
+                          key=str(uuid.uuid4()).encode("ascii"), **extra)
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, "-m", "ilua.app",
+                                "-c", connection_file, "-i", lua,
+                                "-l", "error"] + kernel_args,
+                               cwd=REPO_ROOT)
+    client = BlockingKernelClient(connection_file=connection_file)
+    client.load_connection_file()
+    client.start_channels()
+    # Requests queue up on the client until the kernel binds
+    msg_id = client.kernel_info()
+    wait_reply(client, msg_id, start + TIMEOUT)
+    startup = time.time() - start
+    drain_iopub(client)
+    os.remove(connection_file)
+    return process, client, startup
+
+def stop_kernel(process, client):
+    try:
+        client.shutdown()
+        process.wait(timeout=10)
+    except Exception:
+        process.kill()
+    finally:
+        client.stop_channels()
+        if client.transport == "ipc":
+            for port in (client.shell_port, client.iopub_port,
+                         client.stdin_port, client.control_port,
+                         client.hb_port):
+                try:
+                    os.remove("{}-{}".format(client.ip, port))
+                except OSError:
+                    pass
+
+def compare(results, baseline, threshold, min_delta):
+    """
+    Print a comparison table, and return the names of the scenarios
+    that regressed past threshold, by more than min_delta milliseconds
+    (sub-millisecond latencies are noisy)
+    """
+    regressions = []
+    print("\n{:<22} {:>8} {:>12} {:>12} {:>8}".format(
+        "scenario", "metric", "base (ms)", "now (ms)", "change"))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in result or not base.get(metric):
+                continue
+            ratio = result[metric] / base[metric]
+            regressed = ratio > threshold and \
+                        result[metric] - base[metric] > min_delta
+            flag = " !" if regressed else ""
+            print("{:<22} {:>8} {:>12.3f} {:>12.3f} {:>+7.1f}%{}".format(
+                name, metric[:-3], base[metric], result[metric],
+                (ratio - 1) * 100, flag))
+            if regressed and name not in regressions:
+                regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end kernel "
+                                                 "latency benchmark")
+    parser.add_argument("--lua", default="lua",
+                        help="Lua interpreter the kernel runs")
+    parser.add_argument("--transport", choices=("tcp", "ipc"), default="tcp",
+                        help="ZeroMQ transport between client and kernel")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--scenario", action="append",
+                        help="Only run these scenarios")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="Baseline JSON file to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Slowdown ratio reported as a regression")
+    parser.add_argument("--min-delta", type=float, default=0.5,
+                        help="Milliseconds a regression must add")
+    parser.add_argument("kernel_args", nargs="*",
+                        help="Extra kernel arguments (after --)")
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not args.scenario or scenario[0] in args.scenario]
+    process, client, startup = start_kernel(args.lua, args.kernel_args,
+                                            args.transport)
+    results = {'startup': {'first_reply_ms': startup * 1000}}
+    try:
+        print("{:<22} {:>10} {:>10} {:>10} {:>10}".format(
+            "scenario", "p50 (ms)", "p95 (ms)", "p99 (ms)", "ops/s"))
+        print("{:<22} {:>10.3f}".format("startup", startup * 1000))
+        for name, request, setup in scenarios:
+            # Heavy scenarios get fewer iterations
+            iterations = args.iterations if name not in \
+                ("execute_heavy", "stream_output") else \
+                max(1, args.iterations // 10)
+            result = run_scenario(client, request, setup, iterations,
+                                  min(args.warmup, iterations))
+            results[name] = result
+            print("{:<22} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.1f}{}".format(
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['ops_per_sec'],
+                " ({:.1f}MB/s)".format(result['stream_mb_per_sec'])
+                if 'stream_mb_per_sec' in result else ""))
+    finally:
+        stop_kernel(process, client)
+
+    report = {
+        'meta': {
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'lua': args.lua,
+            'transport': args.transport,
+            'kernel_args': args.kernel_args,
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline:
+            json.dump(report, baseline, indent=2, sort_keys=True)
+        print("\nSaved baseline to {}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline:
+            baseline_results = json.load(baseline)['results']
+        regressions = compare(results, baseline_results, args.threshold,
+                              args.min_delta)
+        if regressions:
+            print("\nRegressed: {}".format(", ".join(regressions)))
+            sys.exit(1)
+    else:
+        # Baselines are machine specific, none is committed
+        print("\nNo baseline at {}, nothing compared. Run with "
+              "--save-baseline to save one".format(args.baseline))
+
+if __name__ == "__main__":
+    main()
@@ -53,6 +53,9 @@ class UnixFifo(abstract.FileDescriptor):
     
     def dataReceived(self, data):
         pass
+
+    def pipeClosed(self, reason):
+        pass
     
     def _try_open(self):
         """
@@ -94,4 +97,5 @@ class UnixFifo(abstract.FileDescriptor):
     def connectionLost(self, reason):
         super(UnixFifo, self).connectionLost(reason)
         os.close(self.fileno())
-        os.remove(self.path)
\ No newline at end of file
+        os.remove(self.path)
+        self.pipeClosed(reason)
\ No newline at end of file
@@ -10,11 +10,14 @@ twisted FileDescriptor
 """
 
 import os
+import pywintypes
 import win32con
 import win32event
 import win32file
 import win32pipe
-from twisted.internet import abstract, defer
+import winerror
+from twisted.internet import abstract, defer, main
+from twisted.python import failure
 
 def get_pipe_path(name):
     """
@@ -59,6 +62,9 @@ class Win32NamedPipe(abstract.FileDescriptor):
     def dataReceived(self, data):
         pass
 
+    def pipeClosed(self, reason):
+        pass
+
     def _connected(self):
         self._connect_deferred.callback(None)
 
@@ -102,7 +108,15 @@ class Win32NamedPipe(abstract.FileDescriptor):
         Read some data
         """
 
-        n = win32file.GetOverlappedResult(self._handle, self._olapped_io, 0)
+        try:
+            n = win32file.GetOverlappedResult(self._handle, self._olapped_io,
+                                              0)
+        except pywintypes.error as err:
+            if err.winerror != winerror.ERROR_BROKEN_PIPE:
+                raise
+            # The other end closed the pipe
+            self.connectionLost(failure.Failure(main.CONNECTION_DONE))
+            return
         data = self._read_buffer[:n]
         self.dataReceived(data)
         win32event.ResetEvent(self._olapped_io.hEvent)
@@ -138,3 +152,4 @@ class Win32NamedPipe(abstract.FileDescriptor):
         super(Win32NamedPipe, self).connectionLost(reason)
         self.reactor.removeEvent(self._olapped_io.hEvent)
         self._handle.close()
+        self.pipeClosed(reason)
@@ -9,7 +9,7 @@ ILua's kernel app entry point and command-line tweaks
 """
 
 from .appbase import AppBase
-from .kernel import ILuaKernel
+from .kernel import ILuaKernel, BYTECODE_CACHE_DIR
 
 class ILuaApp(AppBase):
     def __init__(self, *args, **kwargs):
@@ -19,6 +19,77 @@ class ILuaApp(AppBase):
                                                            'lua'),
                                  help="Lua interpreter to use for code "
                                       "evaluations")
+        self.parser.add_argument("-b", "--bytecode-cache", metavar="DIR",
+                                 default=self._get_default("BYTECODE_CACHE",
+                                                           BYTECODE_CACHE_DIR),
+                                 help="Directory to cache compiled Lua "
+                                      "modules in")
+        self.parser.add_argument("--complete-limit", metavar="N", type=int,
+                                 default=self._get_default("COMPLETE_LIMIT",
+                                                           500),
+                                 help="Maximal number of completion matches "
+                                      "to reply with (0 for no limit)")
+        self.parser.add_argument("--output-limit", metavar="KB", type=int,
+                                 default=self._get_default("OUTPUT_LIMIT",
+                                                           1024),
+                                 help="Output of a cell to publish, in KB, "
+                                      "the rest is written to a file that "
+                                      "`%%output` views (0 for no limit)")
+        self.parser.add_argument("--out-cache-entries", metavar="N", type=int,
+                                 default=self._get_default("OUT_CACHE_ENTRIES",
+                                                           100),
+                                 help="Cell results to keep in Out and _N "
+                                      "(0 to keep none)")
+        self.parser.add_argument("--out-cache-memory", metavar="KB", type=int,
+                                 default=self._get_default("OUT_CACHE_MEMORY",
+                                                           65536),
+                                 help="Estimated memory of cell results to "
+                                      "keep in Out, in KB (0 for no limit)")
+        self.parser.add_argument("--execute-timeout", metavar="SECONDS",
+                                 type=float,
+                                 default=self._get_default("EXECUTE_TIMEOUT",
+                                                           0),
+                                 help="Restart the Lua interpreter when a "
+                                      "cell runs for longer (0 waits "
+                                      "forever)")
+        self.parser.add_argument("--memory-limit", metavar="KB", type=int,
+                                 default=self._get_default("MEMORY_LIMIT", 0),
+                                 help="Fail cells that grow the Lua heap "
+                                      "past this, in KB, checked from a Lua "
+                                      "debug hook that slows code down (0 "
+                                      "for no limit)")
+        self.parser.add_argument("--address-space-limit", metavar="KB",
+                                 type=int,
+                                 default=self._get_default(
+                                     "ADDRESS_SPACE_LIMIT", 0),
+                                 help="Address space the Lua interpreter "
+                                      "may map, in KB, allocations past it "
+                                      "fail (0 for no limit)")
+        self.parser.add_argument("--cpu-limit", metavar="SECONDS", type=int,
+                                 default=self._get_default("CPU_LIMIT", 0),
+                                 help="CPU seconds the Lua interpreter may "
+                                      "use, it is restarted past them (0 "
+                                      "for no limit)")
+        self.parser.add_argument("--open-files-limit", metavar="N", type=int,
+                                 default=self._get_default("OPEN_FILES_LIMIT",
+                                                           0),
+                                 help="Files the Lua interpreter may have "
+                                      "open, its own pipes included (0 for "
+                                      "no limit)")
+        self.parser.add_argument("--warm-spare", action="store_true",
+                                 default=self._get_flag_default("WARM_SPARE"),
+                                 help="Keep a spare Lua interpreter running, "
+                                      "to take over right away when the "
+                                      "current one dies")
+        self.parser.add_argument("--live-introspection", action="store_true",
+                                 default=self._get_flag_default(
+                                     "LIVE_INTROSPECTION"),
+                                 help="Serve completion and inspection "
+                                      "requests while code runs, by polling "
+                                      "for them from a Lua debug hook")
+        self.parser.add_argument("--no-bytecode-cache", dest="bytecode_cache",
+                                 action="store_const", const="",
+                                 help="Always compile Lua modules from source")
 
 def main():
     ILuaApp().run()
@@ -32,6 +32,9 @@ from twisted.internet import task
 from twisted.logger import globalLogBeginner, FilteringLogObserver, \
                            textFileLogObserver, LogLevel, PredicateResult
 from .connection import ConnectionFile
+from .history import HistoryManager
+from .kernelbase import KernelBase
+from . import offload, iopub, sockets
 
 class AppBase(object):
     """
@@ -73,6 +76,139 @@ class AppBase(object):
                                  metavar="LEVEL",
                                  choices=self._NAME_TO_LEVEL.keys(),
                                  help="Show only certain logs")
+        self.parser.add_argument('--history-flush-interval', type=float,
+                                 default=self._get_default(
+                                     'HISTORY_FLUSH_INTERVAL',
+                                     HistoryManager.FLUSH_INTERVAL),
+                                 metavar="SECONDS",
+                                 help="Seconds between history writes")
+        self.parser.add_argument('--history-flush-threshold', type=int,
+                                 default=self._get_default(
+                                     'HISTORY_FLUSH_THRESHOLD',
+                                     HistoryManager.FLUSH_THRESHOLD),
+                                 metavar="ENTRIES",
+                                 help="Write history early once this many "
+                                      "entries are buffered")
+        self.parser.add_argument('--history-max-sessions', type=int,
+                                 default=self._get_default(
+                                     'HISTORY_MAX_SESSIONS', 0),
+                                 metavar="SESSIONS",
+                                 help="Number of past sessions to keep in "
+                                      "history, 0 keeps all of them")
+        self.parser.add_argument('--history-max-age', type=float,
+                                 default=self._get_default(
+                                     'HISTORY_MAX_AGE', 0),
+                                 metavar="DAYS",
+                                 help="Forget sessions older than this, "
+                                      "0 keeps all of them")
+        self.parser.add_argument('--history-max-size', type=float,
+                                 default=self._get_default(
+                                     'HISTORY_MAX_SIZE', 0),
+                                 metavar="MB",
+                                 help="Forget the oldest sessions once "
+                                      "history sources exceed this size, "
+                                      "0 for no limit")
+        self.parser.add_argument('--history-compaction-interval', type=float,
+                                 default=self._get_default(
+                                     'HISTORY_COMPACTION_INTERVAL',
+                                     HistoryManager.COMPACTION_INTERVAL),
+                                 metavar="SECONDS",
+                                 help="Seconds between history clean ups, "
+                                      "0 disables them")
+        self.parser.add_argument('--complete-timeout', type=float,
+                                 default=self._get_default(
+                                     'COMPLETE_TIMEOUT',
+                                     KernelBase.COMPLETE_TIMEOUT),
+                                 metavar="SECONDS",
+                                 help="Reply with no matches to completion "
+                                      "requests taking longer, 0 waits "
+                                      "forever")
+        self.parser.add_argument('--inspect-timeout', type=float,
+                                 default=self._get_default(
+                                     'INSPECT_TIMEOUT',
+                                     KernelBase.INSPECT_TIMEOUT),
+                                 metavar="SECONDS",
+                                 help="Reply with nothing found to "
+                                      "inspection requests taking longer, "
+                                      "0 waits forever")
+        self.parser.add_argument('--is-complete-timeout', type=float,
+                                 default=self._get_default(
+                                     'IS_COMPLETE_TIMEOUT',
+                                     KernelBase.IS_COMPLETE_TIMEOUT),
+                                 metavar="SECONDS",
+                                 help="Reply with an unknown status to code "
+                                      "completeness requests taking longer, "
+                                      "0 waits forever")
+        self.parser.add_argument('--metrics-port', type=int,
+                                 default=self._get_default('METRICS_PORT', 0),
+                                 metavar="PORT",
+                                 help="Serve metrics in the Prometheus "
+                                      "format on this localhost port, 0 to "
+                                      "not serve them")
+        self.parser.add_argument('--metrics-file',
+                                 default=self._get_default('METRICS_FILE',
+                                                           None),
+                                 metavar="PATH",
+                                 help="Dump metrics as JSON to this file "
+                                      "periodically")
+        self.parser.add_argument('--metrics-interval', type=float,
+                                 default=self._get_default(
+                                     'METRICS_INTERVAL', 10.0),
+                                 metavar="SECONDS",
+                                 help="Seconds between metrics dumps")
+        self.parser.add_argument('--trace-file',
+                                 default=self._get_default('TRACE_FILE',
+                                                           None),
+                                 metavar="PATH",
+                                 help="Trace requests to this file, in the "
+                                      "Chrome trace event format")
+        self.parser.add_argument('--offload-threshold', type=int,
+                                 default=self._get_default(
+                                     'OFFLOAD_THRESHOLD',
+                                     offload.DEFAULT_THRESHOLD // 1024),
+                                 metavar="KB",
+                                 help="Decode, render and serialize messages "
+                                      "bigger than this off the reactor "
+                                      "thread, 0 to never do so")
+        self.parser.add_argument('--offload-threads', type=int,
+                                 default=self._get_default(
+                                     'OFFLOAD_THREADS', 2),
+                                 metavar="N",
+                                 help="Threads to decode, render and "
+                                      "serialize big messages with")
+        self.parser.add_argument('--reactor-heartbeat', action="store_true",
+                                 default=self._get_flag_default(
+                                     'REACTOR_HEARTBEAT'),
+                                 help="Answer heartbeats on the reactor "
+                                      "instead of a thread of their own, "
+                                      "they then stall while the kernel is "
+                                      "busy")
+        try:
+            socket_options = [sockets.parse_socket_option(spec)
+                              for spec in self._get_default(
+                                  'SOCKET_OPTIONS', "").split()]
+        except ValueError as err:
+            self.parser.error("{}SOCKET_OPTIONS: {}".format(
+                self.env_var_prefix, err))
+        self.parser.add_argument('--socket-option', action="append",
+                                 dest="socket_options", metavar="OPTION",
+                                 type=self._parse_socket_option,
+                                 default=socket_options,
+                                 help="Set a ZeroMQ socket option, as "
+                                      "[SOCKET.]NAME=VALUE, SOCKET being "
+                                      "one of {}, all sockets when omitted, "
+                                      "and NAME one of {}. Repeatable".format(
+                                          ", ".join(sockets.SOCKET_NAMES),
+                                          ", ".join(sorted(
+                                              sockets.SOCKET_OPTIONS))))
+        self.parser.add_argument('--iopub-backlog', type=int,
+                                 default=self._get_default(
+                                     'IOPUB_BACKLOG',
+                                     iopub.DEFAULT_MAX_BYTES // 1024),
+                                 metavar="KB",
+                                 help="Output to hold back while IOPub "
+                                      "subscribers catch up, in KB of "
+                                      "UTF-8 text, more is dropped")
     
     def run(self):
         """
@@ -81,24 +217,23 @@ class AppBase(object):
         # separated from other options to give subclasses a chance to override
         self.parser.add_argument('-c', '--connection-file',
                             help="Path to existing connection file")
+        self.parser.add_argument('--transport', choices=("tcp", "ipc"),
+                                 default=self._get_default('TRANSPORT',
+                                                           'tcp'),
+                                 help="ZeroMQ transport of generated "
+                                      "connection files, ipc uses Unix "
+                                      "domain sockets in the runtime dir")
         cli_args = vars(self.parser.parse_args())
-        
-        # wow twisted log api sucks bigtime
-        # all this mess just to set global log level
-        filter_level = self._NAME_TO_LEVEL[cli_args.pop("log_level")]
-        log_filter =\
-            lambda e: PredicateResult.yes if e['log_level'] >= filter_level\
-                      else PredicateResult.no
-        observer = FilteringLogObserver(textFileLogObserver(sys.stdout),
-                                        [log_filter])
-        globalLogBeginner.beginLoggingTo([observer], redirectStandardIO=False)
+        self._begin_logging(cli_args.pop("log_level"))
 
+        transport = cli_args.pop("transport")
         if cli_args.get("connection_file"):
             connection_file =\
                 ConnectionFile.from_existing(cli_args.pop("connection_file"))
             write_connection_file = False
         else:
-            connection_file = ConnectionFile.generate()
+            connection_file = ConnectionFile.generate({
+                "transport": transport})
             write_connection_file = True
         
         self.extra_kernel_kwargs.update(cli_args)
@@ -108,21 +243,58 @@ class AppBase(object):
                                       **self.extra_kernel_kwargs)
 
         if write_connection_file:
-            # Fix socket ports
-            props = connection_file.connection_props
-            props["shell_port"] = self._get_socket_port(self.kernel.shell_sock)
-            props["control_port"] = self._get_socket_port(self.kernel.ctrl_sock)
-            props["iopub_port"] = self._get_socket_port(self.kernel.iopub_sock)
-            props["stdin_port"] = self._get_socket_port(self.kernel.stdin_sock)
-            props["hb_port"] = self._get_socket_port(self.kernel.hb_sock)
-
+            self._fix_ports(connection_file.connection_props, self.kernel)
             connection_file_path = connection_file.write_file()
             hint = """To connect another client to this kernel, use:
         --existing {}""".format(path.basename(connection_file_path))
             print(hint)
+
+        def cleanup(result):
+            # Connection files of frontends are theirs to remove
+            if write_connection_file:
+                connection_file.cleanup()
+            return result
         
-        return task.react(lambda r: self.kernel.run())
+        return task.react(lambda r: self.kernel.run().addBoth(cleanup))
     
+    def _begin_logging(self, log_level):
+        """
+        Start logging to stdout
+
+        :param log_level: name of the lowest level to show
+        :type log_level: string
+        """
+
+        # wow twisted log api sucks bigtime
+        # all this mess just to set global log level
+        filter_level = self._NAME_TO_LEVEL[log_level]
+        log_filter =\
+            lambda e: PredicateResult.yes if e['log_level'] >= filter_level\
+                      else PredicateResult.no
+        observer = FilteringLogObserver(textFileLogObserver(sys.stdout),
+                                        [log_filter])
+        globalLogBeginner.beginLoggingTo([observer], redirectStandardIO=False)
+
+    @classmethod
+    def _fix_ports(cls, props, kernel):
+        """
+        Fill a generated connection file with the
+        ports the kernel sockets got bound to
+
+        :param props: properties of the connection file
+        :type props: dict
+        :param kernel: kernel bound to them
+        :type kernel: ilua.kernelbase.KernelBase
+        """
+
+        if props["transport"] != "tcp":
+            return
+        props["shell_port"] = cls._get_socket_port(kernel.shell_sock)
+        props["control_port"] = cls._get_socket_port(kernel.ctrl_sock)
+        props["iopub_port"] = cls._get_socket_port(kernel.iopub_sock)
+        props["stdin_port"] = cls._get_socket_port(kernel.stdin_sock)
+        props["hb_port"] = cls._get_socket_port(kernel.hb_sock)
+
     def _get_default(self, env_var_suffix, default):
         """
         Get default value for arguments from environment variable
@@ -138,6 +310,27 @@ class AppBase(object):
 
         return os.environ.get(self.env_var_prefix + env_var_suffix, default)
 
+    def _get_flag_default(self, env_var_suffix):
+        """
+        Get default value for flag arguments from environment
+        variable, flags are off unless set to a true value
+        
+        :param env_var_suffix: suffix of argument's environment variable
+        :type env_var_suffix: string
+        :return: Decided value
+        :rtype: bool
+        """
+
+        return self._get_default(env_var_suffix, "").lower() in \
+            ("1", "true", "yes", "on")
+
+    @staticmethod
+    def _parse_socket_option(spec):
+        try:
+            return sockets.parse_socket_option(spec)
+        except ValueError as err:
+            raise argparse.ArgumentTypeError(str(err))
+
     @staticmethod
     def _get_socket_port(socket):
         """
@@ -0,0 +1,182 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Completion candidates lookup, matching and ranking
+partially typed names against the keys of Lua tables
+"""
+
+import heapq
+import re
+
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Sorts after every character that may appear in a Lua name
+_PREFIX_END = u"\uffff"
+
+def _prefix_range(sorted_list, prefix):
+    """
+    Get the slice bounds of the items in `sorted_list`
+    starting with `prefix`
+    """
+    return (bisect_left(sorted_list, prefix),
+            bisect_left(sorted_list, prefix + _PREFIX_END))
+
+class CompletionIndex(object):
+    """
+    Searchable set of completion candidates
+
+    Candidates are kept sorted, so prefix matches are
+    found with a binary search. The case-insensitive
+    and fuzzy views are built on first use
+    """
+
+    def __init__(self, keys):
+        """
+        :param keys: completion candidates
+        :type keys: iterable
+        """
+
+        self.keys = sorted(set(keys))
+        self._folded = None
+        self._folded_keys = None
+        self._text = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def match(self, initial, limit=0):
+        """
+        Get the candidates matching `initial`, best first:
+        prefix matches, then case-insensitive prefix matches,
+        then candidates holding the characters of `initial`
+        in order (tighter and earlier matches rank higher)
+
+        :param initial: partially typed name
+        :type initial: string
+        :param limit: maximal number of matches, 0 for no limit
+        :type limit: int
+        :return: matching candidates
+        :rtype: list
+        """
+
+        if not initial:
+            return self.keys[:limit] if limit else list(self.keys)
+
+        start, end = _prefix_range(self.keys, initial)
+        if limit:
+            end = min(end, start + limit)
+        matches = self.keys[start:end]
+        if limit and len(matches) >= limit:
+            return matches
+
+        seen = set(matches)
+        for key in self._match_folded(initial):
+            if key not in seen:
+                seen.add(key)
+                matches.append(key)
+                if limit and len(matches) >= limit:
+                    return matches
+
+        fuzzy = (rank for rank in self._match_fuzzy(initial)
+                 if rank[-1] not in seen)
+        if limit:
+            fuzzy = heapq.nsmallest(limit - len(matches), fuzzy)
+        else:
+            fuzzy = sorted(fuzzy)
+        matches.extend(rank[-1] for rank in fuzzy)
+        return matches
+
+    def _match_folded(self, initial):
+        if self._folded is None:
+            pairs = sorted((key.lower(), key) for key in self.keys)
+            self._folded = [folded for folded, _ in pairs]
+            self._folded_keys = [key for _, key in pairs]
+        start, end = _prefix_range(self._folded, initial.lower())
+        return self._folded_keys[start:end]
+
+    def _match_fuzzy(self, initial):
+        """
+        Generate (rank..., candidate) tuples of the
+        candidates holding the characters of `initial`
+        """
+
+        if self._text is None:
+            self._text = u"\n".join(self.keys)
+        pattern = r"^[^\n]*?" + r"[^\n]*?".join(
+            "({})".format(re.escape(char)) for char in initial) + r"[^\n]*$"
+        last = len(initial)
+        for match in re.finditer(pattern, self._text, re.MULTILINE |
+                                 re.IGNORECASE):
+            first = match.start(1)
+            yield (first - match.start(), match.end(last) - first,
+                   match.end() - match.start(), match.group(0))
+
+class CompletionCache(object):
+    """
+    Completion indexes of recently completed
+    tables, valid for a single namespace version
+    """
+
+    # Maximal count of cached indexes
+    MAX_INDEXES = 64
+
+    def __init__(self):
+        self.version = None
+        self.indexes = OrderedDict()
+
+    def set_version(self, version):
+        """
+        Record the current namespace version of the
+        interpreter, dropping indexes of older versions
+
+        :param version: namespace version
+        :type version: int
+        """
+
+        if version != self.version:
+            self.indexes.clear()
+            self.version = version
+
+    def get(self, breadcrumbs, only_methods):
+        """
+        Get the cached index of a table
+
+        :param breadcrumbs: path to the table
+        :type breadcrumbs: list
+        :param only_methods: whether the index holds methods only
+        :type only_methods: bool
+        :return: cached index, or None
+        :rtype: CompletionIndex
+        """
+
+        key = (tuple(breadcrumbs), only_methods)
+        index = self.indexes.get(key)
+        if index is not None:
+            self.indexes.pop(key)
+            self.indexes[key] = index
+        return index
+
+    def put(self, breadcrumbs, only_methods, keys):
+        """
+        Index and cache the keys of a table
+
+        :param breadcrumbs: path to the table
+        :type breadcrumbs: list
+        :param only_methods: whether keys hold methods only
+        :type only_methods: bool
+        :param keys: table keys
+        :type keys: list
+        :return: new index
+        :rtype: CompletionIndex
+        """
+
+        index = CompletionIndex(keys)
+        self.indexes[(tuple(breadcrumbs), only_methods)] = index
+        while len(self.indexes) > self.MAX_INDEXES:
+            self.indexes.popitem(last=False)
+        return index
@@ -10,6 +10,8 @@ This module is in charge of parsing the
 kernel connection file as described in
 https://jupyter-client.readthedocs.io/en/stable/kernels.html#connection-files
 """
+import errno
+import itertools
 import json
 import os
 import os.path
@@ -33,17 +35,31 @@ class ConnectionFile(object):
         "key": "" # TODO: generate key?
     }
 
+    PORT_NAMES = ("shell_port", "control_port", "iopub_port", "stdin_port",
+                  "hb_port")
+
+    _written = itertools.count()
+
     def __init__(self, connection_props):
         self.connection_props = connection_props
+        # Path of the connection file once written
+        self.path = None
 
-        if not os.path.exists(jupyter_runtime_dir()):
-            os.mkdir(jupyter_runtime_dir(), 0o1700)
+        try:
+            os.makedirs(jupyter_runtime_dir(), 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
     
     @classmethod
     def generate(cls, partial_props=None):
         """
         Generate new connection file props from
         defaults
+
+        With the ipc transport, `ip` is the path prefix of the
+        sockets and ports are suffixes of their paths, those
+        that are not given are picked in the runtime dir
         
         :param partial_props: predefined properties, defaults to None
         :param partial_props: dict, optional
@@ -51,10 +67,30 @@ class ConnectionFile(object):
         :rtype: ilua.connection.ConnectionFile
         """
 
-        partial_props = partial_props or {}
-        props = partial_props.copy()
-        props.update(cls.DEFAULT_PROPERTIES)
+        props = cls.DEFAULT_PROPERTIES.copy()
+        props.update(partial_props or {})
+        if props["transport"] == "ipc":
+            if "ip" not in (partial_props or {}):
+                props["ip"] = os.path.join(jupyter_runtime_dir(),
+                                           "ilua-{}-ipc".format(os.getpid()))
+            taken = set(props[name] for name in cls.PORT_NAMES)
+            suffix = 1
+            for name in cls.PORT_NAMES:
+                if props[name]:
+                    continue
+                while suffix in taken or \
+                      os.path.exists(cls.ipc_path(props["ip"], suffix)):
+                    suffix += 1
+                props[name] = suffix
+                taken.add(suffix)
         return cls(props)
+
+    @staticmethod
+    def ipc_path(ip, port):
+        """
+        Path of an ipc socket, as Jupyter names them
+        """
+        return "{}-{}".format(ip, port)
     
     @classmethod
     def from_existing(cls, path):
@@ -66,10 +102,17 @@ class ConnectionFile(object):
         Write a new connection file to disk. and
         return its path
 
+        Files of further kernels of the process (see ilua.host)
+        are numbered after the first one
+
         :return: path to written connection file
         :rtype: string
         """
-        name = "kernel-{pid}.json".format(pid=os.getpid())
+        number = next(self._written)
+        if number:
+            name = "kernel-{}-{}.json".format(os.getpid(), number)
+        else:
+            name = "kernel-{pid}.json".format(pid=os.getpid())
         path = os.path.join(jupyter_runtime_dir(), name)
 
         # indentation, because why not.
@@ -78,4 +121,25 @@ class ConnectionFile(object):
         with open(path, "w") as connection_file:
             connection_file.write(connection_json)
         
+        self.path = path
         return path
+
+    def cleanup(self):
+        """
+        Remove the connection file if it was written, and
+        the ipc sockets it points to
+        """
+
+        paths = []
+        if self.path is not None:
+            paths.append(self.path)
+        if self.connection_props["transport"] == "ipc":
+            paths.extend(self.ipc_path(self.connection_props["ip"],
+                                       self.connection_props[name])
+                         for name in self.PORT_NAMES)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.path = None
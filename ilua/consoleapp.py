@@ -13,6 +13,7 @@ import os
 from jupyter_console.app import ZMQTerminalIPythonApp
 
 from .app import ILuaApp
+from .sockets import format_socket_option
 
 class ILuaConsoleApp(ILuaApp):
     def run(self):
@@ -23,18 +24,43 @@ class ILuaConsoleApp(ILuaApp):
 
         cli_args = vars(self.parser.parse_args())
 
-        os.environ.update({
-            self.env_var_prefix + key.upper(): cli_args[key]
-            for key in cli_args
-        })
+        os.environ.update(self._to_environ(cli_args))
+        # The kernel parses its arguments back from the environment,
+        # fail here rather than in a kernel the console waits for
+        kernel_args = vars(ILuaApp().parser.parse_args([]))
+        lost = sorted(key for key in cli_args
+                      if kernel_args.get(key) != cli_args[key])
+        if lost:
+            self.parser.error("Could not pass {} to the kernel".format(
+                ", ".join(lost)))
 
         # HACK: passing arguments to jupyter_console via command line
         #       because I have yet to figure out how to do it through
         #       IPython's fancy traitlets framework
         ZMQTerminalIPythonApp.launch_instance(argv=['--kernel', 'lua'])
 
+    def _to_environ(self, cli_args):
+        """
+        :param cli_args: parsed command line
+        :type cli_args: dict
+        :return: environment variables giving the kernel the
+                 same arguments, see AppBase._get_default
+        :rtype: dict
+        """
+
+        environ = {}
+        for key, value in cli_args.items():
+            if value is None or value == []:
+                continue
+            if key == "socket_options":
+                # Read back as whitespace separated settings
+                value = " ".join(format_socket_option(*setting)
+                                 for setting in value)
+            environ[self.env_var_prefix + key.upper()] = str(value)
+        return environ
+
 def main():
     ILuaConsoleApp().run()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
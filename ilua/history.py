@@ -10,26 +10,180 @@ from previous sessions, and making it available
 in the frontend
 """
 
-from twisted.internet import defer
+import hashlib
+import re
+import sqlite3
+import time
+
+from twisted.internet import defer, task
 from twisted.enterprise import adbapi
+from twisted.logger import Logger
+
+from .metrics import NullMetrics
 
 class HistoryManager(object):
     """
     SQLite DB manager capable of retreiving and appending
     history to a database on disk
+
+    Appended entries are buffered in memory and written
+    in batched transactions, either periodically, when
+    enough entries pile up, or when the manager is closed
+
+    Sources are stored once per distinct text, history
+    lines only reference them. Old sessions are dropped
+    by a periodic compaction according to the retention
+    limits, which also reclaims the freed disk space.
+    Sessions of running kernels, which keep marking them
+    as seen, are never dropped
     """
 
-    def __init__(self, history_path):
+    # Seconds between periodic flushes
+    FLUSH_INTERVAL = 1.0
+    # Number of buffered entries that triggers a flush
+    FLUSH_THRESHOLD = 64
+    # Seconds between compactions, the first one runs
+    # COMPACTION_DELAY seconds after connecting
+    COMPACTION_INTERVAL = 3600.0
+    COMPACTION_DELAY = 30.0
+    # Seconds between marking the session as seen, sessions
+    # not seen for SESSION_TIMEOUT seconds are over
+    HEARTBEAT_INTERVAL = 60.0
+    SESSION_TIMEOUT = 600.0
+    # Seconds to wait for other kernels holding the db lock
+    BUSY_TIMEOUT = 10
+    # Share of free pages that makes compaction VACUUM the db
+    VACUUM_THRESHOLD = 0.25
+
+    SCHEMA_VERSION = 2
+
+    _PRAGMAS = (
+        # Readers never block the writer, and commits append to the WAL
+        # instead of rewriting the main db file. WAL needs shared memory,
+        # so SQLite keeps the old journal where it is unavailable.
+        "PRAGMA journal_mode=WAL",
+        # Durable enough for history, and saves an fsync per commit
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+    )
+
+    log = Logger()
+
+    def __init__(self, history_path, flush_interval=FLUSH_INTERVAL,
+                 flush_threshold=FLUSH_THRESHOLD, max_sessions=0, max_age=0,
+                 max_bytes=0, compaction_interval=COMPACTION_INTERVAL,
+                 metrics=None, db=None, reactor=None):
         """
         :param history_path: Path to database (created if
                              does not exist)
         :type history_path: string
+        :param flush_interval: Seconds between periodic flushes
+                               of buffered entries
+        :type flush_interval: float, optional
+        :param flush_threshold: Number of buffered entries that
+                                triggers an immediate flush
+        :type flush_threshold: int, optional
+        :param max_sessions: Number of sessions to keep, 0 keeps
+                             all of them
+        :type max_sessions: int, optional
+        :param max_age: Drop sessions started more than `max_age`
+                        seconds ago, 0 keeps all of them
+        :type max_age: float, optional
+        :param max_bytes: Drop the oldest sessions once the stored
+                          sources exceed `max_bytes`, 0 for no limit
+        :type max_bytes: int, optional
+        :param compaction_interval: Seconds between compactions,
+                                    0 disables compaction
+        :type compaction_interval: float, optional
+        :param metrics: metrics registry to record write
+                        latencies in, defaults to none
+        :type metrics: ilua.metrics.Metrics, optional
+        :param db: connection pool of the database shared with
+                   other managers (see open_db), left open on
+                   close, defaults to a pool of its own
+        :type db: twisted.enterprise.adbapi.ConnectionPool, optional
+        :param reactor: Twisted reactor to use, defaults
+                        to the global one
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
         """
 
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.metrics = metrics or NullMetrics()
         self.history_path = history_path
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.compaction_interval = compaction_interval
+        self.db = db
+        self.shared_db = db is not None
         self.connected = False
+        self.closing = False
+        self.full_text = False
         self.session = None
-    
+
+        self.pending = []
+        self._flush_loop = task.LoopingCall(self.flush)
+        self._flush_loop.clock = self.reactor
+        self._compaction_loop = task.LoopingCall(self.compact)
+        self._compaction_loop.clock = self.reactor
+        self._compaction_call = None
+        self._heartbeat_loop = task.LoopingCall(self._heartbeat)
+        self._heartbeat_loop.clock = self.reactor
+        self.stats = {
+            'flushes': 0,
+            'flushed_entries': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+            'total_flush_latency': 0.0,
+            'compactions': 0,
+            'expired_sessions': 0,
+            'vacuums': 0,
+        }
+
+    @property
+    def queue_depth(self):
+        """
+        Number of entries waiting to be written
+        """
+        return len(self.pending)
+
+    @classmethod
+    def _setup_connection(cls, connection):
+        """
+        Tune every connection the pool opens
+        """
+        cursor = connection.cursor()
+        for pragma in cls._PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @classmethod
+    def open_db(cls, history_path, reactor=None):
+        """
+        Open a connection pool to the history database
+
+        :param history_path: Path to database (created if
+                             does not exist)
+        :type history_path: string
+        :return: the connection pool
+        :rtype: twisted.enterprise.adbapi.ConnectionPool
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        # A single connection serializes writes, which SQLite does
+        # anyway, and keeps flushes in the order they were issued
+        return adbapi.ConnectionPool("sqlite3", history_path,
+                                     timeout=cls.BUSY_TIMEOUT,
+                                     check_same_thread=False,
+                                     cp_min=1, cp_max=1,
+                                     cp_reactor=reactor,
+                                     cp_openfun=cls._setup_connection)
+
     @defer.inlineCallbacks
     def connect(self):
         """
@@ -39,49 +193,496 @@ class HistoryManager(object):
                  and initialized
         :rtype: twisted.internet.deferred.Deferred
         """
-        self.db = adbapi.ConnectionPool("sqlite3", self.history_path,
-                                        check_same_thread=False)
-        yield self.db.runOperation("""CREATE TABLE IF NOT EXISTS history (
-                                          session integer,
-                                          line integer,
-                                          source text,
-                                          PRIMARY KEY(session, line)
-                                      );
-                                   """)
-        
-        result = yield self.db.runQuery(r"SELECT max(session) FROM history")
-        self.session = result[0][0] + 1 if result[0][0] else 1
+        if self.db is None:
+            self.db = self.open_db(self.history_path, self.reactor)
+        yield self.db.runInteraction(self._migrate)
+        self.full_text = yield self.db.runInteraction(self._create_fts)
+        self.session = yield self.db.runInteraction(self._new_session)
 
         self.connected = True
-    
-    def tail(self, lines_back):
+        self._heartbeat_loop.start(self.HEARTBEAT_INTERVAL, now=False)
+        if self.flush_interval > 0:
+            self._flush_loop.start(self.flush_interval, now=False)
+        if self.compaction_interval > 0:
+            self._compaction_call = self.reactor.callLater(
+                self.COMPACTION_DELAY, self._compaction_loop.start,
+                self.compaction_interval)
+
+    def _migrate(self, txn):
+        """
+        Bring the db schema up to SCHEMA_VERSION
+
+        version 0: history(session, line, source)
+        version 1: sources are stored once in `sources`,
+                   sessions are allocated from `sessions`
+        version 2: sessions record when they were last seen
+                   and when they ended, `maintenance` records
+                   when compaction last ran
+        """
+        # Take the write lock up front, so kernels starting together
+        # don't migrate the same db twice
+        txn.execute("BEGIN IMMEDIATE")
+        txn.execute("PRAGMA user_version")
+        version = txn.fetchall()[0][0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        if version < 1:
+            self._migrate_v1(txn)
+        if version < 2:
+            txn.execute("ALTER TABLE sessions ADD COLUMN seen real")
+            txn.execute("ALTER TABLE sessions ADD COLUMN ended real")
+            txn.execute("""CREATE TABLE maintenance (
+                               task text PRIMARY KEY,
+                               last_run real
+                           )
+                        """)
+
+        txn.execute("PRAGMA user_version = {}".format(self.SCHEMA_VERSION))
+
+    def _migrate_v1(self, txn):
+        txn.execute("""SELECT 1 FROM sqlite_master
+                       WHERE type = 'table' AND name = 'history'""")
+        has_old_history = bool(txn.fetchall())
+        if has_old_history:
+            txn.execute("DROP TRIGGER IF EXISTS history_fts_insert")
+            txn.execute("DROP TRIGGER IF EXISTS history_fts_delete")
+            txn.execute("DROP TABLE IF EXISTS history_fts")
+            txn.execute("ALTER TABLE history RENAME TO history_v0")
+
+        txn.execute("""CREATE TABLE sessions (
+                           session integer PRIMARY KEY AUTOINCREMENT,
+                           started real
+                       )
+                    """)
+        txn.execute("""CREATE TABLE sources (
+                           id integer PRIMARY KEY,
+                           digest text UNIQUE,
+                           source text,
+                           size integer
+                       )
+                    """)
+        # The primary key doubles as the index for range queries, and is
+        # scanned backwards for tail queries
+        txn.execute("""CREATE TABLE history (
+                           session integer,
+                           line integer,
+                           source_id integer,
+                           PRIMARY KEY(session, line)
+                       )
+                    """)
+        # Covers deduplication and the search for orphaned sources
+        txn.execute("""CREATE INDEX history_source
+                       ON history(source_id, session, line)
+                    """)
+
+        if has_old_history:
+            txn.execute("""INSERT INTO sessions(session, started)
+                           SELECT DISTINCT session, ? FROM history_v0
+                        """, (time.time(),))
+            txn.execute("SELECT session, line, source FROM history_v0")
+            self._insert_entries(txn, txn.fetchall())
+            txn.execute("DROP TABLE history_v0")
+
+    @staticmethod
+    def _create_fts(txn):
+        """
+        Set up a trigram full-text index over history sources, which
+        SQLite uses to answer GLOB searches without a table scan
+
+        :return: whether the index is available, FTS5 or its trigram
+                 tokenizer (SQLite 3.34+) might be missing
+        :rtype: bool
+        """
+        # Like _migrate, kernels starting together must not both
+        # find the index missing
+        txn.execute("BEGIN IMMEDIATE")
+        txn.execute("""SELECT 1 FROM sqlite_master
+                       WHERE type = 'table' AND name = 'sources_fts'""")
+        if txn.fetchall():
+            return True
+        try:
+            txn.execute("""CREATE VIRTUAL TABLE sources_fts USING fts5(
+                               source,
+                               content='sources',
+                               content_rowid='id',
+                               tokenize='trigram'
+                           )
+                        """)
+        except sqlite3.OperationalError as err:
+            if "no such module" in str(err) or \
+               "no such tokenizer" in str(err):
+                return False
+            raise
+        txn.execute("""CREATE TRIGGER IF NOT EXISTS sources_fts_insert
+                       AFTER INSERT ON sources BEGIN
+                           INSERT INTO sources_fts(rowid, source)
+                           VALUES (new.id, new.source);
+                       END
+                    """)
+        txn.execute("""CREATE TRIGGER IF NOT EXISTS sources_fts_delete
+                       AFTER DELETE ON sources BEGIN
+                           INSERT INTO sources_fts(sources_fts, rowid, source)
+                           VALUES ('delete', old.id, old.source);
+                       END
+                    """)
+        # Index entries written before the index existed
+        txn.execute("INSERT INTO sources_fts(sources_fts) VALUES ('rebuild')")
+        return True
+
+    @staticmethod
+    def _new_session(txn):
+        """
+        Allocate a session number, a single insert no
+        matter how large the history is
+        """
+        now = time.time()
+        txn.execute("INSERT INTO sessions(started, seen) VALUES (?, ?)",
+                    (now, now))
+        return txn.lastrowid
+
+    def _heartbeat(self):
+        """
+        Mark the session as seen, so other kernels
+        compacting the db know it is still running
+        """
+        d = self.db.runOperation("UPDATE sessions SET seen = ? "
+                                 "WHERE session = ?",
+                                 (time.time(), self.session))
+        d.addErrback(lambda failure: self.log.failure(
+            "Failed to mark the history session as seen", failure))
+        return d
+
+    @defer.inlineCallbacks
+    def close(self):
+        """
+        Write any buffered entries and disconnect
+        from the history database
+
+        :return: a deferred firing when db is closed
+        :rtype: twisted.internet.deferred.Deferred
+        """
+        if not self.connected:
+            return
+        self.closing = True
+        if self._flush_loop.running:
+            self._flush_loop.stop()
+        if self._compaction_call and self._compaction_call.active():
+            self._compaction_call.cancel()
+        if self._compaction_loop.running:
+            self._compaction_loop.stop()
+        if self._heartbeat_loop.running:
+            self._heartbeat_loop.stop()
+        yield self.flush()
+        if self.pending:
+            self.log.error("Dropped {count} history entries that could not "
+                           "be written", count=len(self.pending))
+            self.pending = []
+        try:
+            yield self.db.runOperation("UPDATE sessions SET ended = ? "
+                                       "WHERE session = ?",
+                                       (time.time(), self.session))
+        except Exception:
+            # The session then ends once it is no longer seen
+            self.log.failure("Failed to end the history session")
+        if not self.shared_db:
+            self.db.close()
+            self.db = None
+        self.connected = False
+        self.closing = False
+
+    # Joins history lines with their sources, `{lines}` selects
+    # the wanted lines from `history`
+    _ENTRIES_QUERY = """SELECT h.session, h.line, s.source
+                        FROM ({lines}) AS h
+                        JOIN sources AS s ON s.id = h.source_id
+                        ORDER BY h.session {order}, h.line {order}
+                     """
+    # Keep the latest entry of every distinct source, bare columns of
+    # a max() aggregate come from the row holding the maximum
+    _UNIQUE_LINES = """SELECT session, line, source_id,
+                              max(session * 4294967296 + line) AS pos
+                       FROM history {where}
+                       GROUP BY source_id
+                       ORDER BY pos DESC {limit}
+                    """
+    _LATEST_LINES = """SELECT session, line, source_id
+                       FROM history {where}
+                       ORDER BY session DESC, line DESC {limit}
+                    """
+
+    @defer.inlineCallbacks
+    def tail(self, lines_back, unique=False):
         """
         Get last `lines_back` entries from history
         database
 
         :param lines_back: number of lines back to retreive
         :type lines_back: int
+        :param unique: skip repeated sources, keeping the
+                       latest occurrence
+        :type unique: bool, optional
+        :return: a deferred containing requested history,
+                 oldest entry first
+        :rtype: twisted.internet.deferred.Deferred
+        """
+        yield self.flush()
+        lines = self._UNIQUE_LINES if unique else self._LATEST_LINES
+        query = self._ENTRIES_QUERY.format(
+            lines=lines.format(where="", limit="LIMIT ?"), order="ASC")
+        result = yield self.db.runQuery(query, (lines_back,))
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def get_range(self, session=0, start=None, stop=None):
+        """
+        Get entries of a single session, from line `start`
+        up to (not including) line `stop`
+
+        :param session: session number, zero or negative numbers
+                        are relative to the current session
+        :type session: int, optional
+        :param start: first line to retreive, defaults to the
+                      first line in session
+        :type start: int, optional
+        :param stop: line to stop at, defaults to the end of
+                     the session
+        :type stop: int, optional
         :return: a deferred containing requested history
         :rtype: twisted.internet.deferred.Deferred
         """
-        return self.db.runQuery("""SELECT session, line, source FROM history
-                                   ORDER BY session, line
-                                   LIMIT ?
-                                """, (lines_back,))
-    
+        yield self.flush()
+        if not session or session < 0:
+            session = self.session + (session or 0)
+        if stop is None:
+            # sqlite integers are signed 64 bit
+            stop = 2 ** 63 - 1
+        lines = """SELECT session, line, source_id FROM history
+                   WHERE session = ? AND line >= ? AND line < ?
+                """
+        query = self._ENTRIES_QUERY.format(lines=lines, order="ASC")
+        result = yield self.db.runQuery(query, (session, start or 0, stop))
+        defer.returnValue(result)
+
     @defer.inlineCallbacks
+    def search(self, pattern="*", lines_back=None, unique=False):
+        """
+        Get entries whose source matches a glob pattern
+
+        :param pattern: glob pattern, as in SQLite's GLOB
+        :type pattern: string, optional
+        :param lines_back: only retreive the last `lines_back`
+                           matches, defaults to all matches
+        :type lines_back: int, optional
+        :param unique: skip repeated sources, keeping the
+                       latest occurrence
+        :type unique: bool, optional
+        :return: a deferred containing requested history,
+                 oldest entry first
+        :rtype: twisted.internet.deferred.Deferred
+        """
+        yield self.flush()
+        pattern = pattern or "*"
+        # Trigrams only narrow down the search if the pattern has at
+        # least three literal characters in a row
+        if self.full_text and re.search(r"[^*?\[\]]{3}", pattern):
+            where = """WHERE source_id IN (SELECT rowid FROM sources_fts
+                                           WHERE source GLOB ?)"""
+        else:
+            where = """WHERE source_id IN (SELECT id FROM sources
+                                           WHERE source GLOB ?)"""
+        limit = "LIMIT ?" if lines_back else ""
+        args = (pattern, lines_back) if lines_back else (pattern,)
+        lines = self._UNIQUE_LINES if unique else self._LATEST_LINES
+        query = self._ENTRIES_QUERY.format(
+            lines=lines.format(where=where, limit=limit), order="ASC")
+        result = yield self.db.runQuery(query, args)
+        defer.returnValue(result)
+
     def append(self, source, line):
         """
-        Append entry `source` at line `line`
+        Queue entry `source` at line `line` for writing
         line should be the execution count
 
         :param source: evaluated code to save
         :type source: string
         :param line: code line (source's execution count
         :type line: int
-        :return: a deferred firing when insertion is done
+        """
+        self.pending.append((self.session, line, source))
+        if len(self.pending) >= self.flush_threshold:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered entries in a single transaction
+
+        :return: a deferred firing when the entries are written
+        :rtype: twisted.internet.deferred.Deferred
+        """
+        if not self.pending:
+            return defer.succeed(None)
+
+        entries, self.pending = self.pending, []
+        started = time.time()
+        d = self.db.runInteraction(self._insert_entries, entries)
+        d.addCallbacks(self._flushed, self._flush_failed,
+                       callbackArgs=(entries, started),
+                       errbackArgs=(entries,))
+        return d
+
+    @staticmethod
+    def _insert_entries(txn, entries):
+        sources = {}
+        lines = []
+        for session, line, source in entries:
+            data = source.encode("utf8")
+            digest = hashlib.sha1(data).hexdigest()
+            sources[digest] = (digest, source, len(data))
+            lines.append((session, line, digest))
+        txn.executemany("""INSERT OR IGNORE INTO sources(digest, source, size)
+                           VALUES (?,?,?)
+                        """, sources.values())
+        txn.executemany("""INSERT OR IGNORE INTO history
+                           SELECT ?, ?, id FROM sources WHERE digest = ?
+                        """, lines)
+
+    def _flushed(self, _, entries, started):
+        latency = time.time() - started
+        self.stats['flushes'] += 1
+        self.stats['flushed_entries'] += len(entries)
+        self.stats['last_flush_latency'] = latency
+        self.stats['total_flush_latency'] += latency
+        self.stats['max_flush_latency'] = max(latency,
+                                              self.stats['max_flush_latency'])
+        self.metrics.observe("history_write_seconds", latency)
+        self.log.debug("Flushed {count} history entries in {latency:.3f}s",
+                       count=len(entries), latency=latency)
+
+    def _flush_failed(self, failure, entries):
+        if self.closing:
+            # close() reports the entries as dropped
+            self.log.failure("Failed to write history", failure)
+        else:
+            self.log.failure("Failed to write history, will retry", failure)
+        # Put the entries back in front, so the next flush retries them
+        self.pending[:0] = entries
+
+    def compact(self):
+        """
+        Drop sessions past the retention limits and
+        reclaim free space. Runs on the db thread.
+
+        :return: a deferred firing when compaction is done
         :rtype: twisted.internet.deferred.Deferred
         """
-        yield self.db.runOperation("""INSERT INTO history
-                                      VALUES (?,?,?)
-                                   """, (self.session, line, source))
+        d = self.db.runWithConnection(self._compact)
+        d.addCallbacks(self._compacted, self._compaction_failed)
+        return d
+
+    def _expired_session(self, cursor):
+        """
+        Find the newest session past any retention limit,
+        retention always drops whole sessions oldest first,
+        skipping sessions that are still running
+
+        :return: newest session to drop, or None
+        :rtype: int
+        """
+        expired = []
+        if self.max_sessions > 0:
+            cursor.execute("""SELECT session FROM sessions
+                              ORDER BY session DESC
+                              LIMIT 1 OFFSET ?
+                           """, (self.max_sessions,))
+            expired.extend(row[0] for row in cursor.fetchall())
+        if self.max_age > 0:
+            cursor.execute("SELECT max(session) FROM sessions WHERE started < ?",
+                           (time.time() - self.max_age,))
+            expired.extend(row[0] for row in cursor.fetchall())
+        if self.max_bytes > 0:
+            cursor.execute("""SELECT h.session, sum(s.size)
+                              FROM history AS h
+                              JOIN sources AS s ON s.id = h.source_id
+                              GROUP BY h.session
+                              ORDER BY h.session DESC
+                           """)
+            total = 0
+            for session, size in cursor.fetchall():
+                total += size
+                if total > self.max_bytes:
+                    expired.append(session)
+                    break
+
+        expired = [session for session in expired if session is not None]
+        if not expired:
+            return None
+        return max(expired)
+
+    def _compact(self, connection):
+        cursor = connection.cursor()
+        now = time.time()
+        # Kernels sharing the db, in other processes or in the same
+        # host, take turns: whoever finds it was not compacted for
+        # half an interval does it
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("""SELECT last_run FROM maintenance
+                          WHERE task = 'compaction'
+                       """)
+        last_run = cursor.fetchall()
+        if last_run and last_run[0][0] > now - self.compaction_interval / 2:
+            connection.rollback()
+            cursor.close()
+            return None
+        cursor.execute("""INSERT OR REPLACE INTO maintenance(task, last_run)
+                          VALUES ('compaction', ?)
+                       """, (now,))
+
+        expired = self._expired_session(cursor)
+        dropped = 0
+        if expired is not None:
+            # Sessions of running kernels stay, ours included
+            cursor.execute("""SELECT session FROM sessions
+                              WHERE session <= ? AND session != ? AND
+                                    (ended IS NOT NULL OR seen IS NULL OR
+                                     seen < ?)
+                           """, (expired, self.session,
+                                 now - self.SESSION_TIMEOUT))
+            sessions = cursor.fetchall()
+            dropped = len(sessions)
+            cursor.executemany("DELETE FROM sessions WHERE session = ?",
+                               sessions)
+            cursor.executemany("DELETE FROM history WHERE session = ?",
+                               sessions)
+            cursor.execute("""DELETE FROM sources WHERE id NOT IN (
+                                  SELECT source_id FROM history
+                              )
+                           """)
+        connection.commit()
+
+        cursor.execute("PRAGMA freelist_count")
+        free_pages = cursor.fetchall()[0][0]
+        cursor.execute("PRAGMA page_count")
+        pages = cursor.fetchall()[0][0]
+        vacuumed = bool(pages) and free_pages > pages * self.VACUUM_THRESHOLD
+        if vacuumed:
+            cursor.execute("VACUUM")
+            # In WAL mode the shrunk db only reaches the main file
+            # once checkpointed
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        cursor.close()
+        return dropped, vacuumed
+
+    def _compacted(self, result):
+        if result is None:
+            self.log.debug("History was compacted recently, skipping")
+            return
+        dropped, vacuumed = result
+        self.stats['compactions'] += 1
+        self.stats['expired_sessions'] += dropped
+        self.stats['vacuums'] += int(vacuumed)
+        self.log.debug("History compaction dropped {dropped} sessions "
+                       "(vacuumed: {vacuumed})", dropped=dropped,
+                       vacuumed=vacuumed)
+
+    def _compaction_failed(self, failure):
+        self.log.failure("History compaction failed", failure)
@@ -0,0 +1,378 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Runs many kernels in one process, on one reactor
+
+Each kernel keeps its own connection file, sockets and
+Lua interpreter, while the Python side of things (txzmq,
+Pygments, the history db pool, offloading threads) is
+shared. Kernels are started and stopped through a local
+control socket, speaking JSON lines:
+
+    {"command": "start", "connection_file": PATH, "attach": true}
+    {"command": "stop", "kernel_id": ID}
+    {"command": "interrupt", "kernel_id": ID}
+    {"command": "list"}
+    {"command": "shutdown"}
+
+Replies carry the "id" of their request, if it had one. Kernels
+started with "attach" are stopped once the connection that
+started them closes, and a {"event": "stopped"} line is sent
+when they stop. ilua.launcher does just that, so a kernelspec
+can use it to run its kernels in a host
+"""
+
+import json
+import os
+import socket
+import uuid
+
+from twisted.internet import defer, protocol, task
+from twisted.logger import Logger
+from twisted.protocols import basic
+from twisted.python import failure
+
+from .app import ILuaApp
+from .connection import ConnectionFile
+from .launcher import DEFAULT_CONTROL_PATH
+
+class HostedKernel(object):
+    """
+    A kernel running in a host
+    """
+
+    def __init__(self, kernel_id, kernel, connection_file, generated):
+        """
+        :param kernel_id: id of the kernel in the host
+        :type kernel_id: string
+        :param kernel: the kernel
+        :type kernel: ilua.kernelbase.KernelBase
+        :param connection_file: connection file of the kernel
+        :type connection_file: ilua.connection.ConnectionFile
+        :param generated: whether the host generated the connection
+                          file, and so removes it when the kernel stops
+        :type generated: bool
+        """
+
+        self.kernel_id = kernel_id
+        self.kernel = kernel
+        self.connection_file = connection_file
+        self.generated = generated
+        self.stopped = False
+        self._waiters = []
+
+    def wait(self):
+        """
+        :return: deferred firing once the kernel stopped
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if self.stopped:
+            return defer.succeed(None)
+        waiter = defer.Deferred()
+        self._waiters.append(waiter)
+        return waiter
+
+    def describe(self):
+        return {
+            'kernel_id': self.kernel_id,
+            'connection_file': self.connection_file.path
+        }
+
+    def _stopped(self):
+        self.stopped = True
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+class KernelHost(object):
+    """
+    Starts and stops kernels sharing a process
+    """
+
+    log = Logger()
+
+    def __init__(self, kernel_cls, kernel_kwargs, transport="tcp",
+                 reactor=None):
+        """
+        :param kernel_cls: kernel class to instantiate
+        :type kernel_cls: ilua.kernelbase.KernelBase
+        :param kernel_kwargs: kwargs passed to kernel_cls
+        :type kernel_kwargs: dict
+        :param transport: ZeroMQ transport of generated connection files
+        :type transport: string
+        :param reactor: Twisted reactor to use, defaults
+                        to the global reactor
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.kernel_cls = kernel_cls
+        self.kernel_kwargs = dict(kernel_kwargs)
+        self.kernel_kwargs.update(kernel_cls.shared_resources(kernel_kwargs,
+                                                              reactor))
+        self.transport = transport
+        # kernel id mapped to HostedKernel
+        self.kernels = {}
+        self.shutting_down = False
+        self.stopped = defer.Deferred()
+
+    def start(self, connection_file=None):
+        """
+        Start a kernel
+
+        :param connection_file: path of the connection file to bind
+                                by, one is generated if None
+        :type connection_file: string
+        :return: the started kernel
+        :rtype: HostedKernel
+        """
+
+        if self.shutting_down:
+            raise RuntimeError("The host is shutting down")
+        if connection_file:
+            connection = ConnectionFile.from_existing(connection_file)
+            connection.path = connection_file
+        else:
+            connection = ConnectionFile.generate({
+                "transport": self.transport})
+        kernel = self.kernel_cls(connection.connection_props,
+                                 reactor=self.reactor, **self.kernel_kwargs)
+        if not connection_file:
+            ILuaApp._fix_ports(connection.connection_props, kernel)
+            connection.write_file()
+
+        hosted = HostedKernel(str(uuid.uuid4()), kernel, connection,
+                              not connection_file)
+        self.kernels[hosted.kernel_id] = hosted
+        kernel.run().addBoth(self._kernel_stopped, hosted)
+        self.log.info("Started kernel {kernel_id} ({path}), {count} running",
+                      kernel_id=hosted.kernel_id, path=connection.path,
+                      count=len(self.kernels))
+        return hosted
+
+    def stop(self, kernel_id):
+        """
+        Stop a kernel
+
+        :param kernel_id: id of the kernel
+        :type kernel_id: string
+        :return: deferred firing once the kernel stopped
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        hosted = self._get(kernel_id)
+        hosted.kernel.signal_stop()
+        return hosted.wait()
+
+    def interrupt(self, kernel_id):
+        return defer.maybeDeferred(self._get(kernel_id).kernel.do_interrupt)
+
+    @defer.inlineCallbacks
+    def shutdown(self):
+        """
+        Stop all kernels, and then the host
+        """
+
+        if self.shutting_down:
+            yield self.stopped
+            return
+        self.shutting_down = True
+        yield defer.DeferredList([self.stop(kernel_id)
+                                  for kernel_id in list(self.kernels)])
+        self.stopped.callback(None)
+
+    def _get(self, kernel_id):
+        try:
+            return self.kernels[kernel_id]
+        except KeyError:
+            raise LookupError("No kernel {}".format(kernel_id))
+
+    def _kernel_stopped(self, result, hosted):
+        del self.kernels[hosted.kernel_id]
+        if hosted.generated:
+            hosted.connection_file.cleanup()
+        if isinstance(result, failure.Failure):
+            self.log.failure("Kernel {kernel_id} failed", result,
+                             kernel_id=hosted.kernel_id)
+        else:
+            self.log.info("Kernel {kernel_id} stopped, {count} running",
+                          kernel_id=hosted.kernel_id, count=len(self.kernels))
+        hosted._stopped()
+
+class ControlProtocol(basic.LineReceiver):
+    """
+    Control connection of a KernelHost
+    """
+
+    delimiter = b"\n"
+
+    log = Logger()
+
+    def __init__(self, host):
+        self.host = host
+        # Kernels to stop when the connection closes
+        self.attached = set()
+        self.closed = defer.Deferred()
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line.decode("utf8"))
+            handler = getattr(self, "do_" + request["command"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._send({'status': 'error',
+                        'error': "Bad request {!r}".format(line)})
+            return
+        result = defer.maybeDeferred(handler, request)
+        result.addCallbacks(
+            lambda reply: dict(reply or {}, status='ok'),
+            lambda reason: {'status': 'error',
+                            'error': reason.getErrorMessage()})
+        if "id" in request:
+            result.addCallback(lambda reply: dict(reply, id=request["id"]))
+        result.addCallback(self._send)
+
+    def do_start(self, request):
+        hosted = self.host.start(request.get("connection_file"))
+        if request.get("attach"):
+            self.attached.add(hosted.kernel_id)
+            hosted.wait().addCallback(self._attached_stopped, hosted)
+        return hosted.describe()
+
+    @defer.inlineCallbacks
+    def do_stop(self, request):
+        yield self.host.stop(request["kernel_id"])
+
+    @defer.inlineCallbacks
+    def do_interrupt(self, request):
+        yield self.host.interrupt(request["kernel_id"])
+
+    def do_list(self, request):
+        return {'kernels': [hosted.describe()
+                            for hosted in self.host.kernels.values()]}
+
+    def do_shutdown(self, request):
+        self.host.shutdown()
+
+    def connectionLost(self, reason):
+        # Kernels may stop right away, leaving self.attached on the way
+        attached, self.attached = self.attached, set()
+        for kernel_id in attached:
+            if kernel_id in self.host.kernels:
+                self.host.stop(kernel_id)
+        self.closed.callback(None)
+
+    def _attached_stopped(self, _, hosted):
+        if hosted.kernel_id in self.attached:
+            self.attached.discard(hosted.kernel_id)
+            self._send({'event': 'stopped', 'kernel_id': hosted.kernel_id})
+
+    def _send(self, message):
+        if self.transport.connected:
+            self.sendLine(json.dumps(message).encode("utf8"))
+
+class ControlFactory(protocol.Factory):
+    def __init__(self, host):
+        self.host = host
+        self.connections = set()
+
+    def buildProtocol(self, addr):
+        connection = ControlProtocol(self.host)
+        self.connections.add(connection)
+        connection.closed.addCallback(
+            lambda _: self.connections.discard(connection))
+        return connection
+
+    def close(self):
+        """
+        Close the control connections, once they sent
+        what they have to send
+
+        :return: deferred firing once they are closed
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        closing = [connection.closed for connection in self.connections]
+        for connection in list(self.connections):
+            connection.transport.loseConnection()
+        return defer.DeferredList(closing)
+
+class HostApp(ILuaApp):
+    """
+    Runs a KernelHost, the kernel command-line
+    arguments apply to all of its kernels
+    """
+
+    # Per-kernel endpoints and files, which kernels
+    # sharing a process can't share
+    UNSUPPORTED = ("metrics_port", "metrics_file", "trace_file")
+
+    def __init__(self, *args, **kwargs):
+        super(HostApp, self).__init__(*args, **kwargs)
+        self.parser.prog = "python -m ilua.host"
+        self.parser.description = "Run many ILua kernels in one process, " \
+                                  "see ilua.launcher to run one in a host"
+        self.parser.add_argument('--control', metavar="PATH",
+                                 default=self._get_default(
+                                     'HOST_CONTROL', DEFAULT_CONTROL_PATH),
+                                 help="Path of the control socket")
+
+    def run(self):
+        """
+        Run the host until it is shut down
+        """
+
+        self.parser.add_argument('--transport', choices=("tcp", "ipc"),
+                                 default=self._get_default('TRANSPORT',
+                                                           'tcp'),
+                                 help="ZeroMQ transport of generated "
+                                      "connection files, ipc uses Unix "
+                                      "domain sockets in the runtime dir")
+        cli_args = vars(self.parser.parse_args())
+        for name in self.UNSUPPORTED:
+            if cli_args.pop(name, None):
+                self.parser.error("--{} is not supported by the host".format(
+                    name.replace("_", "-")))
+        if not hasattr(socket, "AF_UNIX"):
+            self.parser.error("The host needs Unix domain sockets")
+        self._begin_logging(cli_args.pop("log_level"))
+        control_path = cli_args.pop("control")
+        transport = cli_args.pop("transport")
+        self.extra_kernel_kwargs.update(cli_args)
+
+        def serve(reactor):
+            self.host = KernelHost(self.kernel_cls, self.extra_kernel_kwargs,
+                                   transport, reactor=reactor)
+            if os.path.exists(control_path):
+                # Left behind by a host that died
+                os.remove(control_path)
+            factory = ControlFactory(self.host)
+            port = reactor.listenUNIX(control_path, factory, mode=0o600)
+
+            @defer.inlineCallbacks
+            def stop():
+                yield self.host.shutdown()
+                # Attached launchers get to hear their kernel stopped
+                yield factory.close()
+                yield port.stopListening()
+                if os.path.exists(control_path):
+                    os.remove(control_path)
+
+            reactor.addSystemEventTrigger("before", "shutdown", stop)
+            print("Hosting kernels, control socket: {}".format(control_path))
+            return self.host.stopped
+
+        return task.react(serve)
+
+def main():
+    HostApp().run()
+
+if __name__ == '__main__':
+    main()
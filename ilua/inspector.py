@@ -9,25 +9,257 @@ A collection of lexer-involved routines
 for lua code parsing
 """
 
-from itertools import islice, takewhile
+import os
+import re
+from bisect import bisect_left
+from collections import OrderedDict
 from pygments import token, highlight
 from pygments.lexers import _lua_builtins
 from pygments.lexers.scripting import LuaLexer
 from pygments.formatters.terminal import TerminalFormatter
 
+from .scope import CellScopes
+
+LUA_KEYWORDS = frozenset([
+    "and", "break", "do", "else", "elseif", "end", "false", "for",
+    "function", "goto", "if", "in", "local", "nil", "not", "or", "repeat",
+    "return", "then", "true", "until", "while"
+])
+
+# Everything that switches from code to a string or a comment
+_SPAN_START = re.compile(r"""--\[(=*)\[|--|\[(=*)\[|["']""")
+_SHORT_STRING_END = {
+    '"': re.compile(r'(?:[^"\\\n]|\\[\s\S])*(?:"|\n|$)'),
+    "'": re.compile(r"(?:[^'\\\n]|\\[\s\S])*(?:'|\n|$)")
+}
+
+# `require "name"` or `require("name")`
+_REQUIRE_CALL = (r"""\brequire\s*(?:"([\w.-]+)"|'([\w.-]+)'|"""
+                 r"""\(\s*(?:"([\w.-]+)"|'([\w.-]+)')\s*\))""")
+_REQUIRE_CALL_END = re.compile(_REQUIRE_CALL + "$")
+_REQUIRE_ALIAS = re.compile(r"\b([A-Za-z_]\w*)\s*=\s*" + _REQUIRE_CALL[2:])
+_REQUIRE_STRING_END = re.compile(r"""\brequire\s*\(?\s*["']([\w.-]*)$""")
+# How far back from the cursor to look for a require call
+REQUIRE_LOOKBEHIND = 256
+
+def required_module(obj):
+    """
+    Get the module name out of a `require "name"` object,
+    as returned by Inspector.get_last_obj
+
+    :param obj: object text
+    :type obj: string
+    :return: module name, or None if obj is not a require call
+    :rtype: string
+    """
+
+    match = _REQUIRE_CALL_END.match(obj)
+    if not match:
+        return None
+    return _first_group(match)
+
+def _first_group(match, start=1):
+    return next(group for group in match.groups()[start - 1:] if group)
+
+class CodeScanner(object):
+    """
+    Tells code apart from strings and comments, without
+    running a full lexer
+
+    Spots where the scan is back in code are kept as
+    checkpoints, so scanning an edited version of the
+    last scanned text resumes from the last checkpoint
+    before the first edit
+    """
+
+    # Minimal distance between checkpoints
+    CHECKPOINT_INTERVAL = 2048
+
+    def __init__(self):
+        self.text = ""
+        self.checkpoints = [0]
+
+    def in_code(self, text, pos):
+        """
+        Check whether `pos` in `text` is in code, rather
+        than in a string or a comment
+
+        :param text: lua source
+        :type text: string
+        :param pos: position in text
+        :type pos: int
+        :return: True if pos is in code
+        :rtype: bool
+        """
+
+        checkpoints = self._valid_checkpoints(text, pos)
+        self.text, self.checkpoints = text, checkpoints
+
+        scan_pos = checkpoints[-1]
+        while True:
+            match = _SPAN_START.search(text, scan_pos, pos)
+            if not match:
+                return True
+            scan_pos = self._span_end(text, match)
+            if scan_pos > pos:
+                return False
+            if scan_pos - checkpoints[-1] >= self.CHECKPOINT_INTERVAL:
+                checkpoints.append(scan_pos)
+
+    def _valid_checkpoints(self, text, pos):
+        """
+        Get the checkpoints of the last scan that are still
+        valid for `text`, up to `pos`
+        """
+        valid = 1
+        last = 0
+        for checkpoint in self.checkpoints[1:]:
+            if checkpoint > pos or text[last:checkpoint] != \
+                                   self.text[last:checkpoint]:
+                break
+            last = checkpoint
+            valid += 1
+        return self.checkpoints[:valid]
+
+    @staticmethod
+    def _span_end(text, match):
+        """
+        Get the position right after a string or a comment,
+        positions of unterminated spans are past the text
+        """
+        opener = match.group(0)
+        if opener in "\"'":
+            end = _SHORT_STRING_END[opener].match(text, match.end()).end()
+            # the match of a string broken by a newline already ends
+            # after it, one cut by the end of text still owns the end
+            return end if text[end - 1:end] in (opener, "\n") else end + 1
+        if opener == "--":
+            end = text.find("\n", match.end())
+            return end + 1 if end != -1 else len(text) + 1
+        level = match.group(1) if match.group(1) is not None \
+                else match.group(2)
+        closer = "]" + level + "]"
+        end = text.find(closer, match.end())
+        return end + len(closer) if end != -1 else len(text) + 1
+
+class SourceIndex(object):
+    """
+    A source file lexed once, with everything needed to
+    answer repeated doc and source lookups on it
+    """
+    def __init__(self, path, lexer):
+        """
+        :param path: path to source file
+        :type path: string
+        :param lexer: lexer to tokenize the source with
+        :type lexer: pygments.lexer.Lexer
+        """
+
+        self.signature = self.stat(path)
+        with open(path) as source:
+            self.text = source.read()
+        self.line_offsets = [0] + [m.end() for m in
+                                   re.finditer("\n", self.text)]
+        self.tokens = list(lexer.get_tokens_unprocessed(self.text))
+        self.token_offsets = [t[0] for t in self.tokens]
+        # line -> doc comment, (start_line, end_line) -> highlighted source
+        self.docs = {}
+        self.highlighted = {}
+
+    @staticmethod
+    def stat(path):
+        """
+        Get the file attributes that invalidate an index
+        """
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def line_offset(self, line):
+        """
+        Offset of the start of a (1-based) line in text
+        """
+        if line - 1 < len(self.line_offsets):
+            return self.line_offsets[line - 1]
+        return len(self.text)
+
+    def get_doc(self, line):
+        """
+        Get the comment block right above `line`
+        """
+        if line not in self.docs:
+            offset = self.line_offset(line)
+            end = bisect_left(self.token_offsets, offset)
+            doc_parts = []
+            for i in range(end - 1, -1, -1):
+                start, ttype, value = self.tokens[i]
+                # Whitespace also carries the indentation of `line`
+                value = value[:offset - start]
+                if ttype.parent != token.Comment and value != "\n":
+                    break
+                doc_parts.append(value)
+            self.docs[line] = "".join(doc_parts[::-1])
+        return self.docs[line]
+
+    def get_lines(self, start_line, end_line):
+        """
+        Get source text from `start_line` to `end_line`
+        """
+        return self.text[self.line_offset(start_line):
+                         self.line_offset(end_line + 1)]
+
 class Inspector(object):
     """
     Lua lexical inspection services
     """
-    def __init__(self):
-        self.lexer = LuaLexer(disabled_modules=list(_lua_builtins.MODULES))
-        self.formatter = TerminalFormatter()
+
+    # Number of source files kept lexed
+    MAX_INDEXES = 32
+
+    def __init__(self, shared=None):
+        """
+        :param shared: inspector to share the lexer and the lexed
+                       source files of, cell scopes are never shared
+        :type shared: Inspector, optional
+        """
+
+        if shared is None:
+            self.lexer = LuaLexer(disabled_modules=list(_lua_builtins.MODULES))
+            self.formatter = TerminalFormatter()
+            self.indexes = OrderedDict()
+        else:
+            self.lexer = shared.lexer
+            self.formatter = shared.formatter
+            self.indexes = shared.indexes
+        self.scanner = CodeScanner()
+        self.cell_scopes = CellScopes(self.lexer)
+
+    def get_index(self, path):
+        """
+        Get the lexed index of a source file, lexing it only if
+        it is not cached or changed since it was lexed
+
+        :param path: path to source file
+        :type path: string
+        :return: index of the source file
+        :rtype: ilua.inspector.SourceIndex
+        """
+
+        index = self.indexes.pop(path, None)
+        if index is None or index.signature != SourceIndex.stat(path):
+            index = SourceIndex(path, self.lexer)
+        # (Re)insert as the most recently used
+        self.indexes[path] = index
+        while len(self.indexes) > self.MAX_INDEXES:
+            self.indexes.popitem(last=False)
+        return index
     
     def get_last_obj(self, code, cursor_pos):
         """
         Get the object under the cursor and break it to
         `breadcrumbs`
         i.e: break `assert(io.stdin:write|` to ['io','stdin','write']
+        A require call heading the chain is kept as a single object,
+        i.e: `require"a".b|` breaks to ['require"a"', '.', 'b']
         
         :param code: code to inspect
         :type code: string
@@ -37,34 +269,104 @@ class Inspector(object):
         :rtype: list
         """
 
-        all_tokens = list(self.lexer.get_tokens_unprocessed(code[:cursor_pos]))
+        # Only look as far back as the expression goes, the scanner
+        # just has to tell if the cursor is in a string or a comment
+        if not self.scanner.in_code(code, cursor_pos):
+            return []
 
-        unordered_tokens = takewhile(lambda x: x[1] == token.Name or
-                                               x[2] in '.:',
-                                               all_tokens[::-1])
-        unordered_tokens = list(unordered_tokens)
-        
         last_obj = []
-        if not unordered_tokens:
-            return last_obj
-        
-        now_name = token.Name == unordered_tokens[0][1]
-        for i, t in enumerate(unordered_tokens):
-            if now_name and t[1] == token.Name:
-                last_obj.insert(0, t[2])
-            elif not now_name and i < 2 and t[2] == ":":
-                last_obj.insert(0, t[2])
-            elif not now_name and  t[2] == ".":
-                last_obj.insert(0, t[2])
+        pos = cursor_pos
+        while True:
+            start = pos
+            while start > 0 and (code[start - 1].isalnum() or
+                                 code[start - 1] == "_"):
+                start -= 1
+            name = code[start:pos]
+            if name[:1].isdigit() or name in LUA_KEYWORDS:
+                break
+            if name:
+                last_obj.insert(0, name)
+            elif last_obj:
+                break
+            pos = start
+
+            # ':' may only separate the last name, '..' is not a
+            # separator at all
+            separator = code[pos - 1:pos]
+            if separator == "." and code[pos - 2:pos - 1] != ".":
+                pass
+            elif separator == ":" and len(last_obj) <= 1 and \
+                 code[pos - 2:pos - 1] != ":":
+                pass
             else:
                 break
-            now_name = not now_name
-        
+            last_obj.insert(0, separator)
+            pos -= 1
+
         if last_obj and last_obj[0] in ".:":
-            last_obj.pop(0)
-        
+            # Chain starts with a call, an index or a literal, which
+            # we can't follow, unless it is the module of a require
+            require_call = _REQUIRE_CALL_END.search(
+                code, max(0, pos - REQUIRE_LOOKBEHIND), pos)
+            if last_obj[0] != "." or not require_call:
+                return []
+            last_obj.insert(0, require_call.group(0))
+
         return last_obj
-    
+
+    def get_require_prefix(self, code, cursor_pos):
+        """
+        Get the partial module name under the cursor,
+        if it is inside the string of a require call
+        i.e: get 'socket.h' out of `require"socket.h|`
+
+        :param code: code to inspect
+        :type code: string
+        :param cursor_pos: cursor position in code
+        :type cursor_pos: int
+        :return: partial module name, or None
+        :rtype: string
+        """
+
+        match = _REQUIRE_STRING_END.search(
+            code, max(0, cursor_pos - REQUIRE_LOOKBEHIND), cursor_pos)
+        if not match or not self.scanner.in_code(code, match.start()):
+            return None
+        return match.group(1)
+
+    def get_visible_names(self, code, cursor_pos):
+        """
+        Get the names the code before the cursor makes
+        visible at the cursor: locals of the enclosing
+        scopes, and the globals it defines
+
+        :param code: code to inspect
+        :type code: string
+        :param cursor_pos: cursor position in code
+        :type cursor_pos: int
+        :return: local names (innermost first), and global names
+        :rtype: tuple
+        """
+
+        if not self.scanner.in_code(code, cursor_pos):
+            return [], []
+        return self.cell_scopes.visible_names(code[:cursor_pos])
+
+    @staticmethod
+    def get_module_aliases(code):
+        """
+        Get the names `code` assigns required modules to
+        i.e: map 'json' to 'ext.json' for `local json = require"ext.json"`
+
+        :param code: code to inspect
+        :type code: string
+        :return: names mapped to module names
+        :rtype: dict
+        """
+
+        return dict((match.group(1), _first_group(match, 2))
+                    for match in _REQUIRE_ALIAS.finditer(code))
+
     def get_doc(self, path, line):
         """
         Get doc string from lines above given line in
@@ -79,12 +381,7 @@ class Inspector(object):
         :rtype: string
         """
 
-        with open(path) as source:
-            tokens = list(self.lexer.get_tokens_unprocessed("".join(islice(
-                        source, line-1))))[::-1]
-            doc_tokens = takewhile(lambda t: t[1].parent == token.Comment or
-                                             t[2] == "\n" , tokens)
-            return "".join([t[2] for t in list(doc_tokens)[::-1]])
+        return self.get_index(path).get_doc(line)
     
     def get_source(self, path, start_line, end_line):
         """
@@ -101,6 +398,10 @@ class Inspector(object):
         :rtype: string
         """
 
-        with open(path) as source:
-            return highlight("".join(islice(source, start_line-1, end_line)),
-                             self.lexer, self.formatter)
\ No newline at end of file
+        index = self.get_index(path)
+        key = (start_line, end_line)
+        if key not in index.highlighted:
+            index.highlighted[key] = highlight(
+                index.get_lines(start_line, end_line), self.lexer,
+                self.formatter)
+        return index.highlighted[key]
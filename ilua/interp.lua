@@ -7,11 +7,188 @@
 
 local cmd_pipe_path = assert(os.getenv("ILUA_CMD_PATH"))
 local ret_pipe_path = assert(os.getenv("ILUA_RET_PATH"))
+local bytecode_cache_dir = os.getenv("ILUA_BYTECODE_CACHE")
+local mailbox_path = os.getenv("ILUA_MAILBOX_PATH")
+-- Results kept in Out, 0 to keep none
+local out_cache_entries = tonumber(os.getenv("ILUA_OUT_CACHE_ENTRIES") or "")
+                          or 100
+-- Estimated KB of results kept in Out, 0 for no limit
+local out_cache_memory = tonumber(os.getenv("ILUA_OUT_CACHE_MEMORY") or "")
+                         or 65536
+-- Add the time spent on each request to its reply
+local trace = os.getenv("ILUA_TRACE") == "1"
+-- KB the Lua heap may grow to while a cell runs, 0 for no limit
+local memory_limit = tonumber(os.getenv("ILUA_MEMORY_LIMIT") or "") or 0
+
+-- Bytecode cache
+-- Modules found on package.path are compiled once, and their string.dump
+-- output is stored in ILUA_BYTECODE_CACHE. A cache entry is only used if it
+-- was written by the same interpreter build, for the same path, from the
+-- exact same source, so stale or foreign entries are simply recompiled.
+local function load_binary(chunk, chunk_name)
+    if setfenv then
+        return loadstring(chunk, chunk_name)
+    else
+        return load(chunk, chunk_name, "b")
+    end
+end
+
+local function load_source(chunk, chunk_name)
+    -- loadfile skips a leading shebang line, mimic that
+    chunk = chunk:gsub("^#[^\n]*", "")
+    if setfenv then
+        return loadstring(chunk, chunk_name)
+    else
+        return load(chunk, chunk_name, "t")
+    end
+end
+
+local function hash_string(str)
+    local h1, h2 = 5381, 0
+    for i=1, #str do
+        local byte = str:byte(i)
+        h1 = (h1 * 33 + byte) % 4294967296
+        h2 = (h2 * 65599 + byte) % 4294967296
+    end
+    return ("%08x%08x"):format(h1, h2)
+end
+
+local function search_path(name, path)
+    if package.searchpath then
+        return package.searchpath(name, path)
+    end
+    local module_path = name:gsub("%.", package.config:sub(1, 1))
+    for template in path:gmatch("[^;]+") do
+        local filename = template:gsub("%?", function() return module_path end)
+        local file = io.open(filename, "rb")
+        if file then
+            file:close()
+            return filename
+        end
+    end
+end
+
+local function read_field(data, pos)
+    local colon = data:find(":", pos, true)
+    local length = colon and tonumber(data:sub(pos, colon - 1))
+    if not length then
+        return nil
+    end
+    return data:sub(colon + 1, colon + length), colon + length + 1
+end
+
+local function write_field(data)
+    return #data .. ":" .. data
+end
+
+local CACHE_MAGIC = "ILUABC1\n"
+
+local function install_bytecode_cache(cache_dir)
+    local dump_ok, probe = pcall(string.dump, load_source("return", "=probe"))
+    if not dump_ok then
+        return -- string.dump is unsupported, nothing to cache
+    end
+    local interpreter_id = table.concat({_VERSION, jit and jit.version or "",
+                                         probe}, "\0")
+    local dir_sep = package.config:sub(1, 1)
+
+    local function read_entry(cache_path, filename, source)
+        local file = io.open(cache_path, "rb")
+        if not file then
+            return nil
+        end
+        local data = file:read("*a")
+        file:close()
+        if not data or data:sub(1, #CACHE_MAGIC) ~= CACHE_MAGIC then
+            return nil
+        end
+        local pos = #CACHE_MAGIC + 1
+        local cached_id, cached_filename, cached_source
+        cached_id, pos = read_field(data, pos)
+        if cached_id ~= interpreter_id then
+            return nil
+        end
+        cached_filename, pos = read_field(data, pos)
+        if cached_filename ~= filename then
+            return nil
+        end
+        cached_source, pos = read_field(data, pos)
+        if cached_source ~= source then
+            return nil
+        end
+        return data:sub(pos)
+    end
+
+    local function write_entry(cache_path, filename, source, bytecode)
+        local tmp_path = ("%s.%s.tmp"):format(cache_path, hash_string(
+            tostring({}) .. os.time() .. os.clock()))
+        local file = io.open(tmp_path, "wb")
+        if not file then
+            return
+        end
+        local written = file:write(CACHE_MAGIC, write_field(interpreter_id),
+                                   write_field(filename), write_field(source),
+                                   bytecode)
+        file:close()
+        if not written then
+            os.remove(tmp_path)
+        elseif not os.rename(tmp_path, cache_path) then
+            -- rename does not replace existing files on windows
+            os.remove(cache_path)
+            if not os.rename(tmp_path, cache_path) then
+                os.remove(tmp_path)
+            end
+        end
+    end
+
+    local function load_cached(filename)
+        local file = io.open(filename, "rb")
+        local source = file and file:read("*a")
+        if file then
+            file:close()
+        end
+        if not source then
+            return nil
+        end
+        local cache_path = cache_dir .. dir_sep ..
+            hash_string(interpreter_id .. "\0" .. filename) .. ".luac"
+        local chunk_name = "@" .. filename
+        local bytecode = read_entry(cache_path, filename, source)
+        local chunk = bytecode and load_binary(bytecode, chunk_name)
+        if chunk then
+            return chunk
+        end
+        chunk = load_source(source, chunk_name)
+        if not chunk then
+            return nil -- let the stock searcher report the error
+        end
+        local ok, dumped = pcall(string.dump, chunk)
+        if ok then
+            write_entry(cache_path, filename, source, dumped)
+        end
+        return chunk
+    end
+
+    local function bytecode_searcher(name)
+        local filename = search_path(name, package.path)
+        local chunk = filename and load_cached(filename)
+        if chunk then
+            return chunk, filename
+        end
+    end
+
+    -- Right after the preload searcher, before the stock Lua searcher
+    table.insert(package.searchers or package.loaders, 2, bytecode_searcher)
+end
+
+if bytecode_cache_dir and bytecode_cache_dir ~= "" then
+    install_bytecode_cache(bytecode_cache_dir)
+end
 
 local netstring = require"ext.netstring"
 local json = require"ext.json"
 local inspect = require"ext.inspect"
-local builtins = require"builtins"
+local introspect = require"introspect"
 
 -- Compatibility setup
 table.pack = table.pack or function (...)
@@ -48,6 +225,110 @@ for key, val in pairs(global_env) do
     dynamic_env[key] = val
 end
 
+-- Result cache
+-- The first value each cell returns is kept as Out[n] (and _n), n being
+-- the execution count. Once there are too many results, or they take too
+-- much memory, the oldest ones are evicted to a weak table, where they stay
+-- reachable for as long as something else keeps them alive. Sizes are
+-- estimated from how much the heap grew while the cell ran.
+local evicted_results = setmetatable({}, {__mode = "v"})
+local results = setmetatable({}, {__index = evicted_results})
+local result_order = {}
+local result_sizes = {}
+local results_memory = 0
+dynamic_env.Out = results
+setmetatable(dynamic_env, {
+    __index = function(_, key)
+        local count = type(key) == "string" and key:match("^_(%d+)$")
+        if count then
+            return results[tonumber(count)]
+        end
+    end
+})
+
+local function is_collectable(value)
+    local kind = type(value)
+    -- Strings are never removed from weak tables
+    return kind == "table" or kind == "function" or kind == "userdata" or
+           kind == "thread"
+end
+
+local function evict_results()
+    while #result_order > out_cache_entries or
+            (out_cache_memory > 0 and results_memory > out_cache_memory) do
+        local count = table.remove(result_order, 1)
+        local value = rawget(results, count)
+        rawset(results, count, nil)
+        results_memory = results_memory - result_sizes[count]
+        result_sizes[count] = nil
+        if is_collectable(value) then
+            evicted_results[count] = value
+        end
+    end
+end
+
+local function store_result(count, value, heap_before)
+    if count == nil or value == nil or out_cache_entries <= 0 then
+        return
+    end
+    local size = 0
+    if type(value) == "string" then
+        size = #value / 1024
+    elseif is_collectable(value) then
+        size = math.max(0, collectgarbage("count") - heap_before)
+    end
+    if out_cache_memory > 0 and size > out_cache_memory then
+        if is_collectable(value) then
+            evicted_results[count] = value
+        end
+        return
+    end
+    rawset(results, count, value)
+    result_order[#result_order + 1] = count
+    result_sizes[count] = size
+    results_memory = results_memory + size
+    evict_results()
+end
+
+-- Bumped whenever user code runs, so the kernel knows
+-- when its cached completions went stale
+local namespace_version = 0
+
+-- Installed for the duration of user code when live introspection is on,
+-- serving introspection requests that show up in the mailbox
+local mailbox_hook
+-- Sends output buffered by the print/io proxies of dynamic_env
+local flush_output
+-- Instructions between mailbox checks
+local MAILBOX_HOOK_COUNT = 100000
+
+-- Memory guard
+-- A count hook fails the running cell once the heap outgrows the memory
+-- limit, garbage aside. Cells that start over the limit (code that caught
+-- the error can keep what it allocated) may only shrink the heap. This is
+-- a soft limit: user code may catch the error, and JIT compiled code runs
+-- no hooks, the address space limit of the kernel backs it up.
+local MEMORY_HOOK_COUNT = 1000
+local memory_ceiling
+local memory_ticks = 0
+
+local function memory_hook()
+    if collectgarbage("count") > memory_ceiling then
+        collectgarbage("collect")
+        if collectgarbage("count") > memory_ceiling then
+            error(("ILua: the cell grew the Lua heap past the memory limit "
+                   .. "of %d KB"):format(memory_limit), 2)
+        end
+    end
+    if mailbox_hook then
+        memory_ticks = memory_ticks + 1
+        if memory_ticks * MEMORY_HOOK_COUNT >= MAILBOX_HOOK_COUNT then
+            memory_ticks = 0
+            mailbox_hook()
+        end
+    end
+end
+
 -- shell logic
 local function load_chunk(code, env)
     local loaded, err = load_compat("return " .. code, env)
@@ -57,15 +338,34 @@ local function load_chunk(code, env)
     return loaded, err
 end
 
-local function handle_execute(code)
+local function handle_execute(code, execution_count)
     local loaded, err = load_chunk(code, dynamic_env)
     if not loaded then
         return nil, err
     end
+    local heap_before = collectgarbage("count")
+    -- Bump before and after, the namespace is in flux while running
+    namespace_version = namespace_version + 1
+    if mailbox_hook then
+        mailbox_hook("reset")
+    end
+    if memory_limit > 0 then
+        memory_ceiling = math.max(memory_limit, heap_before)
+        memory_ticks = 0
+        debug.sethook(memory_hook, "", MEMORY_HOOK_COUNT)
+    elseif mailbox_hook then
+        debug.sethook(mailbox_hook, "", MAILBOX_HOOK_COUNT)
+    end
     outcome = table.pack(xpcall(loaded, debug.traceback))
+    if mailbox_hook or memory_limit > 0 then
+        debug.sethook()
+    end
+    namespace_version = namespace_version + 1
 
-    dynamic_env.io.stdout:flush()
-    dynamic_env.io.stderr:flush()
+    -- Output must reach the kernel before the result does
+    flush_output()
+    io.stdout:flush()
+    io.stderr:flush()
 
     success = outcome[1]
     if not success then
@@ -78,6 +378,7 @@ local function handle_execute(code)
     local returned = table.pack(select(2, table.unpack(outcome, 1, outcome.n)))
     if returned.n > 0 then
         dynamic_env['_'] = returned[1]
+        store_result(execution_count, returned[1], heap_before)
     else
         dynamic_env['_'] = nil
     end
@@ -98,68 +399,219 @@ local function handle_is_complete(code)
     end
 end
 
-local function get_matches(obj, matches, only_methods)
-    if type(obj) == 'table' then
-        for key, value in pairs(obj) do
-            if type(key) == 'string' and
-                    key:match("^[_a-zA-Z][_a-zA-Z0-9]*$") and
-                    (not only_methods or type(value) == 'function') then
-                matches[#matches+1] = key
-            end
+local function handle_complete(breadcrumbs, only_methods)
+    return introspect.complete(dynamic_env, breadcrumbs, only_methods)
+end
+
+local function handle_info(breadcrumbs)
+    return introspect.info(dynamic_env, breadcrumbs)
+end
+
+local cmd_pipe = assert(io.open(cmd_pipe_path, "rb"))
+local ret_pipe = assert(io.open(ret_pipe_path, "wb"))
+
+-- In-band output
+-- print and io output of user code are buffered and sent as stream frames
+-- on the return pipe, so they arrive before the execute result rather than
+-- racing it over the process stdout/stderr (which remain for output of C
+-- code). Buffers are sent once they grow big, when enough CPU time or any
+-- wall time (os.time only has second resolution) passed since the last
+-- frame, and right before the result.
+local OUTPUT_FLUSH_SIZE = 4096
+local OUTPUT_FLUSH_INTERVAL = 0.05
+
+-- Output of a single stream is buffered at a time, switching streams
+-- flushes, so stdout and stderr stay interleaved as written
+local output_stream, output_buffer, output_size = nil, {}, 0
+local last_flush_clock, last_flush_time = os.clock(), os.time()
+
+function flush_output()
+    if output_size > 0 then
+        netstring.write(ret_pipe, json.encode({
+            type = "stream",
+            payload = {
+                name = output_stream,
+                text = table.concat(output_buffer)
+            }
+        }))
+        ret_pipe:flush()
+        output_buffer, output_size = {}, 0
+    end
+    last_flush_clock, last_flush_time = os.clock(), os.time()
+end
+
+local function buffer_output(name, ...)
+    if name ~= output_stream then
+        flush_output()
+        output_stream = name
+    end
+    for i=1, select("#", ...) do
+        local value = select(i, ...)
+        local value_type = type(value)
+        if value_type == "number" then
+            value = tostring(value)
+        elseif value_type ~= "string" then
+            error(("bad argument #%d to 'write' (string expected, got %s)")
+                  :format(i, value_type), 3)
         end
+        output_buffer[#output_buffer+1] = value
+        output_size = output_size + #value
     end
-    local mt = getmetatable(obj)
-    if mt and mt.__index then
-        get_matches(mt.__index, matches, only_methods)
+    if output_size >= OUTPUT_FLUSH_SIZE or
+            os.clock() - last_flush_clock >= OUTPUT_FLUSH_INTERVAL or
+            os.time() ~= last_flush_time then
+        flush_output()
     end
 end
 
-local function handle_complete(breadcrumbs, only_methods)
-    local subject_obj = dynamic_env
-    local matches = {}
-    for _, key in ipairs(breadcrumbs) do
-        subject_obj = subject_obj[key]
-        if not subject_obj then
-            return matches
-        end
+local real_io = io
+
+local function make_stream(name, real_file)
+    local stream = {}
+    function stream.write(self, ...)
+        buffer_output(name, ...)
+        return self
+    end
+    function stream.flush(self)
+        flush_output()
+        return self
     end
-    get_matches(subject_obj, matches, methods_only)
-    return matches
+    -- Everything else goes to the real file
+    return setmetatable(stream, {
+        __index = function(_, key)
+            local method = real_file[key]
+            if type(method) ~= "function" then
+                return method
+            end
+            return function(self, ...)
+                if self == stream then
+                    self = real_file
+                end
+                return method(self, ...)
+            end
+        end,
+        __tostring = function()
+            return tostring(real_file)
+        end
+    })
 end
 
-local function handle_info(breadcrumbs)
-    local subject_obj = dynamic_env
-    for _, key in ipairs(breadcrumbs) do
-        subject_obj = subject_obj[key]
-        if not subject_obj then
-            return false
+local stdout_stream = make_stream("stdout", real_io.stdout)
+local stderr_stream = make_stream("stderr", real_io.stderr)
+local default_output = stdout_stream
+
+dynamic_env.io = setmetatable({
+    stdout = stdout_stream,
+    stderr = stderr_stream,
+    write = function(...)
+        return default_output:write(...)
+    end,
+    output = function(file)
+        if file == nil then
+            return default_output
+        elseif file == stdout_stream or file == stderr_stream then
+            default_output = file
+        else
+            default_output = real_io.output(file)
         end
+        return default_output
+    end,
+    type = function(obj)
+        if obj == stdout_stream or obj == stderr_stream then
+            return "file"
+        end
+        return real_io.type(obj)
+    end
+}, {__index = real_io})
+
+dynamic_env.print = function(...)
+    local parts = {}
+    for i=1, select("#", ...) do
+        parts[i] = dynamic_env.tostring((select(i, ...)))
     end
-    if type(subject_obj) ~= "function" then
-        return false -- nil will be lost in json encoding
+    buffer_output("stdout", table.concat(parts, "\t"), "\n")
+end
+
+-- Live introspection
+-- The main loop blocks on the command pipe and standard Lua can't poll it,
+-- so while user code runs, the kernel appends read-only requests to a plain
+-- mailbox file instead. A count hook checks the file for new requests and
+-- serves them right away. (Lua hooks can't yield back to the main loop, but
+-- they can answer from where they are.) The kernel empties the mailbox
+-- between executions, and resends requests that were not served.
+local function serve_readonly(message)
+    local payload
+    if message.type == "is_complete" then
+        payload = handle_is_complete(message.payload)
+    elseif message.type == "complete" then
+        payload = {
+            matches = handle_complete(message.payload.breadcrumbs,
+                                      message.payload.only_methods),
+            version = namespace_version
+        }
+    elseif message.type == "info" then
+        payload = handle_info(message.payload.breadcrumbs)
     else
-        local info = debug.getinfo(subject_obj, "S")
-        local builtin_info = builtins[subject_obj]
-        if builtin_info then
-            info.preloaded_info = true
-            info.func_signature = builtin_info['signature']
-            info.func_documentation = builtin_info['documentation']
-        else
-            info.preloaded_info = false
-        end
-        return info
+        error("Unexpected mailbox message type")
     end
+    netstring.write(ret_pipe, json.encode({
+        type = message.type,
+        payload = payload,
+        request_id = message.request_id
+    }))
+    ret_pipe:flush()
 end
 
-local cmd_pipe = assert(io.open(cmd_pipe_path, "rb"))
-local ret_pipe = assert(io.open(ret_pipe_path, "wb"))
+if mailbox_path and mailbox_path ~= "" then
+    local mailbox = assert(io.open(mailbox_path, "rb"))
+    local offset = 0
+
+    local function check_mailbox()
+        local size = mailbox:seek("end")
+        if not size or size <= offset then
+            return
+        end
+        mailbox:seek("set", offset)
+        local data = mailbox:read(size - offset)
+        local pos = 1
+        -- Requests may still be half written, stop at the first partial one
+        while true do
+            local colon = data:find(":", pos, true)
+            local length = colon and tonumber(data:sub(pos, colon - 1))
+            if not length or #data < colon + length + 1 then
+                break
+            end
+            serve_readonly(json.decode(data:sub(colon + 1, colon + length)))
+            pos = colon + length + 2
+        end
+        offset = offset + pos - 1
+    end
+
+    function mailbox_hook(event)
+        if event == "reset" then
+            offset = 0
+            return
+        end
+        -- Running user code must not see our errors
+        local ok, err = pcall(check_mailbox)
+        if not ok then
+            io.stderr:write("ILua mailbox error: ", tostring(err), "\n")
+            offset = mailbox:seek("end") or offset
+        end
+    end
+end
 
 while true do
-    local message = json.decode(netstring.read(cmd_pipe))
+    local request = netstring.read(cmd_pipe)
+    local received = trace and os.clock()
+    local message = json.decode(request)
+    local decoded = trace and os.clock()
+    local reply
     if message.type == "echo" then
-        netstring.write(ret_pipe, json.encode(message))
+        reply = message
     elseif message.type == "execute" then
-        local success, ret_val = handle_execute(message.payload)
+        local success, ret_val = handle_execute(message.payload,
+                                                message.execution_count)
         if not success then
             success = false
         end
@@ -170,35 +622,62 @@ while true do
             end
             ret_val = table.concat(tmp, "\t")
         end
-        netstring.write(ret_pipe, json.encode({
+        reply = {
             type = "execute",
             payload = {
                 success = success,
-                returned = ret_val
+                returned = ret_val,
+                version = namespace_version,
+                heap = collectgarbage("count")
             }
-        }))
+        }
     elseif message.type == "is_complete" then
-        local status = handle_is_complete(message.payload)
-        netstring.write(ret_pipe, json.encode({
+        reply = {
             type = "is_complete",
-            payload = status
-        }))
+            payload = handle_is_complete(message.payload)
+        }
     elseif message.type == 'complete' then
         local matches = handle_complete(message.payload.breadcrumbs,
                                         message.payload.only_methods)
-        netstring.write(ret_pipe, json.encode({
+        reply = {
             type = "complete",
-            payload = matches
-        }))
+            payload = {
+                matches = matches,
+                version = namespace_version
+            }
+        }
     elseif message.type == 'info' then
-        local info = handle_info(message.payload.breadcrumbs)
-        netstring.write(ret_pipe, json.encode({
+        reply = {
             type = "info",
-            payload = info
-        }))
+            payload = handle_info(message.payload.breadcrumbs)
+        }
+    elseif message.type == 'usage' then
+        reply = {
+            type = "usage",
+            payload = {
+                heap = collectgarbage("count"),
+                cpu = os.clock()
+            }
+        }
+    elseif message.type == 'package_info' then
+        reply = {
+            type = "package_info",
+            payload = {
+                path = package.path,
+                dir_sep = package.config:sub(1, 1)
+            }
+        }
     else
         error("Unknown message type")
     end
+    if trace then
+        -- CPU seconds, encoding the reply is left out
+        reply.timing = {
+            decode = decoded - received,
+            handle = os.clock() - decoded
+        }
+    end
+    netstring.write(ret_pipe, json.encode(reply))
     ret_pipe:flush()
 end
 
@@ -0,0 +1,201 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Lua interpreter subprocess, along with the
+pipes and protocol used to command it
+"""
+
+import itertools
+import os
+import signal
+import time
+
+from twisted.internet import defer, error, protocol
+from twisted.logger import Logger
+from twisted.python import failure
+
+from . import rlimit
+from .namedpipe import CoupleOPipes, get_pipe_path
+from .proto import InterpreterDied, InterpreterProtocol, OutputCapture
+
+INTERPRETER_SCRIPT = os.path.join(os.path.dirname(__file__), "interp.lua")
+
+class Interpreter(object):
+    """
+    A Lua subprocess running the interpreter script
+
+    Each instance gets its own pipes, so a new interpreter
+    can be started while an old one is going away
+    """
+
+    log = Logger()
+
+    _generations = itertools.count()
+
+    def __init__(self, lua_interpreter, env, message_sink, mailbox_path=None,
+                 death_handler=None, metrics=None, tracer=None,
+                 offloader=None, limits=None, reactor=None):
+        """
+        :param lua_interpreter: Lua executable
+        :type lua_interpreter: string
+        :param env: environment of the subprocess
+        :type env: dict
+        :param message_sink: output handler
+        :type message_sink: function
+        :param mailbox_path: path of the mailbox file, or None
+        :type mailbox_path: string
+        :param death_handler: called with the interpreter and the
+                              reason once the subprocess ends, in charge
+                              of closing the interpreter
+        :type death_handler: function
+        :param metrics: metrics registry of the protocol, or None
+        :type metrics: ilua.metrics.Metrics
+        :param tracer: tracer of the protocol, or None
+        :type tracer: ilua.tracing.Tracer
+        :param offloader: offloader of the protocol, or None
+        :type offloader: ilua.offload.Offloader
+        :param limits: resource limits of the subprocess, see
+                       ilua.rlimit.LIMITS
+        :type limits: dict
+        :param reactor: Twisted reactor to use, defaults
+                        to the global reactor
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.death_handler = death_handler
+        generation = next(self._generations)
+        self.pipes = CoupleOPipes(get_pipe_path("ret_{}".format(generation)),
+                                  get_pipe_path("cmd_{}".format(generation)),
+                                  reactor)
+        self.proto = InterpreterProtocol(message_sink, mailbox_path, metrics,
+                                         tracer, offloader)
+        self.started = time.time()
+        self.ready = False
+        self.exit_reason = None
+        self._connecting = None
+        self._connect_result = None
+        self._waiters = []
+
+        env = dict(env, ILUA_CMD_PATH=self.pipes.out_pipe.path,
+                   ILUA_RET_PATH=self.pipes.in_pipe.path)
+        capture = OutputCapture(message_sink, self._process_ended)
+        argv = [lua_interpreter, INTERPRETER_SCRIPT]
+        if limits:
+            argv = rlimit.wrap(argv, limits)
+        self.log.debug("Launching child lua")
+        # pylint: disable=no-member
+        if os.name == "nt":
+            self.process = reactor.spawnProcess(capture, None, argv, env)
+        else:
+            self.process = reactor.spawnProcess(capture, argv[0], argv, env)
+
+    @property
+    def dead(self):
+        return self.exit_reason is not None
+
+    def connect(self):
+        """
+        Open the pipes to the interpreter
+
+        :return: Deferred fired with the protocol once
+                 the pipes are open
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if self._connecting is None:
+            self._connecting = self.pipes.connect(
+                protocol.Factory.forProtocol(lambda: self.proto))
+            self._connecting.addCallback(self._connected)
+            self._connecting.addBoth(self._notify_waiters)
+        if self._connect_result is not None:
+            if isinstance(self._connect_result, failure.Failure):
+                return defer.fail(self._connect_result)
+            return defer.succeed(self._connect_result)
+        waiter = defer.Deferred()
+        self._waiters.append(waiter)
+        return waiter
+
+    def describe_exit(self):
+        """
+        :return: how the subprocess ended, for humans
+        :rtype: string
+        """
+
+        reason = self.exit_reason.value if self.exit_reason else None
+        if isinstance(reason, error.ProcessTerminated):
+            if reason.signal == getattr(signal, "SIGXCPU", None):
+                return "ran out of CPU time"
+            if reason.signal is not None:
+                return "was killed by signal {}".format(reason.signal)
+            return "exited with code {}".format(reason.exitCode)
+        return "exited"
+
+    def usage(self):
+        """
+        :return: resources the subprocess uses, see
+                 ilua.rlimit.process_usage
+        :rtype: dict
+        """
+
+        if self.dead or self.process.pid is None:
+            return {}
+        return rlimit.process_usage(self.process.pid)
+
+    def kill(self):
+        try:
+            self.process.signalProcess("KILL")
+        except error.ProcessExitedAlready:
+            pass
+
+    def close(self):
+        """
+        Fail requests that were not answered,
+        close the pipes and kill the subprocess
+        """
+
+        if self.proto.lost is None:
+            self.proto.abort(InterpreterDied("The Lua interpreter {}".format(
+                self.describe_exit())))
+        self.pipes.loseConnection()
+        if os.name == "posix":
+            # FIFOs that were never opened stay around, removing
+            # them also stops waiting for the other end
+            for pipe in (self.pipes.in_pipe, self.pipes.out_pipe):
+                if not pipe.connected:
+                    try:
+                        os.remove(pipe.path)
+                    except OSError:
+                        pass
+        self.kill()
+
+    def _connected(self, _):
+        self.ready = True
+        # The interpreter closing its end means it is gone, even if the
+        # subprocess lingers. Requests fail once the subprocess ends, so
+        # the failure tells how it ended
+        self.pipes.in_pipe.pipeClosed = lambda reason: self.kill()
+        return self.proto
+
+    def _notify_waiters(self, result):
+        self._connect_result = result
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def _process_ended(self, reason):
+        self.exit_reason = reason
+        if self.death_handler:
+            self.death_handler(self, reason)
+        else:
+            self.close()
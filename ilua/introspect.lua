@@ -0,0 +1,72 @@
+-- ILua
+-- Copyright (C) 2018  guysv
+
+-- This file is part of ILua which is released under GPLv2.
+-- See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+-- for full license details.
+
+-- Completion and inspection of the values found under a namespace,
+-- following breadcrumbs (chains of keys) from its root
+
+local builtins = require"builtins"
+
+local introspect = {}
+
+local function get_matches(obj, matches, only_methods)
+    if type(obj) == 'table' then
+        for key, value in pairs(obj) do
+            if type(key) == 'string' and
+                    key:match("^[_a-zA-Z][_a-zA-Z0-9]*$") and
+                    (not only_methods or type(value) == 'function') then
+                matches[#matches+1] = key
+            end
+        end
+    end
+    local mt = getmetatable(obj)
+    if mt and mt.__index then
+        get_matches(mt.__index, matches, only_methods)
+    end
+end
+
+local function follow(root, breadcrumbs)
+    local subject_obj = root
+    for _, key in ipairs(breadcrumbs) do
+        subject_obj = subject_obj[key]
+        if not subject_obj then
+            return nil
+        end
+    end
+    return subject_obj
+end
+
+-- Get the identifier keys of the object at breadcrumbs
+function introspect.complete(root, breadcrumbs, only_methods)
+    local matches = {}
+    local subject_obj = follow(root, breadcrumbs)
+    if subject_obj then
+        get_matches(subject_obj, matches, only_methods)
+    end
+    return matches
+end
+
+-- Get debug info (and documentation of builtins) of the
+-- function at breadcrumbs, or false
+function introspect.info(root, breadcrumbs)
+    local subject_obj = follow(root, breadcrumbs)
+    if type(subject_obj) ~= "function" then
+        return false -- nil will be lost in json encoding
+    else
+        local info = debug.getinfo(subject_obj, "S")
+        local builtin_info = builtins[subject_obj]
+        if builtin_info then
+            info.preloaded_info = true
+            info.func_signature = builtin_info['signature']
+            info.func_documentation = builtin_info['documentation']
+        else
+            info.preloaded_info = false
+        end
+        return info
+    end
+end
+
+return introspect
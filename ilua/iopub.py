@@ -0,0 +1,130 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Holds IOPub messages back while subscribers can't keep up,
+merging stream output and dropping it past a size limit, so
+a runaway print loop can't grow the kernel without bound
+"""
+
+from collections import deque
+
+# Stream text held back past which more is dropped, in bytes
+DEFAULT_MAX_BYTES = 1024 * 1024
+
+class IOPubBacklog(object):
+    """
+    Queue of IOPub messages waiting for the socket
+
+    Stream messages of the same stream and request are merged
+    as they queue. Other messages are never dropped, they are
+    sent in order once subscribers catch up
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param max_bytes: stream text to hold back at most, in
+                          bytes of its UTF-8 encoding
+        :type max_bytes: int
+        """
+
+        self.max_bytes = max_bytes
+        # [msg_type, content, parent, started, built message]
+        # of held back messages, oldest first
+        self.entries = deque()
+        self.stream_bytes = 0
+        self.stats = {
+            'deferred': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'dropped_bytes': 0
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, msg_type, content, parent, started=None):
+        """
+        Queue a message, merged into the last one if both
+        are output of the same stream
+
+        :param msg_type: type of the message
+        :type msg_type: string
+        :param content: message content
+        :type content: dict
+        :param parent: header of the request the message is for
+        :type parent: dict
+        :param started: time the message was sent (time.time()),
+                        for tracing
+        :type started: float
+        """
+
+        if msg_type == "stream":
+            text = content["text"]
+            size = kept = len(text.encode("utf8"))
+            room = max(self.max_bytes - self.stream_bytes, 0)
+            if size > room:
+                # Cut at a character boundary
+                text = text.encode("utf8")[:room].decode("utf8", "ignore")
+                kept = len(text.encode("utf8"))
+                self.stats['dropped'] += 1
+                self.stats['dropped_bytes'] += size - kept
+            self.stream_bytes += kept
+            last = self.entries[-1] if self.entries else None
+            if last and last[0] == "stream" and last[4] is None and \
+               last[2] is parent and \
+               last[1]["name"] == content["name"]:
+                last[1]["text"] += text
+                last[1]["size"] += kept
+                last[1]["dropped"] += size - kept
+                self.stats['coalesced'] += 1
+                return
+            content = {"name": content["name"], "text": text,
+                       "size": kept, "dropped": size - kept}
+        self.stats['deferred'] += 1
+        self.entries.append([msg_type, content, parent, started, None])
+
+    def add_built(self, msg, msg_type, parent, started=None):
+        """
+        Queue a message already built, that the socket refused
+
+        :param msg: message frames
+        :type msg: list
+        """
+
+        self.stats['deferred'] += 1
+        self.entries.append([msg_type, None, parent, started, msg])
+
+    def peek(self, build):
+        """
+        :param build: builds message frames out of
+                      (msg_type, content, parent)
+        :type build: function
+        :return: (msg, msg_type, parent, started) of the oldest
+                 message, built on the way if needed
+        :rtype: tuple
+        """
+
+        entry = self.entries[0]
+        msg_type, content, parent, started, msg = entry
+        if msg is None:
+            if msg_type == "stream":
+                self.stream_bytes -= content.pop("size")
+                dropped = content.pop("dropped")
+                if dropped:
+                    content["text"] += "\n[ILua: dropped {} bytes of " \
+                                       "output, the frontend could not keep " \
+                                       "up]\n".format(dropped)
+            msg = entry[4] = build(msg_type, content, parent)
+            entry[1] = None
+        return msg, msg_type, parent, started
+
+    def pop(self):
+        """
+        Forget the oldest message, once sent
+        """
+
+        self.entries.popleft()
@@ -14,26 +14,47 @@ stuff
 import json
 import os
 import re
+import shlex
+import time
 
 from distutils.spawn import find_executable
 
-if os.name == 'nt':
-    # pylint: disable=E0401
-    from twisted.internet import _pollingfile
+from jupyter_core.paths import jupyter_data_dir, jupyter_runtime_dir
 
 import termcolor
 
-from twisted.internet import protocol, defer
+from twisted.internet import defer
+from twisted.python import failure
 
 from .kernelbase import KernelBase
 
-from .namedpipe import CoupleOPipes, get_pipe_path
-from .proto import InterpreterProtocol, OutputCapture
-from .inspector import Inspector
+from . import rlimit
+from .interpreter import Interpreter
+from .proto import InterpreterDied
+from .inspector import Inspector, required_module
+from .completion import CompletionCache, CompletionIndex
+from .modules import ModuleIndex
+from .offload import shield
+from .output import OutputLimiter, format_size
 from .version import __version__ as ilua_version
 
-INTERPRETER_SCRIPT = os.path.join(os.path.dirname(__file__), "interp.lua")
 LUA_PATH_EXTRA = os.path.join(os.path.dirname(__file__), "?.lua")
+BYTECODE_CACHE_DIR = os.path.join(jupyter_data_dir(), "ilua_bytecode")
+MODULE_INDEX_PATH = os.path.join(jupyter_data_dir(), "ilua_modules.json")
+
+_MAGIC = re.compile(r"^\s*%(\w+)(.*)$", re.DOTALL)
+
+_OUTPUT_MAGIC_USAGE = u"""Usage:
+  %output                       list cells with spilled output
+  %output page [N] [CELL]       show page N (from 1) of the spilled output
+  %output grep PATTERN [CELL]   show spilled lines matching a regex
+  %output tail [N] [CELL]       show the last N (10) spilled lines
+CELL is an execution count, and defaults to the last cell that spilled
+"""
+
+_USAGE_MAGIC_USAGE = u"""Usage:
+  %usage                        show resources the Lua interpreter uses
+"""
 
 _bold_red = lambda s: termcolor.colored(s, "red", attrs=['bold'])
 
@@ -62,47 +83,186 @@ class ILuaKernel(KernelBase):
     if "ILUA_HELP_LINKS" in os.environ:
         help_links = json.loads(os.environ["ILUA_HELP_LINKS"])
 
+    # Introspection requests of a dead interpreter get empty replies
+    fallback_errors = (InterpreterDied,)
+
+    # Keys of Interpreter.usage() mapped to their metrics
+    _USAGE_METRICS = {
+        'cpu': "interpreter_cpu_seconds",
+        'resident': "interpreter_resident_bytes",
+        'address_space': "interpreter_address_space_bytes",
+        'open_files': "interpreter_open_files"
+    }
+
     def __init__(self, *args, **kwargs):
+        # Checked before the sockets are bound
+        assert find_executable(kwargs["lua_interpreter"]), (
+            "Could not find '{}', is Lua in the system path?".format(
+                kwargs["lua_interpreter"]))
+        limits = {
+            'address_space': kwargs.pop("address_space_limit", 0),
+            'cpu': kwargs.pop("cpu_limit", 0),
+            'open_files': kwargs.pop("open_files_limit", 0)
+        }
+        assert rlimit.supported() or not any(limits.values()), (
+            "Resource limits are not supported on this system")
         super(ILuaKernel, self).__init__(*args, **kwargs)
-        self.inspector = Inspector()
-
-        self.pipes = CoupleOPipes(get_pipe_path("ret"), get_pipe_path("cmd"))
+        self.inspector = Inspector(kwargs.pop("inspector", None))
+        # The inspector caches are not thread safe, renders
+        # of inspections (offloaded or not) run one at a time
+        self.render_lock = kwargs.pop("render_lock", None) or \
+            defer.DeferredLock()
+        self.completions = CompletionCache()
+        # (breadcrumbs, only_methods) of completion indexes being
+        # fetched, mapped to the requests waiting for them
+        self._completion_fetches = {}
+        self.modules = kwargs.pop("module_index", None) or \
+            ModuleIndex(MODULE_INDEX_PATH, reactor=self.reactor)
+        self.language_info = dict(self.language_info)
 
         self.lua_interpreter = kwargs.pop("lua_interpreter")
+        self.bytecode_cache = kwargs.pop("bytecode_cache", None)
+        self.complete_limit = kwargs.pop("complete_limit", 0)
+        out_cache_entries = kwargs.pop("out_cache_entries", 100)
+        out_cache_memory = kwargs.pop("out_cache_memory", 65536)
+        self.execute_timeout = kwargs.pop("execute_timeout", 0)
+        self.warm_spare = kwargs.pop("warm_spare", False)
+        self.limits = limits
+        self.memory_limit = kwargs.pop("memory_limit", 0)
+        self.output = OutputLimiter(jupyter_runtime_dir(),
+                                    kwargs.pop("output_limit", 0) * 1024,
+                                    tag=self.runtime_tag,
+                                    reactor=self.reactor)
+        # Magic names mapped to (handler, usage)
+        self.magics = {"output": (self._output_magic, _OUTPUT_MAGIC_USAGE),
+                       "usage": (self._usage_magic, _USAGE_MAGIC_USAGE)}
+        # Executions run one at a time, so output is counted
+        # against the cell that produced it
+        self.execute_lock = defer.DeferredLock()
+        # Execute requests sent to the interpreter and not answered yet
+        self.pending_executions = 0
+        self.mailbox_path = None
+        if kwargs.pop("live_introspection", False):
+            self.mailbox_path = os.path.join(
+                jupyter_runtime_dir(),
+                "ilua_mailbox_{}".format(self.runtime_tag))
+            with open(self.mailbox_path, "wb"):
+                pass
+        if self.bytecode_cache and not os.path.isdir(self.bytecode_cache):
+            os.makedirs(self.bytecode_cache)
 
         # Lua process setup
-        self.log.debug("Launching child lua")
-        def message_sink(stream, data):
-            return self.send_update("stream", {"name": stream, "text": data})
-        proto = OutputCapture(message_sink)
-        os.environ.update({
-            'ILUA_CMD_PATH': self.pipes.out_pipe.path,
-            'ILUA_RET_PATH': self.pipes.in_pipe.path,
+        self.lua_env = dict(os.environ, **{
+            'ILUA_BYTECODE_CACHE': self.bytecode_cache or "",
+            'ILUA_MAILBOX_PATH': self.mailbox_path or "",
+            'ILUA_MEMORY_LIMIT': str(self.memory_limit),
+            'ILUA_OUT_CACHE_ENTRIES': str(out_cache_entries),
+            'ILUA_OUT_CACHE_MEMORY': str(out_cache_memory),
+            'ILUA_TRACE': "1" if self.tracer.enabled else "",
             'LUA_PATH': os.environ.get("LUA_PATH", ";") + ";"  + LUA_PATH_EXTRA
         })
 
-        assert find_executable(self.lua_interpreter), ("Could not find '{}', "
-                                                       "is Lua in the system "
-                                                       "path?".format(
-                                                           self.lua_interpreter))
-
-        # pylint: disable=no-member
-        if os.name == "nt":
-            self.lua_process = self.reactor.spawnProcess(proto, None,
-                                                         [self.lua_interpreter,
-                                                          INTERPRETER_SCRIPT],
-                                                         None)
-        else:
-            self.lua_process = self.reactor.spawnProcess(proto,
-                                                         self.lua_interpreter,
-                                                         [self.lua_interpreter,
-                                                          INTERPRETER_SCRIPT],
-                                                         None)
+        self.interpreter = self._spawn_interpreter()
+        self.proto = self.interpreter.proto
+        # Interpreter started ahead of time, to replace
+        # the current one if it dies
+        self.spare = None
+        # Interpreter deaths, restarts, and the total seconds
+        # it took to restart
+        self.restart_stats = {'deaths': 0, 'restarts': 0,
+                              'recovery_time': 0.0}
+        self.shutting_down = False
+
+        describe = self.metrics.describe
+        describe("interpreter_round_trip_seconds", "Seconds from sending a "
+                 "request to the Lua interpreter to its response")
+        describe("interpreter_queue_depth", "Requests waiting to be sent to "
+                 "the Lua interpreter")
+        describe("execute_queue_depth", "Executions waiting for the running "
+                 "one")
+        describe("lua_heap_bytes", "Lua heap size after the last execution")
+        describe("interpreter_deaths_total", "Lua interpreter deaths")
+        describe("interpreter_restarts_total", "Lua interpreter restarts")
+        describe("interpreter_recovery_seconds_total", "Seconds spent "
+                 "restarting the Lua interpreter")
+        describe("interpreter_cpu_seconds", "CPU seconds the current Lua "
+                 "interpreter used")
+        describe("interpreter_resident_bytes", "Resident memory of the Lua "
+                 "interpreter")
+        describe("interpreter_address_space_bytes", "Address space of the "
+                 "Lua interpreter")
+        describe("interpreter_open_files", "Files the Lua interpreter has "
+                 "open")
+        describe("interpreter_limit", "Resource limits of the Lua "
+                 "interpreter, in the units of its usage metrics")
+        self.metrics.add_collector(self._collect_interpreter_metrics)
+
+    @classmethod
+    def shared_resources(cls, options, reactor=None):
+        """
+        See KernelBase.shared_resources, kernels also share the
+        lexer and the lexed source files of their inspectors,
+        and the module index. Lua state stays per kernel
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        shared = super(ILuaKernel, cls).shared_resources(options, reactor)
+        shared.update({
+            'inspector': Inspector(),
+            'render_lock': defer.DeferredLock(),
+            'module_index': ModuleIndex(MODULE_INDEX_PATH, reactor=reactor)
+        })
+        return shared
+
+    def _spawn_interpreter(self):
+        return Interpreter(self.lua_interpreter, self.lua_env,
+                           self._send_stream, self.mailbox_path,
+                           self._interpreter_died, metrics=self.metrics,
+                           tracer=self.tracer, offloader=self.offloader,
+                           limits=self.limits, reactor=self.reactor)
+
+    def _collect_interpreter_metrics(self):
+        yield ("interpreter_queue_depth", "gauge", {},
+               len(self.proto.pending))
+        yield ("execute_queue_depth", "gauge", {},
+               len(self.execute_lock.waiting))
+        yield ("interpreter_deaths_total", "counter", {},
+               self.restart_stats['deaths'])
+        yield ("interpreter_restarts_total", "counter", {},
+               self.restart_stats['restarts'])
+        yield ("interpreter_recovery_seconds_total", "counter", {},
+               self.restart_stats['recovery_time'])
+        usage = self.interpreter.usage()
+        for name, metric in self._USAGE_METRICS.items():
+            if name in usage:
+                yield (metric, "gauge", {}, usage[name])
+        for name, value in self.limits.items():
+            if value:
+                yield ("interpreter_limit", "gauge", {'resource': name},
+                       value * rlimit.LIMITS[name][1])
+        if self.memory_limit:
+            yield ("interpreter_limit", "gauge", {'resource': "lua_heap"},
+                   self.memory_limit * 1024)
+
+    def _send_stream(self, stream, data):
+        """
+        Publish output of the interpreter, up to
+        the output limit of the running cell
+
+        :param stream: stream name, stdout or stderr
+        :type stream: string
+        :param data: output text
+        :type data: string
+        """
+
+        data = self.output.filter(data)
+        if data:
+            self.send_update("stream", {"name": stream, "text": data})
 
     @defer.inlineCallbacks
     def do_startup(self):
-        self.proto = yield self.pipes.connect(
-            protocol.Factory.forProtocol(InterpreterProtocol))
+        yield self.interpreter.connect()
 
         returned = yield self.proto.sendRequest({"type": "execute",
                                                 "payload": "nil, _VERSION"})
@@ -110,6 +270,7 @@ class ILuaKernel(KernelBase):
         if not returned["payload"]['success']:
             self.log.warn("Version request failed")
         else:
+            self.completions.set_version(returned['payload']['version'])
             version = re.findall(r"Lua (\d(?:\.\d)+)",
                                  returned['payload']['returned'])
             if not version:
@@ -125,47 +286,231 @@ class ILuaKernel(KernelBase):
                 self.language_info['version'] = version[0]
                 self.log.debug("Lua version is {version}", version=version[0])
 
+        yield self._index_modules()
+        if self.warm_spare:
+            self._prepare_spare()
+
+    @defer.inlineCallbacks
+    def _prepare_spare(self):
+        """
+        Start a spare interpreter, to take over
+        when the current one dies
+        """
+
+        self.spare = self._spawn_interpreter()
+        try:
+            yield self.spare.connect()
+        except Exception:
+            pass # _interpreter_died takes care of it
+
+    def _interpreter_died(self, interpreter, reason):
+        """
+        Called when an interpreter subprocess ends, fails requests
+        the interpreter did not answer and starts another one in
+        its place
+        """
+
+        if self.shutting_down or interpreter is not self.interpreter:
+            interpreter.close()
+            if interpreter is self.spare and not self.shutting_down:
+                self._spare_died(interpreter)
+            return
+
+        self.restart_stats['deaths'] += 1
+        if not interpreter.ready:
+            self.log.error("Interpreter {how} before starting",
+                           how=interpreter.describe_exit())
+            interpreter.close()
+            self.signal_stop()
+            return
+
+        self.log.warn("Interpreter {how}, restarting",
+                      how=interpreter.describe_exit())
+        self.send_update("status", {'execution_state': 'restarting'})
+        self.send_update("stream", {
+            "name": "stderr",
+            "text": u"The Lua interpreter {}, restarting it. Variables of "
+                    u"earlier cells are gone\n".format(
+                        interpreter.describe_exit())})
+        interpreter.close()
+        self._restart(time.time())
+
+    def _spare_died(self, spare):
+        self.spare = None
+        if spare.ready:
+            self.log.warn("Spare interpreter {how}, starting another",
+                          how=spare.describe_exit())
+            self._prepare_spare()
+        else:
+            self.log.error("Spare interpreter {how} before starting, no "
+                           "longer keeping spares",
+                           how=spare.describe_exit())
+            self.warm_spare = False
+
     @defer.inlineCallbacks
+    def _restart(self, died_at):
+        interpreter, self.spare = self.spare, None
+        if interpreter is None:
+            interpreter = self._spawn_interpreter()
+        # Requests made from now on queue up for the new interpreter
+        self.interpreter = interpreter
+        self.proto = interpreter.proto
+        self.completions = CompletionCache()
+        self._completion_fetches = {}
+        try:
+            yield interpreter.connect()
+        except Exception:
+            return # _interpreter_died takes care of it
+        if interpreter.dead:
+            return
+
+        recovery_time = time.time() - died_at
+        stats = self.restart_stats
+        stats['restarts'] += 1
+        stats['recovery_time'] += recovery_time
+        self.log.info("Interpreter restarted in {time:.3f}s ({restarts} "
+                      "restarts, {mttr:.3f}s mean time to recovery)",
+                      time=recovery_time, restarts=stats['restarts'],
+                      mttr=stats['recovery_time'] / stats['restarts'])
+        if not self.execute_lock.locked:
+            # Otherwise the execution reports idle when it is done
+            self.send_update("status", {'execution_state': 'idle'})
+        if self.warm_spare:
+            self._prepare_spare()
+
+    def _execute_timed_out(self, interpreter):
+        """
+        Kill an interpreter that ran a cell for too long,
+        it is restarted once it dies
+        """
+
+        self.log.warn("Execution ran for over {timeout}s, killing the "
+                      "interpreter", timeout=self.execute_timeout)
+        self.send_update("stream", {
+            "name": "stderr",
+            "text": u"The cell ran for over {}s, killing the Lua "
+                    u"interpreter\n".format(self.execute_timeout)})
+        interpreter.kill()
+
+    @defer.inlineCallbacks
+    def _index_modules(self):
+        """
+        Index the modules on the package.path of the
+        interpreter, in the background
+        """
+
+        result = yield self.proto.sendRequest({"type": "package_info",
+                                               "payload": None})
+        self.modules.scan(result['payload']['path'],
+                          result['payload']['dir_sep'])
+
+    @staticmethod
+    def _resolve_breadcrumbs(breadcrumbs):
+        """
+        Translate breadcrumbs of an object chain to breadcrumbs
+        the interpreter can follow, modules of require calls are
+        looked up in package.loaded
+
+        :param breadcrumbs: chain object names
+        :type breadcrumbs: list
+        :return: resolved breadcrumbs, and the required module
+                 (or None)
+        :rtype: tuple
+        """
+
+        module = required_module(breadcrumbs[0]) if breadcrumbs else None
+        if module is None:
+            return breadcrumbs, None
+        return ["package", "loaded", module] + breadcrumbs[1:], module
+
     def do_execute(self, code, silent, store_history=True, user_expressions=None,
                    allow_stdin=False):
-        result = yield self.proto.sendRequest({"type": "execute",
-                                              "payload": code})
-
-        if os.name == "nt":
-            # Because twisted's default implementation for process output
-            # reading on windows is polling the output pipe, sometimes the
-            # kernel will finish execute requests before output is read.
-            # This causes a statistical lag in output display
-            # The sleep seems to help the execution request to lose the
-            # race, therefore eliminating the lag
-            sleep_deferred = defer.Deferred()
-            self.reactor.callLater(_pollingfile.MAX_TIMEOUT,
-                                   sleep_deferred.callback, None)
-            yield sleep_deferred
-
-        if result["payload"]["success"]:
-            if result['payload']['returned'] != "" and not silent:
+        magic = _MAGIC.match(code)
+        if magic and magic.group(1) in self.magics:
+            return self.execute_lock.run(self._run_magic, magic.group(1),
+                                         magic.group(2), silent,
+                                         self.execution_count)
+        return self.execute_lock.run(self._execute, code, silent,
+                                     self.execution_count, self._trace_id(),
+                                     time.time())
+
+    @defer.inlineCallbacks
+    def _execute(self, code, silent, execution_count, trace_id=None,
+                 queued=None):
+        if trace_id is not None:
+            self.tracer.span(trace_id, "execute queue", queued, time.time())
+        self.output.start_cell(execution_count)
+        self.pending_executions += 1
+        watchdog = None
+        if self.execute_timeout:
+            watchdog = self.reactor.callLater(self.execute_timeout,
+                                              self._execute_timed_out,
+                                              self.interpreter)
+        try:
+            # Silent executions are not kept in Out
+            result = yield self.proto.sendRequest({
+                "type": "execute",
+                "payload": code,
+                "execution_count": None if silent else execution_count},
+                trace_id=trace_id)
+            self.completions.set_version(result['payload']['version'])
+            self.metrics.set("lua_heap_bytes", result['payload']['heap'] * 1024)
+            returned = result['payload']['returned']
+            if result["payload"]["success"] and not silent:
+                returned = self.output.filter(returned)
+        except InterpreterDied as err:
+            result = None
+            returned = u"{}".format(err)
+        finally:
+            self.pending_executions -= 1
+            notice = self.output.finish_cell()
+            if watchdog is not None and watchdog.active():
+                watchdog.cancel()
+
+        if result is None:
+            if notice:
+                self.send_update("stream", {"name": "stderr", "text": notice})
+            if not silent:
+                self.send_update("error", {
+                    'execution_count': execution_count,
+                    'traceback': [returned],
+                    'ename': 'InterpreterDied',
+                    'evalue': returned
+                })
+            defer.returnValue({
+                'status': 'error',
+                'execution_count': execution_count,
+                'traceback': [returned],
+                'ename': 'InterpreterDied',
+                'evalue': returned
+            })
+        elif result["payload"]["success"]:
+            if returned != "" and not silent:
                 self.send_update("execute_result", {
-                    'execution_count': self.execution_count,
+                    'execution_count': execution_count,
                     'data': {
-                        'text/plain': result['payload']['returned']
+                        'text/plain': returned
                     },
                     'metadata': {}
                 })
+            if notice:
+                self.send_update("stream", {"name": "stderr", "text": notice})
 
             defer.returnValue({
                 'status': 'ok',
-                'execution_count': self.execution_count,
+                'execution_count': execution_count,
                 'payload': [],
                 'user_expressions': {},
             })
         else:
-            full_traceback = result['payload']['returned'].split("\n")
+            if notice:
+                self.send_update("stream", {"name": "stderr", "text": notice})
+            full_traceback = returned.split("\n")
             evalue = full_traceback[0]
             traceback = full_traceback
             if not silent:
                 self.send_update("error", {
-                    'execution_count': self.execution_count,
+                    'execution_count': execution_count,
                     'traceback': traceback,
                     'ename': 'n/a',
                     'evalue': evalue
@@ -173,49 +518,288 @@ class ILuaKernel(KernelBase):
 
             defer.returnValue({
                 'status': 'error',
-                'execution_count': self.execution_count,
+                'execution_count': execution_count,
                 'traceback': traceback,
                 'ename': 'n/a',
                 'evalue': evalue
             })
 
+    @defer.inlineCallbacks
+    def _run_magic(self, name, line, silent, execution_count):
+        """
+        Run a kernel magic (`%name args`) instead of Lua code
+
+        Magics publish their output directly, it does
+        not count against the output limit
+        """
+
+        handler, usage = self.magics[name]
+        try:
+            text = yield handler(shlex.split(line))
+        except ValueError as err:
+            text = u"{}\n{}".format(err, usage)
+            if not silent:
+                self.send_update("stream", {"name": "stderr", "text": text})
+            defer.returnValue({
+                'status': 'error',
+                'execution_count': execution_count,
+                'traceback': [],
+                'ename': 'UsageError',
+                'evalue': str(err)
+            })
+        except InterpreterDied as err:
+            # Magics asking the interpreter fail like cells do
+            returned = u"{}".format(err)
+            if not silent:
+                self.send_update("error", {
+                    'execution_count': execution_count,
+                    'traceback': [returned],
+                    'ename': 'InterpreterDied',
+                    'evalue': returned
+                })
+            defer.returnValue({
+                'status': 'error',
+                'execution_count': execution_count,
+                'traceback': [returned],
+                'ename': 'InterpreterDied',
+                'evalue': returned
+            })
+
+        if text and not silent:
+            self.send_update("stream", {"name": "stdout", "text": text})
+        defer.returnValue({
+            'status': 'ok',
+            'execution_count': execution_count,
+            'payload': [],
+            'user_expressions': {},
+        })
+
+    @defer.inlineCallbacks
+    def _output_magic(self, args):
+        """
+        Page through, grep or tail output spilled past
+        the output limit, see _OUTPUT_MAGIC_USAGE
+        """
+
+        if not args:
+            spills = self.output.spills.values()
+            defer.returnValue(u"".join(
+                u"[{}] {} {}\n".format(spill.execution_count,
+                                       format_size(spill.size), spill.path)
+                for spill in spills) or u"No output was spilled\n")
+
+        command, args = args[0], args[1:]
+        pattern = None
+        if command == "grep":
+            if not args:
+                raise ValueError(u"Missing pattern")
+            pattern, args = args[0], args[1:]
+            try:
+                re.compile(pattern)
+            except re.error as err:
+                raise ValueError(u"Bad pattern: {}".format(err))
+            # Only the cell may follow the pattern
+            args = [None] + args
+        elif command not in ("page", "tail"):
+            raise ValueError(u"Unknown command '{}'".format(command))
+        if len(args) > 2:
+            raise ValueError(u"Too many arguments")
+        try:
+            args = [int(arg) if arg is not None else None for arg in args]
+        except ValueError:
+            raise ValueError(u"Expected numbers")
+        number, cell = (args + [None, None])[:2]
+
+        spill = self.output.get_spill(cell)
+        if spill is None:
+            raise ValueError(u"No spilled output" + (
+                u" for cell {}".format(cell) if cell is not None else u""))
+
+        if command == "page":
+            page = 1 if number is None else number
+            if page < 1:
+                raise ValueError(u"Pages start at 1")
+            text = yield self.output.page(spill, page - 1)
+            if not text:
+                defer.returnValue(u"No page {}\n".format(page))
+        elif command == "grep":
+            matches = yield self.output.grep(spill, pattern)
+            text = u"".join(u"{}: {}\n".format(line_number, line)
+                            for line_number, line in matches)
+            if len(matches) >= self.output.MAX_GREP_MATCHES:
+                text += u"(stopped after {} matches)\n".format(len(matches))
+        else:
+            lines = 10 if number is None else number
+            if lines < 1:
+                defer.returnValue(u"")
+            text = yield self.output.tail(spill, lines)
+        if text and not text.endswith(u"\n"):
+            text += u"\n"
+        defer.returnValue(text)
+
+    @defer.inlineCallbacks
+    def _usage_magic(self, args):
+        """
+        Show resources the Lua interpreter uses, next to its limits
+        """
+
+        if args:
+            raise ValueError(u"Too many arguments")
+        result = yield self.proto.sendRequest({"type": "usage",
+                                               "payload": None})
+        usage = self.interpreter.usage()
+        limits = self.limits
+
+        def row(title, value, limit=None):
+            if limit:
+                value = u"{} of {}".format(value, limit)
+            return u"{:<17}{}\n".format(title, value)
+
+        def size_row(title, size, limit_kb=0):
+            return row(title, format_size(size),
+                       limit_kb and format_size(limit_kb * 1024))
+
+        text = size_row(u"Lua heap", int(result['payload']['heap'] * 1024),
+                        self.memory_limit)
+        cpu_limit = limits['cpu'] and u"{}s".format(limits['cpu'])
+        text += row(u"CPU time",
+                    u"{:.2f}s".format(result['payload']['cpu']), cpu_limit)
+        if "resident" in usage:
+            text += size_row(u"Resident memory", usage['resident'])
+        if "address_space" in usage:
+            text += size_row(u"Address space", usage['address_space'],
+                             limits['address_space'])
+        if "open_files" in usage:
+            text += row(u"Open files", usage['open_files'],
+                        limits['open_files'])
+        text += row(u"Restarts", self.restart_stats['restarts'])
+        defer.returnValue(text)
+
     @defer.inlineCallbacks
     def do_is_complete(self, code):
         result = yield self.proto.sendRequest({"type": "is_complete",
-                                               "payload": code})
+                                               "payload": code},
+                                              read_only=True,
+                                              trace_id=self._trace_id())
 
         defer.returnValue({'status': result['payload']})
 
     @defer.inlineCallbacks
     def do_complete(self, code, cursor_pos):
+        module_prefix = self.inspector.get_require_prefix(code, cursor_pos)
+        if module_prefix is not None:
+            if self.modules.stale:
+                # Results only show up on the next request
+                self._index_modules()
+            defer.returnValue({
+                'matches': self.modules.match_modules(module_prefix,
+                                                      self.complete_limit),
+                'cursor_start': cursor_pos - len(module_prefix),
+                'cursor_end': cursor_pos,
+                'metadata': {},
+                'status': 'ok'
+            })
+
+        trace_id = self._trace_id()
         last_obj = self.inspector.get_last_obj(code, cursor_pos)
         initial = last_obj.pop() if last_obj and last_obj[-1] not in ".:" \
                   else ""
         only_methods = last_obj[-1] == ":" if last_obj else False
-        breadcrumbs = last_obj[::2]
-
-        result = yield self.proto.sendRequest({
-            "type": "complete",
-            "payload": {
-                'breadcrumbs':breadcrumbs,
-                'only_methods': only_methods}})
-
-        matches = filter(lambda x: x.startswith(initial), result['payload'])
+        breadcrumbs, module = self._resolve_breadcrumbs(last_obj[::2])
+        if module is not None and len(breadcrumbs) > 3:
+            module = None # only members of the module itself are indexed
+        elif module is None and len(breadcrumbs) == 1:
+            module = self.inspector.get_module_aliases(code).get(
+                breadcrumbs[0])
+
+        # Table keys only change when code runs, so indexes stay
+        # valid until the namespace version moves on
+        index = self.completions.get(breadcrumbs, only_methods)
+        if index is None and self.pending_executions and \
+           not self.mailbox_path:
+            # The interpreter is busy, answer with what the cell
+            # text tells instead of waiting for it
+            index = CompletionIndex([])
+        elif index is None:
+            index = yield self._fetch_completions(breadcrumbs, only_methods,
+                                                  trace_id)
+
+        if module is not None:
+            # Members of modules that were not required yet
+            members = self.modules.get_members(module, only_methods)
+            if members:
+                index = CompletionIndex(index.keys + members)
+        elif not breadcrumbs:
+            # Locals and names the cell defines before the cursor
+            local_names, global_names = self.inspector.get_visible_names(
+                code, cursor_pos - len(initial))
+            if local_names or global_names:
+                index = CompletionIndex(index.keys + local_names +
+                                        global_names)
+
+        matches = index.match(initial, self.complete_limit)
         matches_prefix = "".join(last_obj)
         matches_full = [matches_prefix + m for m in matches]
 
-        cursor_start = cursor_pos - sum([len(s) for s in breadcrumbs]) \
-                            - len(breadcrumbs) - len(initial)
+        cursor_start = cursor_pos - len(matches_prefix) - len(initial)
         cursor_end = cursor_pos
 
         defer.returnValue({
-            'matches': sorted(list(set(matches_full))),
+            'matches': matches_full,
             'cursor_start':cursor_start,
             'cursor_end':cursor_end,
             'metadata':{},
             'status': 'ok'
         })
 
+    def _fetch_completions(self, breadcrumbs, only_methods, trace_id=None):
+        """
+        Fetch the completion index of a table into the cache
+
+        Requests for the same table share one fetch, which runs
+        to the end even once they gave up on it, so tables too
+        big to index before the deadline still get cached
+
+        :return: deferred fired with the index, cancelling
+                 it leaves the fetch be
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        key = (tuple(breadcrumbs), only_methods)
+        waiters = self._completion_fetches.get(key)
+        if waiters is None:
+            waiters = self._completion_fetches[key] = []
+            fetch = self.proto.sendRequest({
+                "type": "complete",
+                "payload": {
+                    'breadcrumbs':breadcrumbs,
+                    'only_methods': only_methods}}, read_only=True,
+                trace_id=trace_id)
+            fetch.addCallback(self._completions_fetched, self.completions,
+                              breadcrumbs, only_methods)
+            fetch.addBoth(self._notify_completion_waiters, key,
+                          self._completion_fetches)
+        waiter = defer.Deferred()
+        waiters.append(waiter)
+        return waiter
+
+    @staticmethod
+    def _completions_fetched(result, cache, breadcrumbs, only_methods):
+        # Cache of the interpreter asked, not of one that replaced it
+        cache.set_version(result['payload']['version'])
+        return cache.put(breadcrumbs, only_methods,
+                         result['payload']['matches'])
+
+    @staticmethod
+    def _notify_completion_waiters(result, key, fetches):
+        for waiter in fetches.pop(key):
+            if waiter.called:
+                continue # cancelled
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
     _EMPTY_INSPECTION = {
         "status": "ok",
         "found": False,
@@ -226,16 +810,50 @@ class ILuaKernel(KernelBase):
     @defer.inlineCallbacks
     def do_inspect(self, code, cursor_pos, detail_level):
         last_obj = self.inspector.get_last_obj(code, cursor_pos)
-        breadcrumbs = last_obj[::2]
+        breadcrumbs, _ = self._resolve_breadcrumbs(last_obj[::2])
 
         result = yield self.proto.sendRequest({"type": "info",
                                                "payload": {'breadcrumbs':
-                                                           breadcrumbs}})
+                                                           breadcrumbs}},
+                                              read_only=True,
+                                              trace_id=self._trace_id())
 
         if not result['payload']:
             defer.returnValue(self._EMPTY_INSPECTION.copy())
 
         info = result['payload']
+        size = 0
+        if not info['preloaded_info'] and info['source'].startswith("@"):
+            # Lexing and highlighting cost grows with the source file
+            try:
+                size = os.path.getsize(info['source'][1:])
+            except OSError:
+                pass
+        # Superseded requests must not release the lock mid-render
+        text = yield shield(self.render_lock.run(self.offloader.run, size,
+                                                 self._render_inspection,
+                                                 info, detail_level))
+        if text is None:
+            defer.returnValue(self._EMPTY_INSPECTION.copy())
+
+        defer.returnValue({
+            'status': 'ok',
+            'found': True,
+            'data': {
+                'text/plain': text
+            },
+            'metadata': {}
+        })
+
+    def _render_inspection(self, info, detail_level):
+        """
+        Render an inspection reply of the interpreter, runs
+        in a thread for big source files
+
+        :return: inspection text, or None if there is nothing
+                 to show
+        :rtype: string
+        """
 
         text_parts = []
 
@@ -247,7 +865,7 @@ class ILuaKernel(KernelBase):
             text_parts.append(u"{} {}".format(_bold_red("Path:"), "n/a"))
         elif info['source'].startswith("@"):
             # Source is available, parse source file for info
-            # TODO: caching?
+            # (the inspector keeps lexed files cached)
             source_file = info['source'][1:]
             line = int(info['linedefined'])
             documentation = self.inspector.get_doc(source_file, line)
@@ -263,20 +881,21 @@ class ILuaKernel(KernelBase):
 
             text_parts.append(u"{} {}".format(_bold_red("Path:"), source_file))
         else:
-            defer.returnValue(self._EMPTY_INSPECTION.copy())
+            return None
 
-        defer.returnValue({
-            'status': 'ok',
-            'found': True,
-            'data': {
-                'text/plain': u"\n".join(text_parts)
-            },
-            'metadata': {}
-        })
+        return u"\n".join(text_parts)
 
     def do_interrupt(self):
         self.log.warn("ILua does not support keyboard interrupts")
 
     def do_shutdown(self):
-        self.pipes.loseConnection()
-        self.lua_process.signalProcess("KILL")
+        self.shutting_down = True
+        self.interpreter.close()
+        if self.spare is not None:
+            self.spare.close()
+        if self.restart_stats['deaths']:
+            self.log.info("Interpreter restart stats: {stats}",
+                          stats=self.restart_stats)
+        if self.mailbox_path and os.path.exists(self.mailbox_path):
+            os.remove(self.mailbox_path)
+        self.output.cleanup()
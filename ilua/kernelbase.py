@@ -11,11 +11,13 @@ but with Twisted, which allows async code in python 2,
 and provides txzmq.
 """
 
+import itertools
 import os
+import time
 import txzmq
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.logger import Logger
-from . import sockets, message, history
+from . import sockets, message, history, metrics, offload, tracing, iopub
 
 class KernelBase(object):
     """
@@ -48,8 +50,27 @@ class KernelBase(object):
 
     help_links = []
 
+    # Default seconds to wait for introspection replies before
+    # replying with an empty result
+    COMPLETE_TIMEOUT = 1.0
+    INSPECT_TIMEOUT = 2.0
+    IS_COMPLETE_TIMEOUT = 1.0
+
+    # Seconds between attempts to send IOPub messages
+    # held back while subscribers catch up
+    IOPUB_RETRY_INTERVAL = 0.01
+    # Seconds to wait on shutdown for held back IOPub
+    # messages to be sent
+    IOPUB_SHUTDOWN_TIMEOUT = 2.0
+
+    # Errors of introspection handlers answered with an empty
+    # reply, instead of failing the kernel
+    fallback_errors = ()
+
     log = Logger()
 
+    _instances = itertools.count()
+
     def __init__(self, connection_props, reactor=None, *args, **kwargs):
         """
         
@@ -66,15 +87,82 @@ class KernelBase(object):
             from twisted.internet import reactor
         self.reactor = reactor
         self.connection_props = connection_props
-
-        self.history_manager = history.HistoryManager(self.get_history_path())
+        # Tells apart runtime files of kernels sharing a process
+        self.runtime_tag = "{}_{}".format(os.getpid(), next(self._instances))
+
+        # Metrics cost a no-op call each unless they are exported
+        metrics_port = kwargs.pop("metrics_port", 0)
+        metrics_file = kwargs.pop("metrics_file", None)
+        metrics_interval = kwargs.pop("metrics_interval", 10.0)
+        if metrics_port or metrics_file:
+            self.metrics = metrics.Metrics(reactor=self.reactor)
+            self.metrics_exporter = metrics.MetricsExporter(
+                self.metrics, metrics_port, metrics_file, metrics_interval,
+                reactor=self.reactor)
+        else:
+            self.metrics = metrics.NullMetrics()
+            self.metrics_exporter = None
+        self._describe_metrics()
+
+        trace_file = kwargs.pop("trace_file", None)
+        self.tracer = tracing.Tracer(trace_file) if trace_file \
+                      else tracing.NullTracer()
+
+        # Big messages are built off the reactor thread,
+        # IOPub messages are still published in order
+        offload_threshold = kwargs.pop("offload_threshold",
+                                       offload.DEFAULT_THRESHOLD // 1024)
+        offload_threads = kwargs.pop("offload_threads", 2)
+        self.offloader = kwargs.pop("offloader", None) or \
+            offload.Offloader(offload_threshold * 1024, offload_threads,
+                              reactor=self.reactor)
+        self.iopub_queue = offload.OrderedOffloader(self.offloader)
+        # IOPub messages subscribers can't take yet
+        self.iopub_backlog = iopub.IOPubBacklog(
+            kwargs.pop("iopub_backlog",
+                       iopub.DEFAULT_MAX_BYTES // 1024) * 1024)
+        self._iopub_retry = None
+        self._reported_drops = 0
+
+        self.history_manager = history.HistoryManager(
+            self.get_history_path(),
+            flush_interval=kwargs.pop("history_flush_interval",
+                                      history.HistoryManager.FLUSH_INTERVAL),
+            flush_threshold=kwargs.pop("history_flush_threshold",
+                                       history.HistoryManager.FLUSH_THRESHOLD),
+            max_sessions=kwargs.pop("history_max_sessions", 0),
+            max_age=kwargs.pop("history_max_age", 0) * 24 * 60 * 60,
+            max_bytes=kwargs.pop("history_max_size", 0) * 1024 * 1024,
+            compaction_interval=kwargs.pop(
+                "history_compaction_interval",
+                history.HistoryManager.COMPACTION_INTERVAL),
+            metrics=self.metrics,
+            db=kwargs.pop("history_db", None),
+            reactor=self.reactor)
+
+        # 0 waits forever
+        self.request_deadlines = {
+            'complete_request': kwargs.pop("complete_timeout",
+                                           self.COMPLETE_TIMEOUT),
+            'inspect_request': kwargs.pop("inspect_timeout",
+                                          self.INSPECT_TIMEOUT),
+            'is_complete_request': kwargs.pop("is_complete_timeout",
+                                              self.IS_COMPLETE_TIMEOUT)
+        }
+        # Per request type counts of requests, and of requests that
+        # timed out, were superseded by newer ones or failed
+        self.request_stats = {}
+        # Supersedable requests in progress, per type and client
+        self._latest_requests = {}
 
         sign_scheme = self.connection_props["signature_scheme"]
         key = self.connection_props["key"]
         self.message_manager = message.MessageManager(sign_scheme, key)
 
-        self.zmq_factory = txzmq.ZmqFactory()
-        self.zmq_factory.registerForShutdown()
+        self.zmq_factory = kwargs.pop("zmq_factory", None)
+        if self.zmq_factory is None:
+            self.zmq_factory = txzmq.ZmqFactory()
+            self.zmq_factory.registerForShutdown()
         self.execution_count = 0
         self.shutdown_bcast = None
         self.stop_deferred = defer.Deferred()
@@ -87,6 +175,8 @@ class KernelBase(object):
         
         transport = self.connection_props["transport"]
         addr = self.connection_props["ip"]
+        socket_settings = kwargs.pop("socket_options", None) or []
+        options = lambda name: sockets.socket_options(socket_settings, name)
 
         # the shell_sock is circular-referencing
         # it is only allocated once on app up and down tho
@@ -94,28 +184,36 @@ class KernelBase(object):
                                         self.connection_props["shell_port"])
         self.shell_sock = sockets.ShellConnection(self.handle_message,
                                                   self.zmq_factory,
-                                                  shell_endpoint)
+                                                  shell_endpoint,
+                                                  options("shell"))
 
         ctrl_endpoint = self._endpoint(transport, addr,
                                        self.connection_props["control_port"])
         self.ctrl_sock = sockets.ShellConnection(self.handle_message,
                                                  self.zmq_factory,
-                                                 ctrl_endpoint)
+                                                 ctrl_endpoint,
+                                                 options("control"))
         
         iopub_endpoint = self._endpoint(transport, addr,
                                         self.connection_props["iopub_port"])
         self.iopub_sock = sockets.IOPubConnection(self.zmq_factory,
-                                                  iopub_endpoint)
+                                                  iopub_endpoint,
+                                                  options("iopub"))
         
         stdin_endpoint = self._endpoint(transport, addr,
                                         self.connection_props["stdin_port"])
         self.stdin_sock = sockets.StdinConnection(self.zmq_factory,
-                                                  stdin_endpoint)
+                                                  stdin_endpoint,
+                                                  options("stdin"))
         
         hb_endpoint = self._endpoint(transport, addr,
                                      self.connection_props["hb_port"])
-        self.hb_sock = sockets.HearbeatConnection(self.zmq_factory,
-                                                  hb_endpoint)
+        if kwargs.pop("reactor_heartbeat", False):
+            self.hb_sock = sockets.HearbeatConnection(self.zmq_factory,
+                                                      hb_endpoint,
+                                                      options("hb"))
+        else:
+            self.hb_sock = sockets.HeartbeatThread(hb_endpoint, options("hb"))
 
     @defer.inlineCallbacks
     def run(self):
@@ -126,16 +224,72 @@ class KernelBase(object):
         :rtype: twisted.internet.deferred.Deferred
         """
 
+        if self.metrics_exporter:
+            self.metrics_exporter.start()
+        if isinstance(self.hb_sock, sockets.HeartbeatThread):
+            self.hb_sock.start()
         self.send_update("status", {'execution_state': 'starting'})
         yield self.history_manager.connect()
         yield self.do_startup()
         self.send_update("status", {'execution_state': 'idle'})
         val = yield self.stop_deferred
         yield self.do_shutdown()
+        self.log.debug("Introspection request stats: {stats}",
+                       stats=self.request_stats)
+        yield self.history_manager.close()
+        if self.metrics_exporter:
+            yield self.metrics_exporter.stop()
+        self.tracer.close()
+        if isinstance(self.hb_sock, sockets.HeartbeatThread):
+            self.hb_sock.stop()
         if self.shutdown_bcast:
-            self.iopub_sock.publish(self.shutdown_bcast)
+            # Queued like any other message, so it can't
+            # overtake output of earlier cells
+            bcast = self.shutdown_bcast
+            self.iopub_queue.submit(0, lambda: bcast).addCallback(
+                self._publish, "shutdown_reply", None, None)
+        yield self._flush_iopub(self.IOPUB_SHUTDOWN_TIMEOUT)
+        if self._iopub_retry is not None and self._iopub_retry.active():
+            self._iopub_retry.cancel()
+        # The factory may outlive the kernel, see shared_resources
+        for sock in (self.shell_sock, self.ctrl_sock, self.iopub_sock,
+                     self.stdin_sock, self.hb_sock):
+            if isinstance(sock, txzmq.ZmqConnection):
+                sock.shutdown()
         defer.returnValue(val)
 
+    @classmethod
+    def shared_resources(cls, options, reactor=None):
+        """
+        Build the resources that kernels running in the same
+        process share (see ilua.host), instead of each kernel
+        building its own
+
+        :param options: keyword arguments the kernels are built with
+        :type options: dict
+        :param reactor: Twisted reactor to use, defaults
+                        to the global one
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        :return: keyword arguments to build the kernels with,
+                 on top of `options`
+        :rtype: dict
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        zmq_factory = txzmq.ZmqFactory()
+        zmq_factory.registerForShutdown()
+        return {
+            'zmq_factory': zmq_factory,
+            'offloader': offload.Offloader(
+                options.get("offload_threshold",
+                            offload.DEFAULT_THRESHOLD // 1024) * 1024,
+                options.get("offload_threads", 2), reactor=reactor),
+            'history_db': history.HistoryManager.open_db(
+                cls.get_history_path(), reactor)
+        }
+
     @defer.inlineCallbacks
     def handle_message(self, request_socket, sender_id, message_parts):
         """
@@ -157,10 +311,21 @@ class KernelBase(object):
         :rtype: list
         """
 
+        started = time.time()
+        msg_type = None
+        socket_name = "control" if request_socket is self.ctrl_sock \
+                      else "shell"
+        if self.metrics.enabled:
+            self.metrics.inc("received_bytes_total",
+                             sum(len(part) for part in message_parts),
+                             socket=socket_name)
         try:
             # extra ids? probebly will never be used
             # TODO: catch parsing errors
             msg, _ = self.message_manager.parse(message_parts)
+            if self.tracer.enabled:
+                self.tracer.span(msg['header']['msg_id'], "parse", started,
+                                 time.time())
 
             self.curr_parent = msg['header']
 
@@ -193,13 +358,28 @@ class KernelBase(object):
                     content = yield self.do_execute(**msg['content'])
             elif msg_type == 'is_complete_request':
                 resp_type = "is_complete_reply"
-                content = yield self.do_is_complete(**msg['content'])
+                content = yield self._bounded_request(
+                    msg, self.do_is_complete, {'status': 'unknown'})
             elif msg_type == 'complete_request':
                 resp_type = 'complete_reply'
-                content = yield self.do_complete(**msg['content'])
+                cursor_pos = msg['content']['cursor_pos']
+                content = yield self._bounded_request(
+                    msg, self.do_complete, {
+                        'matches': [],
+                        'cursor_start': cursor_pos,
+                        'cursor_end': cursor_pos,
+                        'metadata': {},
+                        'status': 'ok'
+                    }, supersedable=True)
             elif msg_type == 'inspect_request':
                 resp_type = 'inspect_reply'
-                content = yield self.do_inspect(**msg['content'])
+                content = yield self._bounded_request(
+                    msg, self.do_inspect, {
+                        'status': 'ok',
+                        'found': False,
+                        'data': {},
+                        'metadata': {}
+                    }, supersedable=True)
             elif msg_type == 'history_request':
                 resp_type = 'history_reply'
                 content = yield self.do_history(**msg['content'])
@@ -210,7 +390,6 @@ class KernelBase(object):
                 self.shutdown_bcast =\
                     self.message_manager.build('shutdown_reply', content,
                                                msg['header'])
-                self.signal_stop()
             elif msg_type == 'interrupt_request':
                 resp_type = 'interrupt_reply'
                 content = yield self.do_interrupt(**msg['content'])
@@ -222,14 +401,97 @@ class KernelBase(object):
                                content=msg['content'])
                 defer.returnValue(None)
             
-            msg_bin = self.message_manager.build(resp_type, content,
-                                                msg['header'])
+            replying = time.time()
+            msg_bin = yield self.offloader.run(
+                offload.estimate_size(content) if self.offloader.pool else 0,
+                self.message_manager.build, resp_type, content,
+                msg['header'])
             request_socket.sendMultipart(sender_id, msg_bin)
+            if self.tracer.enabled:
+                self.tracer.span(msg['header']['msg_id'], "reply", replying,
+                                 time.time())
+            if self.metrics.enabled:
+                self.metrics.inc("sent_bytes_total",
+                                 sum(len(part) for part in msg_bin),
+                                 socket=socket_name)
         except Exception:
             self.log.failure("Uncought exception in message handler")
             self.signal_stop()
         finally:
             self.send_update("status", {'execution_state': 'idle'})
+            if msg_type == 'shutdown_request':
+                # Once replied, stopping closes the sockets
+                self.signal_stop()
+            if msg_type is not None:
+                self.metrics.inc("requests_total", msg_type=msg_type)
+                self.metrics.observe("request_latency_seconds",
+                                     time.time() - started,
+                                     msg_type=msg_type)
+                if self.tracer.enabled:
+                    self.tracer.span(msg['header']['msg_id'], msg_type,
+                                     started, time.time())
+
+    def _bounded_request(self, msg, handler, fallback, supersedable=False):
+        """
+        Handle an introspection request, replying with `fallback`
+        if its deadline passes first, or if a newer request of
+        the same type from the same client supersedes it
+
+        :param msg: parsed request
+        :type msg: dict
+        :param handler: request handler, called with the request content
+        :type handler: function
+        :param fallback: reply content to use instead
+        :type fallback: dict
+        :param supersedable: whether newer requests supersede this one
+        :type supersedable: bool
+        :return: reply content
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        msg_type = msg['header']['msg_type']
+        stats = self.request_stats.setdefault(msg_type, {
+            'requests': 0,
+            'timeouts': 0,
+            'superseded': 0,
+            'errors': 0
+        })
+        stats['requests'] += 1
+
+        deferred = defer.maybeDeferred(handler, **msg['content'])
+
+        if supersedable:
+            key = (msg_type, msg['header'].get('session'))
+            previous = self._latest_requests.get(key)
+            self._latest_requests[key] = deferred
+            if previous is not None:
+                previous.cancel()
+
+            def forget(result):
+                if self._latest_requests.get(key) is deferred:
+                    del self._latest_requests[key]
+                return result
+            deferred.addBoth(forget)
+
+        timeout = self.request_deadlines.get(msg_type)
+        if timeout:
+            deferred.addTimeout(timeout, self.reactor)
+
+        def fall_back(failure):
+            failure.trap(defer.CancelledError, defer.TimeoutError,
+                         *self.fallback_errors)
+            if failure.check(defer.TimeoutError):
+                reason = 'timeouts'
+            elif failure.check(defer.CancelledError):
+                reason = 'superseded'
+            else:
+                reason = 'errors'
+            stats[reason] += 1
+            self.log.debug("Gave up on {msg_type} ({reason})",
+                           msg_type=msg_type, reason=reason)
+            return fallback
+        deferred.addErrback(fall_back)
+        return deferred
 
     def do_kernel_info(self):
         """
@@ -346,8 +608,11 @@ class KernelBase(object):
         stripped_code = code.rstrip("?")
         cursor_pos = len(stripped_code)
         detail_level = min(1, len(code) - len(stripped_code) - 1)
-        inspect_content = yield self.do_inspect(stripped_code, cursor_pos,
-                                                detail_level)
+        try:
+            inspect_content = yield self.do_inspect(stripped_code, cursor_pos,
+                                                    detail_level)
+        except self.fallback_errors:
+            inspect_content = {'found': False}
         
         response = {
             'status': 'ok',
@@ -399,25 +664,32 @@ class KernelBase(object):
         This method is NOT to be overidden by sub
         classes
 
-        Note: currently, only 'tail' access is
-        implemented, so any other request yields
-        empty response
+        Outputs are not recorded, so when `output`
+        is requested every entry carries a None
+        output
 
-        :return: response containing inspect reply
+        :return: response containing history reply
         :rtype: dict or
                 twisted.internet.deferred.Deferred
         """
 
-        # Most of the arguments seem too rare to be taken care of seriously
-        if hist_access_type != "tail" or not n or output:
-            defer.returnValue({
-                'history': []
-            })
+        if hist_access_type == "tail" and n:
+            result = yield self.history_manager.tail(n, unique)
+        elif hist_access_type == "range":
+            result = yield self.history_manager.get_range(session, start,
+                                                          stop)
+        elif hist_access_type == "search":
+            result = yield self.history_manager.search(pattern, n, unique)
         else:
-            result = yield self.history_manager.tail(n)
-            defer.returnValue({
-                'history': result
-            })
+            result = []
+
+        if output:
+            result = [(entry_session, line, (source, None))
+                      for entry_session, line, source in result]
+
+        defer.returnValue({
+            'history': result
+        })
     
     def do_startup(self):
         """
@@ -448,8 +720,156 @@ class KernelBase(object):
         :param content: message content
         :type content: dict
         """
-        msg = self.message_manager.build(msg_type, content, self.curr_parent)
-        self.iopub_sock.publish(msg)
+        started = time.time() if self.tracer.enabled else None
+        parent = self.curr_parent
+        if self.iopub_backlog and not self.iopub_queue.pending:
+            # Subscribers are behind, queue it up (merged
+            # with earlier output if it is output too)
+            self.iopub_backlog.add(msg_type, content, parent, started)
+            self._schedule_iopub_retry()
+            return
+        size = offload.estimate_size(content) if self.offloader.pool else 0
+        deferred = self.iopub_queue.submit(size, self.message_manager.build,
+                                           msg_type, content, parent)
+        deferred.addCallback(self._publish, msg_type, parent, started)
+        deferred.addErrback(lambda reason: self.log.failure(
+            "Failed to publish a {msg_type} message", reason,
+            msg_type=msg_type))
+
+    def _publish(self, msg, msg_type, parent, started):
+        if self.iopub_backlog or not self.iopub_sock.publish(msg):
+            self.iopub_backlog.add_built(msg, msg_type, parent, started)
+            self._schedule_iopub_retry()
+            return
+        self._published(msg, msg_type, parent, started)
+
+    def _schedule_iopub_retry(self):
+        if self._iopub_retry is None:
+            self._iopub_retry = self.reactor.callLater(
+                self.IOPUB_RETRY_INTERVAL, self._drain_iopub_backlog)
+
+    def _drain_iopub_backlog(self):
+        """
+        Send held back IOPub messages, until
+        subscribers fall behind again
+        """
+
+        self._iopub_retry = None
+        backlog = self.iopub_backlog
+        while backlog:
+            msg, msg_type, parent, started = backlog.peek(
+                self.message_manager.build)
+            if not self.iopub_sock.publish(msg):
+                self._schedule_iopub_retry()
+                return
+            backlog.pop()
+            self._published(msg, msg_type, parent, started)
+        dropped = backlog.stats['dropped_bytes'] - self._reported_drops
+        if dropped:
+            self._reported_drops = backlog.stats['dropped_bytes']
+            self.log.warn("Dropped {dropped} bytes of output, IOPub "
+                          "subscribers could not keep up", dropped=dropped)
+
+    @defer.inlineCallbacks
+    def _flush_iopub(self, timeout):
+        """
+        Wait for queued and held back IOPub messages to be
+        sent, the retries of the backlog send them
+
+        :param timeout: seconds to wait at most
+        :type timeout: float
+        """
+
+        deadline = self.reactor.seconds() + timeout
+        while self.iopub_backlog or self.iopub_queue.pending:
+            if self.reactor.seconds() >= deadline:
+                self.log.warn("Dropped {count} IOPub messages, subscribers "
+                              "could not keep up",
+                              count=len(self.iopub_backlog) +
+                              self.iopub_queue.pending)
+                break
+            yield task.deferLater(self.reactor, self.IOPUB_RETRY_INTERVAL,
+                                  lambda: None)
+
+    def _published(self, msg, msg_type, parent, started):
+        if started is not None and parent:
+            self.tracer.span(parent['msg_id'], "publish " + msg_type,
+                             started, time.time())
+        if self.metrics.enabled:
+            self.metrics.inc("sent_bytes_total", sum(len(part) for part in msg),
+                             socket="iopub")
+            self.metrics.inc("iopub_messages_total", msg_type=msg_type)
+            self.metrics.mark("iopub_messages")
+
+    def _trace_id(self):
+        """
+        :return: msg_id of the request being handled to trace
+                 its spans under, None when not tracing
+        :rtype: string
+        """
+
+        if self.tracer.enabled and self.curr_parent:
+            return self.curr_parent['msg_id']
+        return None
+
+    def _describe_metrics(self):
+        """
+        Document the kernel metrics, and register the
+        collector of the ones kept as stats elsewhere
+        """
+
+        describe = self.metrics.describe
+        describe("requests_total", "Shell and control requests handled")
+        describe("request_latency_seconds", "Seconds to handle requests")
+        describe("received_bytes_total", "Bytes received, per socket")
+        describe("sent_bytes_total", "Bytes sent, per socket")
+        describe("iopub_messages_total", "Messages published on IOPub")
+        describe("iopub_messages_per_second",
+                 "Messages published on IOPub over the last {} "
+                 "seconds".format(metrics.Meter.WINDOW))
+        describe("bounded_requests_total", "Introspection requests, per "
+                 "outcome (requests, timeouts, superseded, errors)")
+        describe("history_write_seconds", "Seconds to write history entries")
+        describe("history_queue_depth", "History entries waiting to be "
+                 "written")
+        describe("history_flushed_entries_total", "History entries written")
+        describe("offloaded_jobs_total", "Decoding, rendering and "
+                 "serializing jobs run off the reactor thread")
+        describe("iopub_queue_depth", "IOPub messages waiting for bigger "
+                 "ones to be built")
+        describe("iopub_backlog_depth", "IOPub messages held back while "
+                 "subscribers catch up")
+        describe("iopub_backlog_bytes", "Output held back while "
+                 "subscribers catch up, in UTF-8 bytes")
+        describe("iopub_deferred_messages_total", "IOPub messages held back "
+                 "while subscribers caught up")
+        describe("iopub_coalesced_messages_total", "Held back output "
+                 "messages merged into earlier ones")
+        describe("iopub_dropped_messages_total", "Output messages cut short "
+                 "while subscribers caught up")
+        describe("iopub_dropped_bytes_total", "Output dropped while "
+                 "subscribers caught up, in UTF-8 bytes")
+        self.metrics.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        for msg_type, stats in self.request_stats.items():
+            for outcome, count in stats.items():
+                yield ("bounded_requests_total", "counter",
+                       {'msg_type': msg_type, 'outcome': outcome}, count)
+        yield ("history_queue_depth", "gauge", {},
+               self.history_manager.queue_depth)
+        yield ("history_flushed_entries_total", "counter", {},
+               self.history_manager.stats['flushed_entries'])
+        yield ("offloaded_jobs_total", "counter", {}, self.offloader.offloaded)
+        yield ("iopub_queue_depth", "gauge", {}, self.iopub_queue.pending)
+        backlog = self.iopub_backlog
+        yield ("iopub_backlog_depth", "gauge", {}, len(backlog))
+        yield ("iopub_backlog_bytes", "gauge", {}, backlog.stream_bytes)
+        for stat in ("deferred", "coalesced", "dropped"):
+            yield ("iopub_{}_messages_total".format(stat), "counter", {},
+                   backlog.stats[stat])
+        yield ("iopub_dropped_bytes_total", "counter", {},
+               backlog.stats['dropped_bytes'])
     
     def signal_stop(self):
         """
@@ -472,7 +892,11 @@ class KernelBase(object):
         easily
         """
 
-        url = "{}://{}:{}".format(transport, addr, port)
+        if transport == "ipc":
+            # addr is a path prefix, and port a suffix of the path
+            url = "ipc://{}-{}".format(addr, port)
+        else:
+            url = "{}://{}:{}".format(transport, addr, port)
         return txzmq.ZmqEndpoint(type, url)
     
     @classmethod
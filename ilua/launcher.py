@@ -0,0 +1,73 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Runs a kernel in a kernel host (see ilua.host) until it
+stops, in place of running a kernel process
+
+Killing the launcher stops the kernel, so frontends manage
+the kernel as if it was this process. The launcher imports
+next to nothing, so it costs little memory
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+
+from jupyter_core.paths import jupyter_runtime_dir
+
+DEFAULT_CONTROL_PATH = os.path.join(jupyter_runtime_dir(), "ilua-host.sock")
+
+def launch(argv=None):
+    """
+    Start a kernel in the host, and wait for it to stop
+
+    :param argv: command-line arguments, defaults to sys.argv
+    :type argv: list
+    :return: exit code
+    :rtype: int
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m ilua.launcher")
+    parser.add_argument('-c', '--connection-file', required=True,
+                        help="Path to existing connection file")
+    parser.add_argument('--control', metavar="PATH",
+                        default=os.environ.get("ILUA_HOST_CONTROL",
+                                               DEFAULT_CONTROL_PATH),
+                        help="Path of the control socket of the host")
+    args = parser.parse_args(argv)
+
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        control.connect(args.control)
+    except socket.error as err:
+        parser.exit(1, "Failed to connect to the host at {}: {}\n".format(
+            args.control, err))
+    # Ending on SIGTERM closes the connection, the host then stops the kernel
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Interrupts are requested by messages, see the kernelspec
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    request = {'command': 'start', 'attach': True,
+               'connection_file': os.path.abspath(args.connection_file)}
+    control.sendall(json.dumps(request).encode("utf8") + b"\n")
+    for line in control.makefile("rb"):
+        message = json.loads(line.decode("utf8"))
+        if message.get("status") == "error":
+            parser.exit(1, "The host failed to start the kernel: {}\n".format(
+                message["error"]))
+        if message.get("event") == "stopped":
+            return 0
+    parser.exit(1, "The host went away\n")
+
+def main():
+    sys.exit(launch())
+
+if __name__ == '__main__':
+    main()
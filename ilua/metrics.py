@@ -0,0 +1,385 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Kernel performance metrics: counters, gauges, latency
+histograms and event rates, exported in the Prometheus
+text format over a local HTTP endpoint, and as a JSON
+file dumped periodically
+"""
+
+import bisect
+import json
+import os
+import time
+from collections import deque
+
+from twisted.internet import defer, task
+from twisted.logger import Logger
+
+# Upper bounds of latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+class Histogram(object):
+    """
+    Counts of observations per bucket, along
+    with their sum
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: (upper bound, observations up to it) pairs
+        :rtype: list
+        """
+
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class Meter(object):
+    """
+    Rate of events over the last WINDOW seconds
+    """
+
+    WINDOW = 10
+
+    def __init__(self, clock):
+        self.clock = clock
+        # (second, events) of the recent seconds
+        self.seconds = deque()
+
+    def mark(self, count=1):
+        now = int(self.clock.seconds())
+        if self.seconds and self.seconds[-1][0] == now:
+            self.seconds[-1][1] += count
+        else:
+            self.seconds.append([now, count])
+            self._expire(now)
+
+    def rate(self):
+        self._expire(int(self.clock.seconds()))
+        return sum(count for _, count in self.seconds) / float(self.WINDOW)
+
+    def _expire(self, now):
+        while self.seconds and self.seconds[0][0] <= now - self.WINDOW:
+            self.seconds.popleft()
+
+class Metrics(object):
+    """
+    Registry of the kernel metrics
+
+    Metrics are created on first use, labelled with keyword
+    arguments. Collectors registered with add_collector report
+    values kept elsewhere (stats dicts, queue lengths) when the
+    metrics are exported
+    """
+
+    enabled = True
+
+    def __init__(self, prefix="ilua", reactor=None):
+        """
+        :param prefix: prefix of exported metric names
+        :type prefix: string
+        :param reactor: Twisted reactor to use, defaults
+                        to the global reactor
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.prefix = prefix
+        # name mapped to help text
+        self.descriptions = {}
+        # name mapped to {label key: value}, per kind
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.meters = {}
+        self._buckets = {}
+        self._collectors = []
+
+    def describe(self, name, help_text, buckets=None):
+        """
+        Document a metric, and set the buckets of histograms
+        """
+
+        self.descriptions[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _label_key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(
+                self._buckets.get(name, DEFAULT_BUCKETS))
+        histogram.observe(value)
+
+    def mark(self, name, count=1, **labels):
+        series = self.meters.setdefault(name, {})
+        key = _label_key(labels)
+        meter = series.get(key)
+        if meter is None:
+            meter = series[key] = Meter(self.reactor)
+        meter.mark(count)
+
+    def add_collector(self, collector):
+        """
+        :param collector: called on export, returns (name, kind,
+                          labels, value) tuples, kind being
+                          "counter" or "gauge"
+        :type collector: function
+        """
+
+        self._collectors.append(collector)
+
+    def _collect(self):
+        """
+        :return: counters and gauges, collected ones included
+        :rtype: tuple
+        """
+
+        counters = dict((name, dict(series))
+                        for name, series in self.counters.items())
+        gauges = dict((name, dict(series))
+                      for name, series in self.gauges.items())
+        for name, series in self.meters.items():
+            gauges[name + "_per_second"] = dict(
+                (key, meter.rate()) for key, meter in series.items())
+        for collector in self._collectors:
+            for name, kind, labels, value in collector():
+                target = counters if kind == "counter" else gauges
+                target.setdefault(name, {})[_label_key(labels)] = value
+        return counters, gauges
+
+    def render_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text format
+        :rtype: string
+        """
+
+        counters, gauges = self._collect()
+        lines = []
+
+        def header(name, kind):
+            full_name = "{}_{}".format(self.prefix, name)
+            help_text = self.descriptions.get(name)
+            if help_text:
+                lines.append("# HELP {} {}".format(full_name, help_text))
+            lines.append("# TYPE {} {}".format(full_name, kind))
+            return full_name
+
+        for kind, metrics in (("counter", counters), ("gauge", gauges)):
+            for name, series in sorted(metrics.items()):
+                full_name = header(name, kind)
+                for key, value in sorted(series.items()):
+                    lines.append("{}{} {}".format(full_name,
+                                                  _format_labels(key),
+                                                  _format_value(value)))
+        for name, series in sorted(self.histograms.items()):
+            full_name = header(name, "histogram")
+            for key, histogram in sorted(series.items()):
+                for bound, count in histogram.cumulative():
+                    lines.append("{}_bucket{} {}".format(
+                        full_name,
+                        _format_labels(key, [("le", _format_value(bound))]),
+                        count))
+                lines.append("{}_sum{} {}".format(full_name,
+                                                  _format_labels(key),
+                                                  _format_value(
+                                                      histogram.sum)))
+                lines.append("{}_count{} {}".format(full_name,
+                                                    _format_labels(key),
+                                                    histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        """
+        :return: the metrics as a JSON-serializable dict, series
+                 are lists of {"labels": ..., "value": ...}
+        :rtype: dict
+        """
+
+        counters, gauges = self._collect()
+
+        def series_list(series, to_value):
+            return [{'labels': dict(key), 'value': to_value(value)}
+                    for key, value in sorted(series.items())]
+
+        identity = lambda value: value
+        return {
+            'time': time.time(),
+            'counters': dict((name, series_list(series, identity))
+                             for name, series in counters.items()),
+            'gauges': dict((name, series_list(series, identity))
+                           for name, series in gauges.items()),
+            'histograms': dict((name, series_list(series, lambda h: {
+                'buckets': [[bound if bound != float("inf") else "+Inf",
+                             count] for bound, count in h.cumulative()],
+                'sum': h.sum,
+                'count': h.count}))
+                               for name, series in self.histograms.items()),
+        }
+
+class NullMetrics(object):
+    """
+    Stand-in for Metrics when collection is disabled,
+    every method does nothing
+    """
+
+    enabled = False
+
+    def describe(self, name, help_text, buckets=None):
+        pass
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def mark(self, name, count=1, **labels):
+        pass
+
+    def add_collector(self, collector):
+        pass
+
+class MetricsExporter(object):
+    """
+    Serves the metrics over HTTP on localhost,
+    and dumps them to a JSON file periodically
+    """
+
+    log = Logger()
+
+    def __init__(self, metrics, port=0, dump_path=None, dump_interval=10.0,
+                 reactor=None):
+        """
+        :param metrics: metrics to export
+        :type metrics: Metrics
+        :param port: local port to serve /metrics on, 0 to not serve
+        :type port: int
+        :param dump_path: JSON file to dump the metrics to, or None
+        :type dump_path: string
+        :param dump_interval: seconds between dumps
+        :type dump_interval: float
+        :param reactor: Twisted reactor to use, defaults
+                        to the global reactor
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.metrics = metrics
+        self.port = port
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self._listening_port = None
+        self._dump_loop = task.LoopingCall(self.dump)
+        self._dump_loop.clock = self.reactor
+
+    def start(self):
+        if self.port:
+            # Imported here, so twisted.web is only loaded when used
+            from twisted.web import resource, server
+
+            metrics = self.metrics
+
+            class MetricsResource(resource.Resource):
+                isLeaf = True
+
+                def render_GET(self, request):
+                    if request.path.rstrip(b"/") not in (b"", b"/metrics"):
+                        request.setResponseCode(404)
+                        return b""
+                    request.setHeader(b"Content-Type",
+                                      b"text/plain; version=0.0.4; "
+                                      b"charset=utf-8")
+                    return metrics.render_prometheus().encode("utf8")
+
+            self._listening_port = self.reactor.listenTCP(
+                self.port, server.Site(MetricsResource()),
+                interface="127.0.0.1")
+            self.log.info("Serving metrics on http://127.0.0.1:{port}/metrics",
+                          port=self.port)
+        if self.dump_path and self.dump_interval > 0:
+            self._dump_loop.start(self.dump_interval, now=False)
+
+    def dump(self):
+        """
+        Write the metrics to the dump file, replacing
+        it only once the new one is complete
+        """
+
+        temp_path = self.dump_path + ".tmp"
+        try:
+            with open(temp_path, "w") as dump:
+                json.dump(self.metrics.as_dict(), dump, indent=2,
+                          sort_keys=True)
+            if os.name == "nt" and os.path.exists(self.dump_path):
+                os.remove(self.dump_path)
+            os.rename(temp_path, self.dump_path)
+        except (IOError, OSError) as err:
+            self.log.warn("Failed to dump metrics: {err}", err=err)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self._dump_loop.running:
+            self._dump_loop.stop()
+        if self.dump_path:
+            self.dump()
+        if self._listening_port is not None:
+            yield self._listening_port.stopListening()
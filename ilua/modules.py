@@ -0,0 +1,341 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Static index of the Lua modules found on package.path,
+used to complete module names and module members before
+the modules are required
+"""
+
+import json
+import os
+import re
+import time
+
+from pygments import token
+from pygments.lexers.scripting import LuaLexer
+from twisted.internet import defer, threads
+from twisted.logger import Logger
+
+from .completion import CompletionIndex
+
+_MODULE_NAME = re.compile(r"^[\w-]+$")
+
+_BLOCK_OPENERS = frozenset(["function", "do", "if", "repeat"])
+_BLOCK_CLOSERS = frozenset(["end", "until"])
+
+def _significant_tokens(lexer, source):
+    """
+    Get the (type, value) tokens of `source`,
+    without whitespace and comments
+    """
+    return [(ttype, value.strip()) for ttype, value in lexer.get_tokens(source)
+            if value.strip() and ttype not in token.Comment]
+
+def _is_punct(tok, chars):
+    return tok is not None and tok[0] in token.Punctuation and tok[1] == chars
+
+def _is_name(tok):
+    return tok is not None and tok[0] in token.Name
+
+def extract_members(lexer, source):
+    """
+    Find the members of the table a module returns,
+    out of the top-level statements of the module
+
+    Understands `function M.f()`, `function M:f()`,
+    `M.x = ...`, `local M = {x = ...}` and `return M`
+    (or `return {x = ...}`)
+
+    :param lexer: Lua lexer
+    :type lexer: pygments.lexers.scripting.LuaLexer
+    :param source: module source
+    :type source: string
+    :return: member names mapped to whether they are functions
+    :rtype: dict
+    """
+
+    tokens = _significant_tokens(lexer, source)
+    get = lambda i: tokens[i] if 0 <= i < len(tokens) else None
+    is_function = lambda i: get(i) == (token.Keyword.Reserved, "function")
+
+    tables = {}
+    exported = None
+    depth = 0
+    braces = 0
+    # Table constructor being read: (table name, brace depth)
+    constructor = None
+
+    for i, (ttype, value) in enumerate(tokens):
+        top_level = depth == 0 and braces == (constructor[1] if constructor
+                                              else 0)
+        if ttype in token.Keyword:
+            if value == "function" and top_level and not constructor and \
+               _is_name(get(i + 1)) and get(i + 2) is not None and \
+               get(i + 2)[1] in (".", ":") and _is_name(get(i + 3)) and \
+               get(i + 4) is not None and get(i + 4)[1].startswith("("):
+                tables.setdefault(get(i + 1)[1], {})[get(i + 3)[1]] = True
+            elif value == "return" and top_level and not constructor:
+                if _is_name(get(i + 1)):
+                    exported = get(i + 1)[1]
+                elif get(i + 1) is not None and \
+                     get(i + 1)[1].startswith("{"):
+                    exported = None
+                    constructor = (None, 1)
+                    tables[None] = {}
+            if value in _BLOCK_OPENERS:
+                depth += 1
+            elif value in _BLOCK_CLOSERS:
+                depth -= 1
+        elif ttype in token.Punctuation:
+            braces += value.count("{") - value.count("}")
+            if constructor and braces < constructor[1]:
+                constructor = None
+        elif ttype in token.Operator and value == "=" and top_level:
+            if constructor:
+                # `name = value` field of the constructor
+                if _is_name(get(i - 1)) and get(i - 2) is not None and \
+                   get(i - 2)[1] in ("{", ",", ";"):
+                    tables[constructor[0]][get(i - 1)[1]] = is_function(i + 1)
+            elif _is_name(get(i - 1)) and _is_punct(get(i - 2), ".") and \
+                 _is_name(get(i - 3)) and \
+                 (get(i - 4) is None or get(i - 4)[1] not in (".", ":")):
+                # `M.x = value`
+                tables.setdefault(get(i - 3)[1], {})[get(i - 1)[1]] = \
+                    is_function(i + 1)
+            elif _is_name(get(i - 1)) and get(i + 1) is not None and \
+                 get(i + 1)[1].startswith("{") and \
+                 (get(i - 2) is None or get(i - 2)[1] not in (".", ":")):
+                # `local M = {` or `M = {`
+                tables.setdefault(get(i - 1)[1], {})
+                if get(i + 1)[1] == "{":
+                    constructor = (get(i - 1)[1], 1)
+
+    return tables.get(exported, {})
+
+def find_modules(package_path, dir_sep=os.sep, max_depth=3,
+                 max_files=20000):
+    """
+    Find the Lua files reachable through the
+    templates of `package_path`
+
+    :param package_path: `package.path` of the interpreter
+    :type package_path: string
+    :param dir_sep: directory separator of module paths
+    :type dir_sep: string
+    :param max_depth: deepest module nesting to look for
+    :type max_depth: int
+    :param max_files: maximal count of files to look at per template,
+                      templates like "./?.lua" may point at big trees
+    :type max_files: int
+    :return: generator of module names and file paths,
+             modules shadowed by earlier templates excluded
+    :rtype: generator
+    """
+
+    seen = set()
+    for template in package_path.split(";"):
+        if template.count("?") != 1:
+            continue
+        prefix, suffix = template.split("?")
+        root = os.path.dirname(prefix) or os.curdir
+        if not os.path.isdir(root):
+            continue
+        root_depth = root.rstrip(os.sep).count(os.sep)
+        visited = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            visited += len(filenames)
+            if visited > max_files:
+                break
+            if dirpath.count(os.sep) - root_depth >= max_depth:
+                dirnames[:] = []
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if not prefix:
+                    path = os.path.relpath(path)
+                if not path.startswith(prefix) or \
+                   not path.endswith(suffix) or \
+                   len(path) <= len(prefix) + len(suffix):
+                    continue
+                parts = path[len(prefix):len(path) - len(suffix)].split(
+                    dir_sep)
+                if not all(_MODULE_NAME.match(part) for part in parts):
+                    continue
+                name = ".".join(parts)
+                if name not in seen:
+                    seen.add(name)
+                    yield name, path
+
+class ModuleIndex(object):
+    """
+    Names and members of the modules on package.path
+
+    Scans run in a thread, and reuse the members of
+    files that did not change since the last scan, as
+    recorded in a JSON file on disk
+    """
+
+    log = Logger()
+
+    # Bumped whenever extraction changes, to invalidate indexes on disk
+    FORMAT_VERSION = 1
+    # Seconds before an index is considered stale
+    RESCAN_INTERVAL = 60.0
+    # Maximal count of indexed modules
+    MAX_MODULES = 5000
+
+    def __init__(self, index_path, reactor=None):
+        """
+        :param index_path: path of the index file, or None
+                           to keep the index in memory only
+        :type index_path: string
+        :param reactor: Twisted reactor to use, defaults
+                        to the global reactor
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.index_path = index_path
+        self.lexer = LuaLexer()
+        self.modules = {}
+        self.names = CompletionIndex([])
+        self.last_scan = None
+        self.scanning = None
+        self._files = None
+
+    @property
+    def stale(self):
+        return self.last_scan is None or \
+               time.time() - self.last_scan > self.RESCAN_INTERVAL
+
+    def scan(self, package_path, dir_sep=os.sep):
+        """
+        Rescan package.path in the background, unless
+        a scan is already running
+
+        :param package_path: `package.path` of the interpreter
+        :type package_path: string
+        :param dir_sep: directory separator of module paths
+        :type dir_sep: string
+        :return: Deferred fired once the index is updated
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if self.scanning is None:
+            self.last_scan = time.time()
+            self.scanning = threads.deferToThreadPool(
+                self.reactor, self.reactor.getThreadPool(),
+                self._scan, package_path, dir_sep)
+            self.scanning.addCallbacks(self._scanned, self._scan_failed)
+        scanning = defer.Deferred()
+        self.scanning.addBoth(lambda result: scanning.callback(None)
+                              or result)
+        return scanning
+
+    def match_modules(self, initial, limit=0):
+        """
+        Get the names of the modules matching `initial`
+
+        :param initial: partially typed module name
+        :type initial: string
+        :param limit: maximal number of matches, 0 for no limit
+        :type limit: int
+        :return: matching module names
+        :rtype: list
+        """
+
+        return self.names.match(initial, limit)
+
+    def get_members(self, module, only_methods=False):
+        """
+        Get the members of a module
+
+        :param module: module name
+        :type module: string
+        :param only_methods: only get functions
+        :type only_methods: bool
+        :return: member names
+        :rtype: list
+        """
+
+        members = self.modules.get(module, {})
+        return [name for name, is_function in members.items()
+                if is_function or not only_methods]
+
+    # Everything below runs in the scanning thread
+
+    def _load(self):
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+        except (IOError, OSError, ValueError):
+            return {}
+        if index.get("version") != self.FORMAT_VERSION:
+            return {}
+        return index.get("files", {})
+
+    def _save(self, files):
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(tmp_path, "w") as index_file:
+            json.dump({"version": self.FORMAT_VERSION, "files": files},
+                      index_file)
+        try:
+            os.rename(tmp_path, self.index_path)
+        except OSError:
+            # rename does not replace existing files on windows
+            os.remove(self.index_path)
+            os.rename(tmp_path, self.index_path)
+
+    def _scan(self, package_path, dir_sep):
+        if self._files is None:
+            self._files = self._load() if self.index_path else {}
+        old_files = self._files
+        files = {}
+        modules = {}
+        for name, path in find_modules(package_path, dir_sep):
+            if len(modules) >= self.MAX_MODULES:
+                break
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = old_files.get(path)
+            if entry is None or entry[:2] != [stat.st_mtime, stat.st_size]:
+                try:
+                    with open(path, "rb") as module_file:
+                        source = module_file.read().decode("utf8", "replace")
+                except (IOError, OSError):
+                    continue
+                entry = [stat.st_mtime, stat.st_size,
+                         extract_members(self.lexer, source)]
+            files[path] = entry
+            modules[name] = entry[2]
+
+        if self.index_path and files != old_files:
+            try:
+                self._save(files)
+            except (IOError, OSError) as err:
+                self.log.warn("Could not save module index: {err}", err=err)
+        self._files = files
+        return modules
+
+    def _scanned(self, modules):
+        self.scanning = None
+        self.modules = modules
+        self.names = CompletionIndex(modules)
+        self.log.debug("Indexed {count} Lua modules", count=len(modules))
+
+    def _scan_failed(self, failure):
+        self.scanning = None
+        self.log.failure("Module indexing failed", failure)
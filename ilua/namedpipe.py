@@ -53,6 +53,8 @@ class CoupleOPipes(object):
 
         proto = protocolFactory.buildProtocol(PipeAddress())
         self.in_pipe.dataReceived = lambda data: proto.dataReceived(data)
+        # The other end closing its pipe means it is gone
+        self.in_pipe.pipeClosed = lambda reason: proto.connectionLost(reason)
         proto.makeConnection(self)
         defer.returnValue(proto)
 
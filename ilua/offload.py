@@ -0,0 +1,177 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Moves big decoding, rendering and serializing jobs
+off the reactor thread, to a bounded thread pool
+"""
+
+from collections import deque
+
+from twisted.internet import defer, threads
+from twisted.python import failure, threadpool
+
+# Sizes past which jobs are offloaded, in bytes
+DEFAULT_THRESHOLD = 256 * 1024
+
+def estimate_size(obj):
+    """
+    Estimate the serialized size of a message content,
+    without serializing it
+
+    :param obj: JSON-serializable object
+    :return: rough size in bytes
+    :rtype: int
+    """
+
+    if isinstance(obj, dict):
+        return sum(len(key) + estimate_size(value)
+                   for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_size(value) for value in obj)
+    if isinstance(obj, (bytes, type(u""))):
+        return len(obj)
+    return 8
+
+def shield(deferred):
+    """
+    Protect a deferred from cancellation, threads can't
+    be stopped, so jobs that run in them go on anyway
+
+    :param deferred: deferred to protect
+    :type deferred: twisted.internet.defer.Deferred
+    :return: deferred fired with the result of `deferred`,
+             cancelling it leaves `deferred` be
+    :rtype: twisted.internet.defer.Deferred
+    """
+
+    shielded = defer.Deferred()
+
+    def forward(result):
+        if not shielded.called:
+            if isinstance(result, failure.Failure):
+                shielded.errback(result)
+            else:
+                shielded.callback(result)
+    deferred.addBoth(forward)
+    return shielded
+
+class Offloader(object):
+    """
+    Runs jobs past a size threshold on a thread pool of
+    its own, and smaller ones right away
+
+    Only pure Python work runs concurrently with the
+    reactor, the json module holds the GIL while it
+    encodes or decodes a document
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, max_threads=2,
+                 reactor=None):
+        """
+        :param threshold: job size (in bytes) from which jobs
+                          are offloaded, 0 never offloads
+        :type threshold: int
+        :param max_threads: size of the thread pool
+        :type max_threads: int
+        :param reactor: Twisted reactor to use, defaults
+                        to the global reactor
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threshold = threshold
+        self.offloaded = 0
+        self.pool = None
+        if threshold and max_threads > 0:
+            self.pool = threadpool.ThreadPool(0, max_threads, "ilua-offload")
+            self.reactor.callWhenRunning(self.pool.start)
+            self.reactor.addSystemEventTrigger("during", "shutdown",
+                                               self.pool.stop)
+
+    def offloads(self, size):
+        """
+        :return: whether jobs of that size are offloaded
+        :rtype: bool
+        """
+
+        return self.pool is not None and size >= self.threshold
+
+    def run(self, size, func, *args, **kwargs):
+        """
+        Run a job, in the thread pool if it is big enough
+
+        :param size: size of the job, in bytes
+        :type size: int
+        :param func: job
+        :type func: function
+        :return: result of the job
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if self.offloads(size):
+            self.offloaded += 1
+            return threads.deferToThreadPool(self.reactor, self.pool, func,
+                                             *args, **kwargs)
+        return defer.maybeDeferred(func, *args, **kwargs)
+
+class OrderedOffloader(object):
+    """
+    Runs jobs through an Offloader, delivering their results
+    in the order the jobs were submitted
+
+    Small jobs submitted while nothing is pending run and
+    deliver right away
+    """
+
+    _PENDING = object()
+
+    def __init__(self, offloader):
+        """
+        :param offloader: offloader to run the jobs with
+        :type offloader: Offloader
+        """
+
+        self.offloader = offloader
+        # [deferred, result] of submitted jobs, oldest first
+        self._jobs = deque()
+
+    @property
+    def pending(self):
+        return len(self._jobs)
+
+    def submit(self, size, func, *args, **kwargs):
+        """
+        Run a job, see Offloader.run
+
+        :return: result of the job, fired after the
+                 results of earlier jobs
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if not self._jobs and not self.offloader.offloads(size):
+            return defer.maybeDeferred(func, *args, **kwargs)
+
+        deferred = defer.Deferred()
+        job = [deferred, self._PENDING]
+        self._jobs.append(job)
+
+        def done(result):
+            job[1] = result
+            self._deliver()
+        self.offloader.run(size, func, *args, **kwargs).addBoth(done)
+        return deferred
+
+    def _deliver(self):
+        while self._jobs and self._jobs[0][1] is not self._PENDING:
+            deferred, result = self._jobs.popleft()
+            if isinstance(result, failure.Failure):
+                deferred.errback(result)
+            else:
+                deferred.callback(result)
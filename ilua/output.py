@@ -0,0 +1,328 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Per-cell output limiting, spilling output past the
+limit to files that can be paged, grepped and tailed
+without loading them whole
+"""
+
+import io
+import os
+import re
+
+from collections import OrderedDict
+
+from twisted.internet import threads
+from twisted.logger import Logger
+
+def format_size(size):
+    """
+    Format a byte count for humans
+
+    :param size: byte count
+    :type size: int
+    :return: formatted size
+    :rtype: string
+    """
+
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "{:.1f}{}".format(size, unit) if unit != "B" else \
+                   "{}B".format(size)
+        size /= 1024.0
+    return "{:.1f}GB".format(size)
+
+class SpillFile(object):
+    """
+    Output of a single cell, past the output limit
+
+    The reading methods block, and are meant to
+    run in a thread
+    """
+
+    # Bytes read at a time
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path, execution_count):
+        """
+        :param path: spill file path
+        :type path: string
+        :param execution_count: execution count of the cell
+        :type execution_count: int
+        """
+
+        self.path = path
+        self.execution_count = execution_count
+        self.size = 0
+        self.file = io.open(path, "w", encoding="utf8", newline="")
+        # Byte offsets of every page_lines'th line, found so far
+        self.page_lines = None
+        self.page_offsets = [0]
+
+    def write(self, text):
+        self.file.write(text)
+
+    def close(self):
+        self.file.close()
+        self.size = os.path.getsize(self.path)
+
+    def read_page(self, page, page_lines):
+        """
+        Read a page of lines
+
+        :param page: page number, from 0
+        :type page: int
+        :param page_lines: lines per page
+        :type page_lines: int
+        :return: the page text, empty past the last page
+        :rtype: string
+        """
+
+        if page_lines != self.page_lines:
+            self.page_lines = page_lines
+            self.page_offsets = [0]
+
+        with open(self.path, "rb") as spill:
+            # Extend the sparse line index as far as the page
+            offset = self.page_offsets[-1]
+            spill.seek(offset)
+            line = 0
+            while len(self.page_offsets) <= page + 1:
+                chunk = spill.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                pos = 0
+                while True:
+                    pos = chunk.find(b"\n", pos) + 1
+                    if not pos:
+                        break
+                    line += 1
+                    if line == page_lines:
+                        line = 0
+                        self.page_offsets.append(offset + pos)
+                offset += len(chunk)
+                # Keep counting from the last offset that was recorded
+                if len(self.page_offsets) > page + 1:
+                    break
+
+            if page >= len(self.page_offsets):
+                return u""
+            spill.seek(self.page_offsets[page])
+            if page + 1 < len(self.page_offsets):
+                data = spill.read(self.page_offsets[page + 1] -
+                                  self.page_offsets[page])
+            else:
+                data = spill.read()
+        return data.decode("utf8", "replace")
+
+    def grep(self, pattern, max_matches):
+        """
+        Find the lines matching a regular expression
+
+        :param pattern: regular expression
+        :type pattern: string
+        :param max_matches: maximal count of lines to return
+        :type max_matches: int
+        :return: (line number, line) of matching lines
+        :rtype: list
+        """
+
+        regex = re.compile(pattern)
+        matches = []
+        with open(self.path, "rb") as spill:
+            for number, line in enumerate(spill, 1):
+                line = line.decode("utf8", "replace").rstrip(u"\n")
+                if regex.search(line):
+                    matches.append((number, line))
+                    if len(matches) >= max_matches:
+                        break
+        return matches
+
+    def tail(self, lines):
+        """
+        Read the last lines, reading blocks from the end
+
+        :param lines: count of lines
+        :type lines: int
+        :return: the last lines
+        :rtype: string
+        """
+
+        with open(self.path, "rb") as spill:
+            spill.seek(0, os.SEEK_END)
+            end = spill.tell()
+            pos = end
+            blocks = []
+            newlines = 0
+            # One more newline than lines, unless the start is reached
+            while pos > 0 and newlines <= lines:
+                size = min(self.CHUNK_SIZE, pos)
+                pos -= size
+                spill.seek(pos)
+                block = spill.read(size)
+                blocks.insert(0, block)
+                newlines += block.count(b"\n")
+        data = b"".join(blocks)
+        if data.endswith(b"\n"):
+            data = data[:-1]
+        return b"\n".join(data.split(b"\n")[-lines:]).decode("utf8",
+                                                              "replace")
+
+class OutputLimiter(object):
+    """
+    Keeps cell output under a limit, spilling
+    the rest of it to files
+    """
+
+    log = Logger()
+
+    # Count of spill files kept, the oldest are removed
+    MAX_SPILLS = 16
+    # Lines per page of spilled output
+    PAGE_LINES = 100
+    # Maximal count of matching lines to show
+    MAX_GREP_MATCHES = 200
+
+    def __init__(self, spill_dir, limit, tag=None, reactor=None):
+        """
+        :param spill_dir: directory to spill output to
+        :type spill_dir: string
+        :param limit: characters of output allowed per cell,
+                      0 for no limit
+        :type limit: int
+        :param tag: part of spill file names telling apart kernels
+                    spilling to the same directory, defaults to
+                    the process id
+        :type tag: string
+        :param reactor: Twisted reactor to use, defaults
+                        to the global reactor
+        :param reactor: Twisted.internet.posixbase.PosixReactorBase,
+                        optional
+        """
+
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.spill_dir = spill_dir
+        self.limit = limit
+        self.tag = tag or str(os.getpid())
+        self.spills = OrderedDict()
+        self.execution_count = None
+        self.used = 0
+        self.spill = None
+
+    def start_cell(self, execution_count):
+        """
+        Start counting output of a new cell
+
+        :param execution_count: execution count of the cell
+        :type execution_count: int
+        """
+
+        self.execution_count = execution_count
+        self.used = 0
+        self.spill = None
+
+    def filter(self, text):
+        """
+        Count output of the current cell
+
+        :param text: output text
+        :type text: string
+        :return: the part of text to publish
+        :rtype: string
+        """
+
+        if not self.limit or self.execution_count is None:
+            return text
+        allowed = max(0, self.limit - self.used)
+        self.used += len(text)
+        if len(text) <= allowed:
+            return text
+        if self.spill is None:
+            self.spill = self._new_spill()
+        self.spill.write(text[allowed:])
+        return text[:allowed]
+
+    def finish_cell(self):
+        """
+        Stop counting output of the current cell
+
+        :return: truncation notice, or None if the
+                 output was not truncated
+        :rtype: string
+        """
+
+        self.execution_count = None
+        spill, self.spill = self.spill, None
+        if spill is None:
+            return None
+        spill.close()
+        return (u"\nOutput exceeded {}, the remaining {} were written to {}"
+                u"\nUse `%output page|grep|tail` to view them\n").format(
+                    format_size(self.limit), format_size(spill.size),
+                    spill.path)
+
+    def get_spill(self, execution_count=None):
+        """
+        Get the spilled output of a cell
+
+        :param execution_count: execution count of the cell,
+                                defaults to the latest spill
+        :type execution_count: int
+        :return: spilled output, or None
+        :rtype: SpillFile
+        """
+
+        if execution_count is None:
+            return next(reversed(self.spills.values()), None) \
+                   if self.spills else None
+        return self.spills.get(execution_count)
+
+    def page(self, spill, page):
+        return threads.deferToThreadPool(self.reactor,
+                                         self.reactor.getThreadPool(),
+                                         spill.read_page, page,
+                                         self.PAGE_LINES)
+
+    def grep(self, spill, pattern):
+        return threads.deferToThreadPool(self.reactor,
+                                         self.reactor.getThreadPool(),
+                                         spill.grep, pattern,
+                                         self.MAX_GREP_MATCHES)
+
+    def tail(self, spill, lines):
+        return threads.deferToThreadPool(self.reactor,
+                                         self.reactor.getThreadPool(),
+                                         spill.tail, lines)
+
+    def cleanup(self):
+        """
+        Remove all spill files
+        """
+
+        while self.spills:
+            self._remove_oldest()
+
+    def _new_spill(self):
+        path = os.path.join(self.spill_dir, "ilua_output_{}_{}.txt".format(
+            self.tag, self.execution_count))
+        spill = SpillFile(path, self.execution_count)
+        self.spills[self.execution_count] = spill
+        while len(self.spills) > self.MAX_SPILLS:
+            self._remove_oldest()
+        return spill
+
+    def _remove_oldest(self):
+        _, spill = self.spills.popitem(last=False)
+        try:
+            if not spill.file.closed:
+                spill.file.close()
+            os.remove(spill.path)
+        except OSError as err:
+            self.log.warn("Could not remove {path}: {err}", path=spill.path,
+                          err=err)
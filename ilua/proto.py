@@ -10,12 +10,26 @@ protocols used during communiction with
 lua subprocess
 """
 
+import itertools
 import json
+import time
+from collections import deque
 
 from twisted.internet import protocol, defer
 from twisted.protocols import basic
 from twisted.logger import Logger
 
+from .metrics import NullMetrics
+from .offload import Offloader, OrderedOffloader
+from .tracing import NullTracer
+
+class InterpreterDied(Exception):
+    """
+    The interpreter exited, or closed its pipes,
+    before answering a request
+    """
+    pass
+
 class OutputCapture(protocol.ProcessProtocol):
     """
     A protocol for capturing and logging any
@@ -24,13 +38,17 @@ class OutputCapture(protocol.ProcessProtocol):
 
     log = Logger()
 
-    def __init__(self, message_sink):
+    def __init__(self, message_sink, exit_handler=None):
         """
         :param message_sink: output handler
         :type message_sink: function
+        :param exit_handler: called with the reason when
+                             the process ends
+        :type exit_handler: function
         """
 
         self.message_sink = message_sink
+        self.exit_handler = exit_handler
 
     def connectionMade(self):
         self.log.debug("Process is running")
@@ -44,38 +62,222 @@ class OutputCapture(protocol.ProcessProtocol):
         self.log.debug("Received stdout data: {data}", data=repr(data))
         self.message_sink("stderr", data.decode("utf8", "replace"))
 
+    def processEnded(self, reason):
+        self.log.debug("Process ended: {reason}", reason=reason.value)
+        if self.exit_handler:
+            self.exit_handler(reason)
+
 class InterpreterProtocol(basic.NetstringReceiver):
     """
     Child (Lua) interpreter command protocol
     This class shapes the communication API
     into a single method used to command the
     interpreter
+
+    Requests are queued on our side and sent one at
+    a time, so cancelled requests that were not sent
+    yet never reach the interpreter
+
+    Output frames the interpreter sends while code runs
+    are passed to the message sink as they come, ahead
+    of the response they precede
+
+    With a mailbox, read-only requests made while code
+    runs are appended to the mailbox file, where the
+    interpreter picks them up mid-execution. Requests it
+    did not get to are resent after the execution
+
+    Requests can be made before the connection is made,
+    they are sent once it is. When the connection is lost,
+    requests that were not answered fail with InterpreterDied
+
+    Big responses are decoded off the reactor thread,
+    responses are still handled in the order they came
     """
 
     log = Logger()
-    queue = defer.DeferredQueue()
+
+    # Completions of big tables and big return values easily
+    # exceed the default (~100KB)
+    MAX_LENGTH = 2 ** 31 - 1
+
+    def __init__(self, message_sink=None, mailbox_path=None, metrics=None,
+                 tracer=None, offloader=None):
+        """
+        :param message_sink: output handler
+        :type message_sink: function
+        :param mailbox_path: path of the mailbox file, or None
+        :type mailbox_path: string
+        :param metrics: metrics registry to record round
+                        trip times in, defaults to none
+        :type metrics: ilua.metrics.Metrics, optional
+        :param tracer: tracer to record request spans
+                       with, defaults to none
+        :type tracer: ilua.tracing.Tracer, optional
+        :param offloader: offloader to decode big responses
+                          with, defaults to decoding in place
+        :type offloader: ilua.offload.Offloader, optional
+        """
+
+        self.message_sink = message_sink
+        self.mailbox_path = mailbox_path
+        self.metrics = metrics or NullMetrics()
+        self.tracer = tracer or NullTracer()
+        self.responses = OrderedOffloader(offloader or Offloader(0))
+        # (encoded request, deferred, type, trace) of requests not
+        # sent yet, trace being (trace id, time queued) or None
+        self.pending = deque()
+        # deferred of the request the interpreter is handling
+        self.in_flight = None
+        self.in_flight_type = None
+        self.in_flight_sent = None
+        self.in_flight_trace = None
+        # request id mapped to (encoded request, deferred, type, trace)
+        # of requests in the mailbox
+        self.mailbox_requests = {}
+        self._request_ids = itertools.count()
+        # error requests fail with once the connection is lost
+        self.lost = None
+        # times the response being handled was received and decoded
+        self._received = None
+        self._decoded = None
 
     def connectionMade(self):
         self.log.debug("Interpreter connections eastablished")
+        self._sendNext()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.log.debug("Interpreter connections lost")
+        if self.lost is None:
+            self.abort(InterpreterDied("Lost connection to the interpreter"))
+
+    def abort(self, error):
+        """
+        Fail all requests that were not answered yet,
+        and all requests made from now on
+
+        :param error: exception to fail the requests with
+        :type error: Exception
+        """
+
+        self.lost = error
+        entries = list(self.pending) + list(self.mailbox_requests.values())
+        in_flight, self.in_flight = self.in_flight, None
+        self.in_flight_type = None
+        self.in_flight_trace = None
+        self.pending.clear()
+        self.mailbox_requests.clear()
+        if in_flight is not None:
+            entries.insert(0, (None, in_flight, None, None))
+        for _, deferred, _, _ in entries:
+            if not deferred.called:
+                deferred.errback(error)
     
     def stringReceived(self, string):
+        received = time.time() if self.tracer.enabled else None
+        self.responses.submit(len(string), self._decodeResponse, string,
+                              received).addCallbacks(self._responseDecoded,
+                                                     self._decodeFailed)
+
+    @staticmethod
+    def _decodeResponse(string, received):
+        # Runs in a thread for big responses
         response = json.loads(string.decode("utf8", "ignore"))
+        return response, received, \
+            time.time() if received is not None else None
+
+    def _responseDecoded(self, result):
+        response, self._received, self._decoded = result
         self.responseReceived(response)
+
+    def _decodeFailed(self, reason):
+        self.log.failure("Failed to decode an interpreter response", reason)
+        # The interpreter is killed once its pipes are closed
+        self.transport.loseConnection()
     
-    def sendRequest(self, request):
+    def sendRequest(self, request, read_only=False, trace_id=None):
         """
         Send a request to the child interpreter,
         and wait for response
         
         :param request: request object (dict)
         :type request: dict
-        :return: response
-        :rtype: dict
+        :param read_only: whether the request may be served while
+                          code runs (is_complete, complete and info)
+        :type read_only: bool
+        :param trace_id: msg_id of the kernel request this request
+                         serves, to trace it under
+        :type trace_id: string
+        :return: response, cancel the deferred to drop
+                 the request
+        :rtype: twisted.internet.defer.Deferred
         """
 
-        request = json.dumps(request).encode("utf8")
-        self.sendString(request)
-        return self.queue.get()
+        deferred = defer.Deferred(self._cancelRequest)
+        trace = None
+        if trace_id is not None and self.tracer.enabled:
+            trace = (trace_id, time.time())
+        if self.lost is not None:
+            deferred.errback(self.lost)
+        elif read_only and self.mailbox_path and \
+           self.in_flight_type == "execute":
+            request = dict(request, request_id=next(self._request_ids))
+            encoded = json.dumps(request).encode("utf8")
+            self.mailbox_requests[request['request_id']] = \
+                (encoded, deferred, request['type'], trace)
+            with open(self.mailbox_path, "ab") as mailbox:
+                mailbox.write(str(len(encoded)).encode("ascii") + b":" +
+                              encoded + b",")
+        else:
+            self.pending.append((json.dumps(request).encode("utf8"),
+                                 deferred, request['type'], trace))
+            self._sendNext()
+        return deferred
+
+    def _cancelRequest(self, deferred):
+        """
+        Drop a cancelled request if it was not sent yet,
+        the response of a sent request is discarded
+        """
+
+        for entry in self.pending:
+            if entry[1] is deferred:
+                self.pending.remove(entry)
+                self.log.debug("Dropped a queued request")
+                break
+        for request_id, entry in list(self.mailbox_requests.items()):
+            if entry[1] is deferred:
+                del self.mailbox_requests[request_id]
+                break
+
+    def _sendNext(self):
+        if self.in_flight is None and self.pending and self.connected and \
+           self.lost is None:
+            request, self.in_flight, self.in_flight_type, \
+                self.in_flight_trace = self.pending.popleft()
+            self.in_flight_sent = time.time()
+            if self.in_flight_trace is not None:
+                trace_id, queued = self.in_flight_trace
+                self.tracer.span(trace_id, "interpreter queue", queued,
+                                 self.in_flight_sent,
+                                 request_type=self.in_flight_type)
+            self.sendString(request)
+
+    def _emptyMailbox(self):
+        """
+        Requeue the mailbox requests the interpreter did
+        not serve, ahead of everything else
+        """
+
+        with open(self.mailbox_path, "wb"):
+            pass
+        leftovers = sorted(self.mailbox_requests.items(), reverse=True)
+        self.mailbox_requests.clear()
+        for _, entry in leftovers:
+            self.pending.appendleft(entry)
+        if leftovers:
+            self.log.debug("Resending {count} mailbox requests",
+                           count=len(leftovers))
     
     def responseReceived(self, response):
         """
@@ -85,4 +287,61 @@ class InterpreterProtocol(basic.NetstringReceiver):
         :type response: dict
         """
 
-        self.queue.put(response)
\ No newline at end of file
+        if response.get('type') == 'stream':
+            if self.message_sink:
+                self.message_sink(response['payload']['name'],
+                                  response['payload']['text'])
+            return
+
+        if 'request_id' in response:
+            entry = self.mailbox_requests.pop(response['request_id'], None)
+            if entry is not None:
+                if entry[3] is not None:
+                    trace_id, queued = entry[3]
+                    self.tracer.span(trace_id, "interpreter (mailbox)",
+                                     queued, self._received,
+                                     request_type=entry[2])
+                entry[1].callback(response)
+            return
+
+        deferred, self.in_flight = self.in_flight, None
+        if self.in_flight_type is not None:
+            self.metrics.observe("interpreter_round_trip_seconds",
+                                 time.time() - self.in_flight_sent,
+                                 request_type=self.in_flight_type)
+        if self.in_flight_trace is not None:
+            self._traceResponse(self.in_flight_trace[0], response)
+            self.in_flight_trace = None
+        if self.mailbox_path and self.in_flight_type == "execute":
+            self._emptyMailbox()
+        self.in_flight_type = None
+        self._sendNext()
+        if deferred is not None and not deferred.called:
+            deferred.callback(response)
+
+    def _traceResponse(self, trace_id, response):
+        """
+        Record the spans of a request the interpreter answered
+
+        The interpreter reports the CPU time it spent decoding
+        and handling the request, those spans are placed right
+        after the request was sent. The rest of the round trip
+        is spent on the pipes and encoding the response
+        """
+
+        sent = self.in_flight_sent
+        request_type = self.in_flight_type
+        self.tracer.span(trace_id, "interpreter", sent, self._received,
+                         request_type=request_type)
+        timing = response.get('timing')
+        if timing:
+            decoded = sent + timing['decode']
+            handled = decoded + timing['handle']
+            self.tracer.span(trace_id, "lua decode", sent, decoded,
+                             clock="cpu")
+            self.tracer.span(trace_id, "lua " + request_type, decoded,
+                             handled, clock="cpu")
+            self.tracer.span(trace_id, "lua encode and transfer", handled,
+                             self._received)
+        self.tracer.span(trace_id, "reply decode", self._received,
+                         self._decoded)
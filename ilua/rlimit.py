@@ -0,0 +1,124 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Resource limits of the Lua interpreter
+
+Twisted can't run code in the child between fork and exec,
+so limited interpreters are started through this module run
+as a script, which sets the limits and execs the interpreter.
+It only imports the standard library, to start fast
+"""
+
+import os
+import sys
+
+# Limit names mapped to (resource name, bytes or seconds per unit)
+LIMITS = {
+    'address_space': ("RLIMIT_AS", 1024), # KB
+    'cpu': ("RLIMIT_CPU", 1), # seconds
+    'open_files': ("RLIMIT_NOFILE", 1)
+}
+
+SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+def supported():
+    """
+    :return: whether resource limits can be set on this system
+    :rtype: bool
+    """
+
+    try:
+        import resource # pylint: disable=unused-variable
+    except ImportError:
+        return False
+    return True
+
+def wrap(argv, limits):
+    """
+    :param argv: command to run with limits
+    :type argv: list
+    :param limits: names of LIMITS mapped to values, 0 for no limit
+    :type limits: dict
+    :return: command that sets the limits and then runs argv
+    :rtype: list
+    """
+
+    args = ["{}={}".format(name, value)
+            for name, value in sorted(limits.items()) if value]
+    if not args:
+        return list(argv)
+    # -S skips site-packages, nothing from there is needed
+    return [sys.executable, "-S", SCRIPT] + args + ["--"] + list(argv)
+
+def apply(limits):
+    """
+    Set limits on the current process, only lowering
+    the ones already in place
+
+    :param limits: names of LIMITS mapped to values
+    :type limits: dict
+    """
+
+    import resource
+    for name, value in limits.items():
+        resource_name, scale = LIMITS[name]
+        limit = getattr(resource, resource_name)
+        _, hard = resource.getrlimit(limit)
+        soft = value * scale
+        # Past the soft CPU limit the process gets SIGXCPU, and only a
+        # second later SIGKILL, so running out of CPU time tells apart
+        new_hard = soft + 1 if name == "cpu" else soft
+        if hard != resource.RLIM_INFINITY:
+            new_hard = min(new_hard, hard)
+        resource.setrlimit(limit, (min(soft, new_hard), new_hard))
+
+def process_usage(pid):
+    """
+    Resources a process uses, as far as /proc tells
+
+    :param pid: process id
+    :type pid: int
+    :return: any of cpu (seconds), resident and address_space
+             (bytes) and open_files, empty without /proc
+    :rtype: dict
+    """
+
+    usage = {}
+    proc = os.path.join("/proc", str(pid))
+    try:
+        with open(os.path.join(proc, "stat")) as stat:
+            # The command name may hold spaces, fields start after it
+            fields = stat.read().rsplit(")", 1)[1].split()
+        usage['cpu'] = (int(fields[11]) + int(fields[12])) / \
+                       float(os.sysconf("SC_CLK_TCK"))
+        usage['address_space'] = int(fields[20])
+        usage['resident'] = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+        usage['open_files'] = len(os.listdir(os.path.join(proc, "fd")))
+    except (EnvironmentError, IndexError, ValueError):
+        pass
+    return usage
+
+def main(argv=None):
+    """
+    Set limits given as NAME=VALUE arguments, and exec
+    the command following them and "--"
+    """
+
+    argv = sys.argv[1:] if argv is None else argv
+    split = argv.index("--")
+    command = argv[split + 1:]
+    try:
+        apply(dict((name, int(value)) for name, value in
+                   (arg.split("=", 1) for arg in argv[:split])))
+        os.execvp(command[0], command)
+    except (EnvironmentError, ValueError) as err:
+        sys.stderr.write("ILua: could not start {}: {}\n".format(command[0],
+                                                                  err))
+        return 127
+
+if __name__ == '__main__':
+    sys.exit(main())
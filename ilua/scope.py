@@ -0,0 +1,313 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Static scope analysis of cell code, finding the
+names visible at the cursor before the cell runs
+"""
+
+from bisect import bisect_right
+
+from pygments import token
+
+# Size of the chunks compared when looking for the edited part of a cell
+_COMPARE_CHUNK = 4096
+
+def _common_prefix_length(a, b):
+    """
+    Get the length of the common prefix of two strings,
+    comparing chunks at a time
+    """
+    limit = min(len(a), len(b))
+    pos = 0
+    chunk = _COMPARE_CHUNK
+    while pos < limit:
+        end = min(pos + chunk, limit)
+        if a[pos:end] == b[pos:end]:
+            pos = end
+        elif chunk > 1:
+            chunk //= 16
+        else:
+            break
+    return pos
+
+class CellTokens(object):
+    """
+    Lexed prefix of the last cell, relexing only
+    what follows the first edit of a new version
+    """
+
+    def __init__(self, lexer):
+        """
+        :param lexer: Lua lexer
+        :type lexer: pygments.lexers.scripting.LuaLexer
+        """
+
+        self.lexer = lexer
+        self.text = ""
+        # (position, token type, value) of each token
+        self.tokens = []
+        self.positions = []
+        # Count of tokens reused by the last call
+        self.kept = 0
+
+    def get_tokens(self, text):
+        """
+        Lex `text`, reusing the tokens of the last lexed
+        text up to the last safe restart point before the
+        first difference
+
+        :param text: lua source
+        :type text: string
+        :return: (position, token type, value) tuples
+        :rtype: list
+        """
+
+        restart = self._restart_point(_common_prefix_length(self.text, text))
+        self.kept = bisect_right(self.positions, restart) - 1 if restart else 0
+        tokens = self.tokens[:self.kept]
+        tokens.extend((restart + pos, ttype, value) for pos, ttype, value in
+                      self.lexer.get_tokens_unprocessed(text[restart:]))
+        self.text = text
+        self.tokens = tokens
+        self.positions = [pos for pos, _, _ in tokens]
+        return tokens
+
+    def _restart_point(self, limit):
+        """
+        Get the latest token position before `limit` where
+        the lexer is known to be out of strings and comments:
+        a line start following plain whitespace
+        """
+
+        i = bisect_right(self.positions, limit) - 2
+        while i >= 0:
+            _, ttype, value = self.tokens[i]
+            if ttype in token.Text and value.endswith("\n") and \
+               self.positions[i + 1] <= limit:
+                return self.positions[i + 1]
+            i -= 1
+        return 0
+
+def _significant(tokens):
+    return [(ttype, value.strip()) for _, ttype, value in tokens
+            if value.strip() and ttype not in token.Comment]
+
+class ScopeState(object):
+    """
+    Scope analysis state, fed with significant
+    tokens one at a time
+    """
+
+    # How far statements are looked at around the current token
+    MAX_LOOKAROUND = 64
+    # How far processing a token may look ahead, in the worst case
+    # (the parameters of a function)
+    MAX_LOOKAHEAD = 2 * MAX_LOOKAROUND + 2
+
+    def __init__(self):
+        self.scopes = [[]]
+        self.global_names = []
+        self.for_names = None
+        self.braces = 0
+
+    def copy(self):
+        state = ScopeState()
+        state.scopes = [list(scope) for scope in self.scopes]
+        state.global_names = list(self.global_names)
+        state.for_names = self.for_names
+        state.braces = self.braces
+        return state
+
+    def visible_names(self):
+        """
+        :return: visible local names (innermost first), and global names
+        :rtype: tuple
+        """
+
+        local_names = []
+        for scope in reversed(self.scopes):
+            local_names.extend(reversed(scope))
+        return local_names, list(self.global_names)
+
+    def feed(self, tokens, i):
+        """
+        Process the `i`th of the significant `tokens`
+
+        :param tokens: (token type, value) of significant tokens
+        :type tokens: list
+        :param i: index of the token to process
+        :type i: int
+        """
+
+        get = lambda j: tokens[j] if 0 <= j < len(tokens) else (None, "")
+        ttype, value = tokens[i]
+        if ttype in token.Keyword:
+            if value == "local" and get(i + 1)[1] != "function":
+                self.scopes[-1].extend(self._names_from(tokens, i + 1))
+            elif value == "function":
+                self._function(tokens, i)
+            elif value == "for":
+                self.for_names = self._names_from(tokens, i + 1)
+            elif value in ("do", "then", "repeat"):
+                self.scopes.append(self.for_names or [] if value == "do"
+                                   else [])
+                self.for_names = None
+            elif value == "else":
+                self._close_scope()
+                self.scopes.append([])
+            elif value in ("end", "until", "elseif"):
+                self._close_scope()
+        elif ttype in token.Punctuation:
+            self.braces += value.count("{") - value.count("}")
+        elif ttype in token.Operator and value == "=" and self.braces == 0 \
+             and _is_name(get(i - 1)):
+            self._assignment(tokens, i)
+
+    def _close_scope(self):
+        if len(self.scopes) > 1:
+            self.scopes.pop()
+
+    def _names_from(self, tokens, i):
+        """
+        Collect `name [<attrib>], name...` starting at i
+        """
+
+        names = []
+        end = min(len(tokens), i + self.MAX_LOOKAROUND)
+        while i < end and _is_name(tokens[i]):
+            names.append(tokens[i][1])
+            i += 1
+            if i < end and tokens[i][1] == "<":
+                i += 3
+            if i >= end or tokens[i][1] != ",":
+                break
+            i += 1
+        return names
+
+    def _function(self, tokens, i):
+        get = lambda j: tokens[j] if 0 <= j < len(tokens) else (None, "")
+        j = i + 1
+        chain = []
+        while _is_name(get(j)) and j - i < self.MAX_LOOKAROUND:
+            chain.append(get(j)[1])
+            if get(j + 1)[1] not in (".", ":"):
+                break
+            j += 2
+        if get(i - 1)[1] == "local" and chain:
+            self.scopes[-1].append(chain[0])
+        elif len(chain) == 1:
+            self.global_names.append(chain[0])
+        params = ["self"] if get(j - 1)[1] == ":" else []
+        # Parameters follow, unless they are empty (lexed as "()")
+        while get(j)[1] not in ("", "(") and not get(j)[1].startswith("()") \
+              and j - i < self.MAX_LOOKAROUND:
+            j += 1
+        if get(j)[1] == "(":
+            params.extend(self._names_from(tokens, j + 1))
+        self.scopes.append(params)
+
+    def _assignment(self, tokens, i):
+        """
+        Record the globals of `a, b = ...`, but not
+        of `a.b = ...` nor `for i = ...` nor `local a = ...`
+        """
+
+        get = lambda j: tokens[j] if 0 <= j < len(tokens) else (None, "")
+        j = i - 1
+        names = []
+        while _is_name(get(j)) and i - j < self.MAX_LOOKAROUND:
+            names.append(get(j)[1])
+            if get(j - 1)[1] != ",":
+                break
+            j -= 2
+        if get(j - 1)[1] not in (".", ":", "for", "local"):
+            declared = set(name for scope in self.scopes for name in scope)
+            self.global_names.extend(name for name in reversed(names)
+                                     if name not in declared)
+
+def _is_name(tok):
+    return tok[0] is not None and tok[0] in token.Name
+
+def visible_names(tokens):
+    """
+    Find the names visible after `tokens`: locals of the
+    enclosing scopes (innermost first) and globals the code
+    assigns or defines
+
+    :param tokens: (position, token type, value) tuples of lua code
+    :type tokens: list
+    :return: visible local names and global names
+    :rtype: tuple
+    """
+
+    tokens = _significant(tokens)
+    state = ScopeState()
+    for i in range(len(tokens)):
+        state.feed(tokens, i)
+    return state.visible_names()
+
+class CellScopes(object):
+    """
+    Scope analysis of the last cell, resuming from
+    snapshots taken before the first edit of a new
+    version of the cell
+    """
+
+    # Significant tokens between state snapshots
+    SNAPSHOT_INTERVAL = 512
+
+    def __init__(self, lexer):
+        """
+        :param lexer: Lua lexer
+        :type lexer: pygments.lexers.scripting.LuaLexer
+        """
+
+        self.cell_tokens = CellTokens(lexer)
+        # (token type, value) of significant tokens, and
+        # the index of each in the full token list
+        self.significant = []
+        self.token_indexes = []
+        # (significant token index, state before it)
+        self.snapshots = [(0, ScopeState())]
+
+    def visible_names(self, text):
+        """
+        Find the names visible at the end of `text`,
+        see ilua.scope.visible_names
+
+        :param text: lua source
+        :type text: string
+        :return: visible local names and global names
+        :rtype: tuple
+        """
+
+        tokens = self.cell_tokens.get_tokens(text)
+        kept = self.cell_tokens.kept
+
+        # Keep what was derived from tokens that are still there
+        valid = bisect_right(self.token_indexes, kept - 1)
+        del self.significant[valid:]
+        del self.token_indexes[valid:]
+        for index in range(kept, len(tokens)):
+            _, ttype, value = tokens[index]
+            value = value.strip()
+            if value and ttype not in token.Comment:
+                self.significant.append((ttype, value))
+                self.token_indexes.append(index)
+
+        # Snapshots are taken before a token, whose processing
+        # may look a few tokens around it
+        resume = valid - ScopeState.MAX_LOOKAHEAD
+        while len(self.snapshots) > 1 and self.snapshots[-1][0] > resume:
+            self.snapshots.pop()
+        start, state = self.snapshots[-1]
+        state = state.copy()
+        for i in range(start, len(self.significant)):
+            if i % self.SNAPSHOT_INTERVAL == 0 and i > self.snapshots[-1][0]:
+                self.snapshots.append((i, state.copy()))
+            state.feed(self.significant, i)
+        return state.visible_names()
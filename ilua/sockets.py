@@ -12,18 +12,179 @@ sockets used in the Jupyter protocol
 The sockets provide a simple API for the
 kernel to communicate with the frontend
 """
+import threading
+
 import txzmq
+import zmq
+
+SOCKET_NAMES = ("shell", "control", "iopub", "stdin", "hb")
+
+# Tunable ZeroMQ socket options, by the names used to set them
+SOCKET_OPTIONS = {
+    'sndhwm': zmq.SNDHWM,
+    'rcvhwm': zmq.RCVHWM,
+    'linger': zmq.LINGER,
+    'tcp_keepalive': zmq.TCP_KEEPALIVE,
+    'tcp_keepalive_idle': zmq.TCP_KEEPALIVE_IDLE,
+    'tcp_keepalive_intvl': zmq.TCP_KEEPALIVE_INTVL,
+    'tcp_keepalive_cnt': zmq.TCP_KEEPALIVE_CNT
+}
+
+# txzmq leaves high water marks unlimited, so messages to a slow
+# peer pile up in memory. These are the ZeroMQ defaults
+DEFAULT_OPTIONS = {
+    'sndhwm': 1000,
+    'rcvhwm': 1000
+}
+
+def parse_socket_option(spec):
+    """
+    Parse a socket option setting
+
+    :param spec: "[socket.]option=value", socket being one of
+                 SOCKET_NAMES, all sockets when omitted, and
+                 option one of SOCKET_OPTIONS
+    :type spec: string
+    :return: (socket or None, option, value)
+    :rtype: tuple
+    :raises ValueError: spec is malformed
+    """
+
+    name, sep, value = spec.partition("=")
+    socket, _, option = name.strip().rpartition(".")
+    if not sep or (socket and socket not in SOCKET_NAMES):
+        raise ValueError("expected [{}.]option=value, got {!r}".format(
+            "|".join(SOCKET_NAMES), spec))
+    if option not in SOCKET_OPTIONS:
+        raise ValueError("unknown socket option {!r}, expected one of "
+                         "{}".format(option, ", ".join(sorted(SOCKET_OPTIONS))))
+    try:
+        return socket or None, option, int(value)
+    except ValueError:
+        raise ValueError("value of {} must be an integer, got {!r}".format(
+            option, value))
+
+def format_socket_option(socket, option, value):
+    """
+    Format a socket option setting back, the
+    inverse of parse_socket_option
+
+    :return: "[socket.]option=value"
+    :rtype: string
+    """
+
+    return "{}{}={}".format(socket + "." if socket else "", option, value)
+
+def socket_options(settings, socket):
+    """
+    Options of a socket, defaults updated with the settings
+    for all sockets then with those for it
+
+    :param settings: (socket or None, option, value) tuples,
+                     see parse_socket_option
+    :type settings: list
+    :param socket: one of SOCKET_NAMES
+    :type socket: string
+    :return: option mapped to value
+    :rtype: dict
+    """
+
+    options = dict(DEFAULT_OPTIONS)
+    for target in (None, socket):
+        options.update((option, value) for name, option, value in settings
+                       if name == target)
+    return options
+
+def set_options(socket, options):
+    """
+    :param socket: socket to set the options of, before it binds
+    :type socket: zmq.Socket
+    :param options: option mapped to value, see SOCKET_OPTIONS
+    :type options: dict
+    """
+
+    for option, value in options.items():
+        socket.setsockopt(SOCKET_OPTIONS[option], value)
 
-class HearbeatConnection(txzmq.ZmqREPConnection):
+class TunedConnection(object):
+    """
+    Mixin of txzmq connections, setting socket
+    options before binding
+    """
+
+    def __init__(self, factory, endpoint, options=None):
+        """
+        :param factory: ZeroMQ Twisted factory
+        :type factory: txzmq.ZmqFactory
+        :param endpoint: endpoint to bind to
+        :type endpoint: txzmq.ZmqEndpoint
+        :param options: option mapped to value, see SOCKET_OPTIONS
+        :type options: dict, optional
+        """
+
+        super(TunedConnection, self).__init__(factory)
+        set_options(self.socket, options or {})
+        self.addEndpoints([endpoint])
+
+class HearbeatConnection(TunedConnection, txzmq.ZmqREPConnection):
     """
     Simple echo socket for heartbeats, init and
     forget
+
+    Echoes on the reactor, so heartbeats stall whenever
+    the reactor is busy, see HeartbeatThread
     """
 
     def gotMessage(self, messageId, *messageParts):
         self.reply(messageId, *messageParts)
 
-class ShellConnection(txzmq.ZmqRouterConnection):
+class HeartbeatThread(threading.Thread):
+    """
+    Heartbeat echo running on a thread of its own, with its
+    own ZeroMQ context, so heartbeats are answered even while
+    the reactor is blocked (as ipykernel does)
+    """
+
+    def __init__(self, endpoint, options=None):
+        """
+        :param endpoint: endpoint to bind to
+        :type endpoint: txzmq.ZmqEndpoint
+        :param options: option mapped to value, see SOCKET_OPTIONS
+        :type options: dict, optional
+        """
+
+        super(HeartbeatThread, self).__init__(name="heartbeat")
+        self.daemon = True
+        self.context = zmq.Context()
+        # Bound right away, so the port is known before the thread runs
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.linger = 0
+        set_options(self.socket, options or {})
+        self.socket.bind(endpoint.address)
+
+    def run(self):
+        try:
+            # Routes every ping straight back to its sender
+            zmq.device(zmq.QUEUE, self.socket, self.socket)
+        except zmq.ZMQError as err:
+            if err.errno != zmq.ETERM:
+                raise
+        finally:
+            self.socket.close()
+
+    def stop(self):
+        """
+        Stop echoing, and wait for the thread to end
+        """
+
+        if self.ident is None:
+            self.socket.close()
+        # Interrupts the device, the thread then closes the socket
+        self.context.term()
+        if self.ident is not None:
+            self.join()
+
+class ShellConnection(TunedConnection, txzmq.ZmqRouterConnection):
     """
     Shell connection socket, handling requests
     from the frontend
@@ -36,14 +197,43 @@ class ShellConnection(txzmq.ZmqRouterConnection):
     def gotMessage(self, sender_id, *messageParts):
         self.message_handler(self, sender_id, messageParts)
     
-class IOPubConnection(txzmq.ZmqPubConnection):
+class IOPubConnection(TunedConnection, txzmq.ZmqPubConnection):
     """
     IOPub socket for message broadcasts
+
+    A PUB socket drops messages silently once a subscriber
+    is SNDHWM messages behind. Where ZeroMQ supports it, this
+    is an XPUB socket that refuses them instead, so the kernel
+    knows to hold messages back
     """
 
+    if hasattr(zmq, "XPUB_NODROP"):
+        socketType = zmq.XPUB
+
+    def __init__(self, factory, endpoint, options=None):
+        super(IOPubConnection, self).__init__(factory, endpoint, options)
+        if self.socketType == zmq.XPUB:
+            self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+
     def publish(self, message):
-        self.send(message)
+        """
+        :param message: message frames
+        :type message: list
+        :return: whether the message was sent, False if
+                 a subscriber is too far behind to take it
+        :rtype: bool
+        """
+
+        try:
+            self.send(message)
+        except zmq.Again:
+            return False
+        return True
+
+    def messageReceived(self, message):
+        # Subscriptions, XPUB sockets pass them on
+        pass
 
-class StdinConnection(txzmq.ZmqRouterConnection):
+class StdinConnection(TunedConnection, txzmq.ZmqRouterConnection):
     # TODO: unused
     pass
@@ -0,0 +1,104 @@
+# ILua
+# Copyright (C) 2018  guysv
+
+# This file is part of ILua which is released under GPLv2.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-2.0.txt
+# for full license details.
+"""
+Per-request span tracing, written in the Chrome trace
+event format (chrome://tracing, ui.perfetto.dev)
+
+Spans of a request are async events keyed by its msg_id,
+so each request gets a track of its own in the viewer
+"""
+
+import json
+import os
+
+from twisted.logger import Logger
+
+class Tracer(object):
+    """
+    Writes spans to a trace file as they end
+
+    The file is a JSON array of trace events, closed on
+    close(). Viewers load it even if the kernel died
+    before closing it
+    """
+
+    enabled = True
+
+    log = Logger()
+
+    def __init__(self, path):
+        """
+        :param path: trace file to write, replaced if it exists
+        :type path: string
+        """
+
+        self.path = path
+        self.pid = os.getpid()
+        self._file = open(path, "w")
+        self._file.write("[")
+        self._write({
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': self.pid,
+            'args': {'name': 'ILua kernel'}
+        }, first=True)
+
+    def span(self, trace_id, name, start, end, **args):
+        """
+        Record a span of a request
+
+        :param trace_id: msg_id of the request
+        :type trace_id: string
+        :param name: what happened during the span
+        :type name: string
+        :param start: time the span started (time.time())
+        :type start: float
+        :param end: time the span ended (time.time())
+        :type end: float
+        :param args: extra details shown with the span
+        :type args: dict
+        """
+
+        if self._file is None:
+            return
+        args['msg_id'] = trace_id
+        event = {
+            'name': name,
+            'cat': 'ilua',
+            'id': trace_id,
+            'pid': self.pid,
+            'tid': self.pid,
+        }
+        self._write(dict(event, ph='b', ts=start * 1e6, args=args))
+        self._write(dict(event, ph='e', ts=max(start, end) * 1e6))
+
+    def _write(self, event, first=False):
+        if not first:
+            self._file.write(",\n")
+        self._file.write(json.dumps(event))
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write("]\n")
+        self._file.close()
+        self._file = None
+        self.log.info("Wrote trace to {path}", path=self.path)
+
+class NullTracer(object):
+    """
+    Stand-in for Tracer when tracing is disabled,
+    every method does nothing
+    """
+
+    enabled = False
+
+    def span(self, trace_id, name, start, end, **args):
+        pass
+
+    def close(self):
+        pass